@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""Measure the startup time of `git-hg-cli`, and what its imports cost.
+
+Run with `python -m benchmarks.bench_cli_startup`. Commands import their own
+dependencies, so importing the CLI itself should stay cheap.
+"""
+
+import subprocess
+import sys
+import time
+
+ROUNDS = 10
+COMMANDS = {
+    "interpreter": ["-c", "pass"],
+    "import": ["-c", "import git_hg_sync.cli"],
+    "--help": ["-m", "git_hg_sync.cli", "--help"],
+}
+
+
+def best_time(args: list[str]) -> float:
+    timings = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *args], check=True, capture_output=True)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def heaviest_imports(count: int = 10) -> list[tuple[int, str]]:
+    """Return the modules imported by the CLI, by cumulative time in microseconds."""
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import git_hg_sync.cli"],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stderr
+    imports = []
+    for line in output.splitlines()[1:]:
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        # Nested imports are indented by two more spaces, only keep those of the CLI.
+        if len(name) - len(name.lstrip()) == 3:
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main() -> None:
+    for name, args in COMMANDS.items():
+        print(f"{name:12} {best_time(args) * 1000:6.1f}ms")
+    print("Heaviest imports:")
+    for cumulative, name in heaviest_imports():
+        print(f"  {cumulative / 1000:6.1f}ms {name}")
+
+
+if __name__ == "__main__":
+    main()
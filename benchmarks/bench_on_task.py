@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Measure the overhead of decoding and validating a message in `PulseWorker.on_task`.
+
+Run with `python -m benchmarks.bench_on_task`. Handling the event is left out, so
+this only covers what happens on the consumer thread for each received message.
+"""
+
+import json
+import os
+import timeit
+from pathlib import Path
+from unittest import mock
+
+from mozlog import commandline
+
+from git_hg_sync.pulse_worker import PulseWorker
+
+ROUNDS = 5
+
+
+def make_body(tag_count: int) -> dict:
+    return {
+        "payload": {
+            "type": "push",
+            "repo_url": "https://github.com/mozilla-firefox/firefox",
+            "branches": {"main": "a" * 40},
+            "tags": {f"FIREFOX_{n}_RELEASE": f"{n:040x}" for n in range(tag_count)},
+            "time": 0,
+            "push_id": 0,
+            "user": "user@example.com",
+            "push_json_url": "https://example.com/push.json",
+        },
+        "_meta": {"exchange": "exchange/git-push", "routing_key": "firefox"},
+    }
+
+
+def bench(worker: PulseWorker, body: dict | str, number: int) -> float:
+    """Return the best time per message, in microseconds."""
+    message = mock.MagicMock()
+    # Messages are consumed by parsing, so each one gets a fresh copy.
+    bodies = [
+        body if isinstance(body, str) else json.loads(json.dumps(body))
+        for _ in range(number * ROUNDS)
+    ]
+    timings = timeit.repeat(
+        lambda: worker.on_task(bodies.pop(), message), number=number, repeat=ROUNDS
+    )
+    return min(timings) / number * 1e6
+
+
+def main() -> None:
+    with Path(os.devnull).open("w") as devnull:
+        commandline.setup_logging("benchmark", {}, {"raw": devnull})
+        worker = PulseWorker(mock.MagicMock(), mock.MagicMock())
+        with mock.patch.object(PulseWorker, "_enqueue"):
+            for tag_count, number in ((0, 2000), (100, 500), (5000, 20)):
+                body = make_body(tag_count)
+                as_dict = bench(worker, body, number)
+                as_string = bench(worker, json.dumps(body), number)
+                print(
+                    f"{tag_count:5} tags: {as_dict:9.1f}us (decoded), {as_string:9.1f}us (JSON string)"
+                )
+
+
+if __name__ == "__main__":
+    main()
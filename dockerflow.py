@@ -1,32 +1,58 @@
 import logging
 import os
+import time
 
 import flask
 
 from git_hg_sync.application import Application
 
+# A worker running the same sync stage for longer than this is considered stalled,
+# except for the stages without timeouts, which opt out (see `Stage.stall_check`).
+STALL_TIMEOUT = float(os.environ.get("STALL_TIMEOUT", "7200"))
+
 app = flask.Flask(__name__)
 
 
 @app.route("/__lbheartbeat__")
 def lb_heartbeat() -> flask.Response:
+    if not Application.is_ready():
+        return flask.Response("not ready: warming up", status=503)
     return flask.Response("ok")
 
 
 @app.route("/__heartbeat__")
 def heartbeat() -> flask.Response:
     try:
-        pid = Application.get_pid()
+        pids = Application.get_pids()
     except (OSError, ValueError):
-        return flask.Response("failed to read pidfile", status=503)
+        return flask.Response("failed to read pidfiles", status=503)
+    if not pids:
+        return flask.Response("no process running", status=503)
 
-    try:
-        # Test is a process with this PID is still running.
-        # Returns 0 if so, or raises OSError otherwise.
-        os.kill(pid, 0)
-    except OSError:
-        return flask.Response(f"pid {pid} not running", status=503)
-    return flask.Response(f"ok: pid {pid} running", status=200)
+    for name, pid in pids.items():
+        try:
+            # Test is a process with this PID is still running.
+            # Returns 0 if so, or raises OSError otherwise.
+            os.kill(pid, 0)
+        except OSError:
+            return flask.Response(f"{name}: pid {pid} not running", status=503)
+
+    now = time.time()
+    for name, status in Application.get_statuses().items():
+        for stage, stage_status in (status or {}).get("stages", {}).items():
+            running = now - stage_status["started"]
+            if stage_status["stall_check"] and running > STALL_TIMEOUT:
+                return flask.Response(
+                    f"{name}: stalled in {stage} for {running:.0f}s", status=503
+                )
+
+    running = ", ".join(f"{name} (pid {pid})" for name, pid in pids.items())
+    return flask.Response(f"ok: {running} running", status=200)
+
+
+@app.route("/__status__")
+def status() -> flask.Response:
+    return flask.jsonify(Application.get_statuses())
 
 
 @app.route("/")
@@ -35,6 +61,7 @@ def index() -> flask.Response:
         "<pre>git-hg-sync\n"
         '<a href="__lbheartbeat__">__lbheartbeat__</a>\n'
         '<a href="__heartbeat__">__heartbeat__</a>\n'
+        '<a href="__status__">__status__</a>\n'
         "</pre>"
     )
 
@@ -1,3 +1,3 @@
-from .consts import PID_FILEPATH
+from .consts import REGISTRY_DIRECTORY
 
-__all__ = ["PID_FILEPATH"]
+__all__ = ["REGISTRY_DIRECTORY"]
@@ -1,16 +1,26 @@
 import argparse
 import sys
+from collections.abc import Callable
+from contextlib import nullcontext
+from functools import partial
 from pathlib import Path
 
 import sentry_sdk
-from kombu import Connection, Exchange, Queue
 from mozlog import commandline
 from pydantic import ValidationError
 
 from git_hg_sync.application import Application
-from git_hg_sync.config import Config, PulseConfig
+from git_hg_sync.config import Config
+from git_hg_sync.leases import FileLeaseManager, default_holder
+from git_hg_sync.ledger import Ledger
+from git_hg_sync.limiter import HostLimiters
+from git_hg_sync.mapping import Mapping
 from git_hg_sync.pulse_worker import PulseWorker
+from git_hg_sync.queues import get_connection, get_parking_queue, get_queue
 from git_hg_sync.repo_synchronizer import RepoSynchronizer
+from git_hg_sync.ssh import SshMultiplexer
+from git_hg_sync.supervisor import Supervisor, worker_configs
+from git_hg_sync.warmup import warm_up
 
 
 def get_parser() -> argparse.ArgumentParser:
@@ -22,32 +32,52 @@ def get_parser() -> argparse.ArgumentParser:
         required=True,
         help="Configuration file path.",
     )
-    return parser
-
-
-def get_connection(config: PulseConfig) -> Connection:
-    return Connection(
-        hostname=config.host,
-        port=config.port,
-        userid=config.userid,
-        password=config.password,
-        heartbeat=config.heartbeat,
-        ssl=config.ssl,
+    parser.add_argument(
+        "--supervise",
+        action="store_true",
+        help="Run one worker process per tracked repository or configured shard.",
     )
+    return parser
 
 
-def get_queue(config: PulseConfig) -> Queue:
-    exchange = Exchange(config.exchange, type="topic")
-    return Queue(
-        name=config.queue,
-        exchange=exchange,
-        routing_key=config.routing_key,
-        exclusive=False,
-    )
+def get_synchronizers(
+    config: Config,
+    current: dict[str, RepoSynchronizer] | None = None,
+    ssh: SshMultiplexer | None = None,
+    limiters: HostLimiters | None = None,
+) -> dict[str, RepoSynchronizer]:
+    """Create the synchronizer of each tracked repository.
+
+    Synchronizers from `current` are reused if their settings didn't change, e.g. when
+    reloading the configuration.
+    """
+    current = current or {}
+    synchronizers = {}
+    for tracked_repo in config.tracked_repositories:
+        clone_directory = config.clones.directory / tracked_repo.name
+        synchronizer = current.get(tracked_repo.url)
+        if not synchronizer or not synchronizer.is_configured_as(
+            clone_directory, tracked_repo.url, tracked_repo.shards, config.timeouts
+        ):
+            synchronizer = RepoSynchronizer(
+                clone_directory,
+                tracked_repo.url,
+                tracked_repo.shards,
+                config.timeouts,
+                ssh,
+                limiters,
+            )
+        synchronizers[tracked_repo.url] = synchronizer
+    return synchronizers
 
 
 def start_app(
-    config: Config, logger: commandline.StructuredLogger, *, one_shot: bool = False
+    config: Config,
+    logger: commandline.StructuredLogger,
+    *,
+    one_shot: bool = False,
+    name: str = "worker",
+    load_config: Callable[[], Config] | None = None,
 ) -> None:
     pulse_config = config.pulse
     connection = get_connection(pulse_config)
@@ -58,18 +88,86 @@ def start_app(
     queue(connection).queue_bind()
     logger.info(f"Reading messages from {connection}/{queue.name} ...")
 
-    synchronizers = {
-        tracked_repo.url: RepoSynchronizer(
-            config.clones.directory / tracked_repo.name, tracked_repo.url
+    ssh = None
+    if config.ssh_multiplexing:
+        ssh = SshMultiplexer(
+            config.ssh_multiplexing.control_directory,
+            persist=config.ssh_multiplexing.persist,
+            connect_timeout=config.ssh_multiplexing.connect_timeout,
+            check_interval=config.ssh_multiplexing.check_interval,
         )
-        for tracked_repo in config.tracked_repositories
-    }
-    with connection as conn:
+
+    limiters = None
+    if config.concurrency:
+        limiters = HostLimiters(**config.concurrency.model_dump())
+
+    synchronizers = get_synchronizers(config, ssh=ssh, limiters=limiters)
+    mappings = [*config.branch_mappings, *config.tag_mappings]
+    warmup = None
+    if config.warmup.enabled:
+        warmup = partial(
+            warm_up,
+            config.tracked_repositories,
+            synchronizers,
+            mappings,
+            max_workers=config.warmup.jobs,
+        )
+
+    lease_options = {}
+    if config.leases:
+        lease_options = {
+            "leases": FileLeaseManager(
+                config.leases.directory, default_holder(name), config.leases.ttl
+            ),
+            "skip_without_lease": config.leases.on_unavailable == "skip",
+            "lease_retry_interval": config.leases.retry_interval,
+        }
+
+    reloader = None
+    if load_config:
+        # Only the tracked repositories and the mappings are reloaded on SIGHUP.
+        def reloader(
+            current: dict[str, RepoSynchronizer],
+        ) -> tuple[dict[str, RepoSynchronizer], list[Mapping]]:
+            new_config = load_config()
+            return get_synchronizers(new_config, current, ssh, limiters), [
+                *new_config.branch_mappings,
+                *new_config.tag_mappings,
+            ]
+
+    ledger = None
+    if config.ledger:
+        ledger = Ledger(config.ledger.path)
+        ledger.compact(config.ledger.retention_days * 24 * 3600)
+
+    with connection as conn, ssh or nullcontext():
+        if ssh:
+            ssh.warm(
+                mapping.destination_url
+                for mapping in mappings
+                if not mapping.is_dynamic
+            )
         conn.connect()
         logger.info(f"connected to {conn.host}")
-        worker = PulseWorker(conn, queue, one_shot=one_shot)
+        worker = PulseWorker(
+            conn,
+            queue,
+            one_shot=one_shot,
+            lookahead=pulse_config.lookahead,
+            retry_delay=pulse_config.retry_delay,
+            max_retry_delay=pulse_config.max_retry_delay,
+            max_attempts=pulse_config.max_attempts,
+            parking_queue=get_parking_queue(pulse_config),
+        )
         app = Application(
-            worker, synchronizers, [*config.branch_mappings, *config.tag_mappings]
+            worker,
+            synchronizers,
+            mappings,
+            warmup,
+            name=name,
+            ledger=ledger,
+            reloader=reloader,
+            **lease_options,
         )
         app.run()
 
@@ -89,7 +187,20 @@ def main() -> None:
     if sentry_config and sentry_config.sentry_dsn:
         logger.info(f"Sentry DSN: {sentry_config.sentry_dsn}")
         sentry_sdk.init(sentry_config.sentry_dsn, max_value_length=4096)
-    start_app(config, logger)
+
+    if args.supervise:
+        supervisor = Supervisor(
+            config,
+            lambda worker_config, name: start_app(
+                worker_config,
+                logger,
+                name=name,
+                load_config=lambda: worker_configs(Config.from_file(args.config))[name],
+            ),
+        )
+        supervisor.run()
+    else:
+        start_app(config, logger, load_config=partial(Config.from_file, args.config))
 
 
 if __name__ == "__main__":
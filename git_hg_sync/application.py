@@ -1,22 +1,49 @@
 import dataclasses
 import json
-import os
 import signal
 import sys
-from collections.abc import Sequence
+import threading
+from collections.abc import Callable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass
+from functools import partial
 from types import FrameType
+from typing import TYPE_CHECKING, Any
 
 import sentry_sdk
 from mozlog import get_proxy_logger
 
-from git_hg_sync import PID_FILEPATH
 from git_hg_sync.events import Event, Push
+from git_hg_sync.leases import LeaseManager, LeaseRenewer, LeaseUnavailableError
+from git_hg_sync.ledger import Ledger
 from git_hg_sync.mapping import Mapping, SyncOperation
-from git_hg_sync.pulse_worker import PulseWorker
+from git_hg_sync.metrics import metrics
+from git_hg_sync.pulse_worker import Lane, PulseWorker
+from git_hg_sync.registry import ProcessRegistry
 from git_hg_sync.repo_synchronizer import RepoSynchronizer
+from git_hg_sync.status import StatusPublisher, status
+
+if TYPE_CHECKING:
+    from pathlib import Path
 
 logger = get_proxy_logger(__name__)
 
+# Build the synchronizers and mappings from the reloaded configuration, given the
+# current synchronizers to reuse those of the unchanged repositories.
+ConfigReloader = Callable[
+    [dict[str, RepoSynchronizer]],
+    tuple[dict[str, RepoSynchronizer], Sequence[Mapping]],
+]
+
+
+@dataclass(frozen=True)
+class _Tracking:
+    """What the events are synced with, swapped as a whole on configuration reloads."""
+
+    repo_synchronizers: dict[str, RepoSynchronizer]
+    mappings: Sequence[Mapping]
+
 
 class Application:
     def __init__(
@@ -24,49 +51,321 @@ class Application:
         worker: PulseWorker,
         repo_synchronizers: dict[str, RepoSynchronizer],
         mappings: Sequence[Mapping],
+        warmup: Callable[[], object] | None = None,
+        *,
+        name: str = "worker",
+        registry: ProcessRegistry | None = None,
+        leases: LeaseManager | None = None,
+        skip_without_lease: bool = False,
+        lease_retry_interval: float = 5,
+        ledger: Ledger | None = None,
+        reloader: ConfigReloader | None = None,
     ) -> None:
         self._worker = worker
         self._worker.event_handler = self._handle_event
-        self._repo_synchronizers = repo_synchronizers
-        self._mappings = mappings
+        self._worker.event_preparer = self._prepare_event
+        self._worker.event_lane = self._event_lane
+        self._worker.event_settled = self._forget_checkpoints
+        self._tracking = _Tracking(repo_synchronizers, mappings)
+        self._reloader = reloader
+        self._reload_requested = False
+        self._worker.iteration_callback = self._on_iteration
+        self._warmup = warmup
+        self._name = name
+        self._registry = registry or ProcessRegistry()
+        self._leases = leases
+        self._skip_without_lease = skip_without_lease
+        self._lease_retry_interval = lease_retry_interval
+        # Whether the worker stopped consuming after losing a lease.
+        self._lease_lost = False
+        self._ledger = ledger
+        # Without a ledger, the destinations already synced for the pushes which failed
+        # are only remembered by this process, until their message is acknowledged,
+        # e.g. once they succeed or are parked.
+        self._checkpoints: dict[tuple[str, int], set[str]] = {}
+        self._checkpoints_lock = threading.Lock()
+        self._stopping = threading.Event()
 
     def run(self) -> None:
         def signal_handler(_sig: int, _frame: FrameType | None) -> None:
-            PID_FILEPATH.unlink(missing_ok=True)
-            if self._worker.should_stop:
+            self._registry.unregister(self._name)
+            if self._stopping.is_set():
                 logger.info("Process killed by user")
                 sys.exit(1)
+            self._stopping.set()
             self._worker.should_stop = True
             logger.info("Process exiting gracefully")
 
+        def reload_handler(_sig: int, _frame: FrameType | None) -> None:
+            # Applied from the consumer loop, see `_apply_reload`.
+            logger.info("Configuration reload requested")
+            self._reload_requested = True
+
         signal.signal(signal.SIGINT, signal_handler)
         signal.signal(signal.SIGTERM, signal_handler)
-        PID_FILEPATH.write_text(f"{os.getpid()}\n")
-        self._worker.run()
+        if self._reloader:
+            signal.signal(signal.SIGHUP, reload_handler)
+        self._registry.register(self._name)
+
+        try:
+            # Only report readiness once the warmup is done, so the first messages
+            # don't pay the bootstrap costs.
+            if self._warmup:
+                self._warmup()
+            self._registry.mark_ready(self._name)
+
+            with ExitStack() as stack:
+                stack.enter_context(
+                    StatusPublisher(self._registry.status_path(self._name))
+                )
+                if self._leases:
+                    stack.enter_context(LeaseRenewer(self._leases))
+                self._consume()
+        finally:
+            if self._leases:
+                # Let other workers take over without waiting for the leases to expire.
+                self._leases.release_all()
+            self._registry.unregister(self._name)
+
+    @property
+    def _exclusive_leases(self) -> bool:
+        """Whether the worker only consumes while holding the leases, see `_consume`."""
+        return self._leases is not None and not self._skip_without_lease
+
+    def _consume(self) -> None:
+        """Run the worker, only while holding the leases of the tracked repositories.
+
+        Workers sharing a queue would otherwise push the messages of a repository out
+        of order: a worker holding a message it can't handle yet, even briefly, lets
+        the lease holder handle the following ones first. So the workers without the
+        leases don't consume at all, and retry taking them every
+        `lease_retry_interval` seconds.
+        """
+        while not self._stopping.is_set():
+            if self._exclusive_leases and not self._acquire_leases():
+                if not self._lease_lost:
+                    logger.info(
+                        "Tracked repositories leased elsewhere, waiting for their leases ..."
+                    )
+                    self._lease_lost = True
+                self._stopping.wait(self._lease_retry_interval)
+                continue
+            self._lease_lost = False
+            self._worker.run()
+            if not self._lease_lost or self._stopping.is_set():
+                return
+            # The requeued messages may go to other workers, and never come back.
+            with self._checkpoints_lock:
+                self._checkpoints.clear()
+            # Consume again once the leases are back.
+            self._worker.should_stop = False
+
+    def _acquire_leases(self) -> bool:
+        """Acquire the leases of all the tracked repositories, and return if it worked.
+
+        If not, the held leases are released, so they don't block other workers. The
+        leases of repositories which aren't tracked anymore are released too.
+        """
+        assert self._leases
+        tracked = set(self._tracking.repo_synchronizers)
+        held = set(self._leases.held())
+        for name in held - tracked:
+            self._leases.release(name)
+        if all(self._leases.acquire(name) for name in sorted(tracked - held)):
+            return True
+        self._leases.release_all()
+        return False
+
+    def _stop_without_leases(self) -> None:
+        """Stop consuming after losing a lease, until the leases are back."""
+        logger.warning("Lost the lease of a tracked repository, stopping consuming")
+        metrics.incr("leases.standby")
+        self._lease_lost = True
+        self._worker.should_stop = True
 
     @classmethod
-    def get_pid(cls) -> int:
-        return int(PID_FILEPATH.read_text().strip())
+    def get_pids(cls) -> dict[str, int]:
+        """Return the PIDs of the running processes, by name."""
+        return ProcessRegistry().pids()
 
-    def _handle_push_event(self, push_event: Push) -> None:
-        logger.debug(f"Handling event {push_event}")
-        synchronizer = self._repo_synchronizers[push_event.repo_url]
-        operations_by_destination: dict[str, list[SyncOperation]] = {}
+    @classmethod
+    def get_statuses(cls) -> dict[str, dict[str, Any] | None]:
+        """Return the live status of the running processes, by name, if any."""
+        return ProcessRegistry().statuses()
+
+    @classmethod
+    def is_ready(cls) -> bool:
+        return ProcessRegistry().is_ready()
+
+    def _on_iteration(self) -> None:
+        self._apply_reload()
+        if (
+            self._exclusive_leases
+            and not self._lease_lost
+            and not self._stopping.is_set()
+            and not self._acquire_leases()
+        ):
+            self._stop_without_leases()
 
-        for mapping in self._mappings:
+    def _apply_reload(self) -> None:
+        """Reload the configuration, if requested.
+
+        The tracked repositories and mappings are swapped at once, while the events
+        being prepared or handled keep using the previous ones.
+        """
+        if not self._reload_requested or not self._reloader:
+            return
+        self._reload_requested = False
+        try:
+            with metrics.timer("config.reload"):
+                repo_synchronizers, mappings = self._reloader(
+                    self._tracking.repo_synchronizers
+                )
+        except Exception:
+            logger.error(
+                "Failed to reload the configuration, keeping the current one",
+                exc_info=True,
+            )
+            metrics.incr("config.reload_failed")
+            return
+        previous = self._tracking.repo_synchronizers
+        self._tracking = _Tracking(repo_synchronizers, mappings)
+        kept = [
+            url
+            for url, synchronizer in repo_synchronizers.items()
+            if previous.get(url) is synchronizer
+        ]
+        logger.info(
+            f"Reloaded the configuration: {len(repo_synchronizers)} tracked repositories ({len(kept)} unchanged), {len(mappings)} mappings"
+        )
+
+    def _operations_by_destination(
+        self, push_event: Push, tracking: _Tracking
+    ) -> dict[str, list[SyncOperation]]:
+        operations_by_destination: dict[str, list[SyncOperation]] = {}
+        for mapping in tracking.mappings:
             if matches := mapping.match(push_event):
                 for match in matches:
                     operations_by_destination.setdefault(
                         match.destination_url, []
                     ).append(match.operation)
+        return operations_by_destination
+
+    def _event_lane(self, event: Event) -> Lane:
+        tracking = self._tracking
+        if event.repo_url not in tracking.repo_synchronizers or not isinstance(
+            event, Push
+        ):
+            return Lane()
+        priorities = []
+        destinations = set()
+        for mapping in tracking.mappings:
+            if matches := mapping.match(event):
+                priorities.append(mapping.priority)
+                destinations.update(match.destination_url for match in matches)
+        return Lane(max(priorities, default=0), frozenset(destinations))
+
+    def _prepare_event(self, event: Event) -> Callable[[], None]:
+        """Prepare the handling of `event`, and return a function completing it.
+
+        This runs while the previous event is being handled (see the worker lookahead).
+        For pushes, the sync operations are resolved, and the source commits are
+        prefetched into the clones, which doesn't interfere with running syncs.
+        """
+        tracking = self._tracking
+        synchronizer = tracking.repo_synchronizers.get(event.repo_url)
+        if not synchronizer or not isinstance(event, Push):
+            return partial(self._handle_event, event, tracking=tracking)
+
+        operations_by_destination = self._operations_by_destination(event, tracking)
+        for destination, operations in operations_by_destination.items():
+            try:
+                synchronizer.prefetch_source_commits(
+                    destination, [operation.source_commit for operation in operations]
+                )
+            except Exception:
+                # The sync will fetch the missing commits itself.
+                logger.error(
+                    f"Failed to prefetch source commits for {destination}",
+                    exc_info=True,
+                )
+        return partial(self._handle_event, event, operations_by_destination, tracking)
+
+    def _handle_push_event(
+        self,
+        push_event: Push,
+        tracking: _Tracking,
+        operations_by_destination: dict[str, list[SyncOperation]] | None = None,
+    ) -> None:
+        logger.debug(f"Handling event {push_event}")
+        synchronizer = tracking.repo_synchronizers[push_event.repo_url]
+        if operations_by_destination is None:
+            operations_by_destination = self._operations_by_destination(
+                push_event, tracking
+            )
 
         if not operations_by_destination:
             logger.warning(f"No operation for event {push_event}")
             return
 
+        # Only sync the destinations which didn't complete on a previous delivery.
+        if synced := self._synced_destinations(push_event) & set(
+            operations_by_destination
+        ):
+            logger.info(
+                f"Already synced {push_event} to {sorted(synced)}, skipping them"
+            )
+            metrics.incr("checkpoints.skipped", len(synced))
+            operations_by_destination = {
+                destination: operations
+                for destination, operations in operations_by_destination.items()
+                if destination not in synced
+            }
+            if not operations_by_destination:
+                return
+
+        # Destinations using different clones (see clone shards) are synced
+        # concurrently, while those sharing a clone are synced in order.
+        destinations_by_clone: dict[Path, list[str]] = {}
+        for destination in operations_by_destination:
+            destinations_by_clone.setdefault(
+                synchronizer.clone_directory_for(destination), []
+            ).append(destination)
+
+        if len(destinations_by_clone) == 1:
+            self._sync_destinations(push_event, synchronizer, operations_by_destination)
+        else:
+            with ThreadPoolExecutor(
+                max_workers=len(destinations_by_clone), thread_name_prefix="sync"
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        self._sync_destinations,
+                        push_event,
+                        synchronizer,
+                        {
+                            destination: operations_by_destination[destination]
+                            for destination in destinations
+                        },
+                    )
+                    for destinations in destinations_by_clone.values()
+                ]
+            for future in futures:
+                if exc := future.exception():
+                    raise exc
+        self._forget_checkpoints(push_event)
+        logger.info(f"Successfully handled event {push_event}")
+
+    def _sync_destinations(
+        self,
+        push_event: Push,
+        synchronizer: RepoSynchronizer,
+        operations_by_destination: dict[str, list[SyncOperation]],
+    ) -> None:
+        """Sync to each destination in order, stopping at the first failure."""
         for destination, operations in operations_by_destination.items():
             try:
-                synchronizer.sync(destination, operations, push_event.user)
+                hg_shas = synchronizer.sync(destination, operations, push_event.user)
             except Exception as exc:
                 sentry_sdk.capture_exception(exc)
                 error_data = json.dumps(
@@ -82,14 +381,66 @@ class Application:
                     exc_info=True,
                 )
                 raise exc
-        logger.info(f"Successfully handled event {push_event}")
+            self._checkpoint(push_event, destination, hg_shas)
+
+    def _synced_destinations(self, push_event: Push) -> set[str]:
+        if self._ledger:
+            return self._ledger.synced_destinations(
+                push_event.repo_url, push_event.push_id
+            )
+        with self._checkpoints_lock:
+            return set(
+                self._checkpoints.get((push_event.repo_url, push_event.push_id), ())
+            )
 
-    def _handle_event(self, event: Event) -> None:
-        if event.repo_url not in self._repo_synchronizers:
+    def _forget_checkpoints(self, event: Event) -> None:
+        """Forget the synced destinations of `event`, whose message won't come back."""
+        if isinstance(event, Push):
+            with self._checkpoints_lock:
+                self._checkpoints.pop((event.repo_url, event.push_id), None)
+
+    def _checkpoint(
+        self, push_event: Push, destination: str, hg_shas: dict[str, str]
+    ) -> None:
+        """Remember that `destination` is synced, so it's skipped if the push is retried."""
+        status.record_success(destination)
+        if self._ledger:
+            self._ledger.record(
+                push_event.repo_url, push_event.push_id, destination, hg_shas
+            )
+            return
+        with self._checkpoints_lock:
+            self._checkpoints.setdefault(
+                (push_event.repo_url, push_event.push_id), set()
+            ).add(destination)
+
+    def _handle_event(
+        self,
+        event: Event,
+        operations_by_destination: dict[str, list[SyncOperation]] | None = None,
+        tracking: _Tracking | None = None,
+    ) -> None:
+        # Prepared events keep using the configuration they were prepared with.
+        tracking = tracking or self._tracking
+        if event.repo_url not in tracking.repo_synchronizers:
             logger.warning(f"Ignoring event for untracked repository: {event.repo_url}")
             return
-        match event:
-            case Push():
-                self._handle_push_event(event)
-            case _:
-                raise NotImplementedError()
+        if self._leases and not self._leases.acquire(event.repo_url):
+            metrics.incr("leases.unavailable")
+            if self._skip_without_lease:
+                logger.info(f"Skipping event for repository leased elsewhere: {event}")
+                return
+            logger.info(f"Requeueing event for repository leased elsewhere: {event}")
+            self._stop_without_leases()
+            raise LeaseUnavailableError(event.repo_url)
+        status.start_message(str(event))
+        succeeded = False
+        try:
+            match event:
+                case Push():
+                    self._handle_push_event(event, tracking, operations_by_destination)
+                case _:
+                    raise NotImplementedError()
+            succeeded = True
+        finally:
+            status.finish_message(succeeded)
@@ -5,19 +5,17 @@ import os
 import signal
 import sys
 from pathlib import Path
-from typing import Any
+from typing import TYPE_CHECKING, Any
 
-import sentry_sdk
-from devtools import pprint
-from kombu.simple import SimpleQueue
 from mozlog import commandline
-from pydantic import ValidationError
 
-from git_hg_sync.__main__ import get_connection
-from git_hg_sync.application import Application
-from git_hg_sync.config import Config, PulseConfig
-from git_hg_sync.pulse_worker import PulseWorker
-from git_hg_sync.repo_synchronizer import RepoSynchronizer
+# Commands import what they need when they run, so the CLI starts quickly.
+if TYPE_CHECKING:
+    from kombu import Message
+    from kombu.simple import SimpleQueue
+
+    from git_hg_sync.config import Config, PulseConfig
+    from git_hg_sync.ledger import Ledger
 
 
 def get_parser() -> argparse.ArgumentParser:
@@ -35,16 +33,44 @@ def get_parser() -> argparse.ArgumentParser:
     return parser
 
 
-def add_repository_argument(parser: argparse.ArgumentParser) -> None:
+# Configuration sections needed to find the queues of the supervised workers.
+SHARD_CONFIG_SECTIONS = [
+    "pulse",
+    "supervisor",
+    "tracked_repositories",
+    "branch_mappings",
+    "tag_mappings",
+]
+
+
+def add_shard_argument(parser: argparse.ArgumentParser) -> None:
     parser.add_argument(
-        "-r",
-        "--repository-url",
+        "-s",
+        "--shard",
         type=str,
-        required=True,
-        help="URL of the repository to process",
+        help="Use the queue of the worker of this shard, with `git-hg-sync "
+        "--supervise`, rather than the main queue",
     )
 
 
+def shard_pulse_config(
+    config: "Config", logger: commandline.StructuredLogger, args: argparse.Namespace
+) -> "PulseConfig":
+    """Return the Pulse configuration of the worker of `--shard`, or the main one."""
+    if not args.shard:
+        return config.pulse
+
+    from git_hg_sync.supervisor import shard_configs
+
+    configs = shard_configs(config)
+    if args.shard not in configs:
+        logger.error(
+            f"Unknown shard {args.shard}, expected one of: {', '.join(configs)}"
+        )
+        sys.exit(1)
+    return configs[args.shard].pulse
+
+
 ###
 # config
 ###
@@ -54,15 +80,17 @@ def set_subparser_config(subparsers: Any) -> None:
     subparser = subparsers.add_parser(
         "config", help="Show the contents of the configuration"
     )
-    subparser.set_defaults(func=config)
+    subparser.set_defaults(func=config, config_sections=None)
 
 
 def config(
-    config: Config,
+    config: "Config",
     logger: commandline.StructuredLogger,
     args: argparse.Namespace,  # noqa: ARG001
 ) -> None:
     """Output the currently selected configuration, with environment-overrides."""
+    from devtools import pprint
+
     logger.info("Dumping config ...")
     pprint(config)
 
@@ -76,86 +104,121 @@ def set_subparser_dequeue(
     subparsers: Any,
 ) -> None:
     subparser = subparsers.add_parser(
-        "dequeue", help="Remove a message from the Pulse queue"
+        "dequeue",
+        help="Remove the push messages matching a filter from the Pulse queue",
+    )
+    subparser.add_argument(
+        "-r",
+        "--repository-url",
+        type=str,
+        help="Only remove pushes to this repository",
     )
-    add_repository_argument(subparser)
     subparser.add_argument(
         "-p",
         "--push-id",
         type=int,
-        required=True,
         help="ID of the Push to delete",
     )
-    subparser.set_defaults(func=dequeue)
+    subparser.add_argument(
+        "--min-push-id",
+        type=int,
+        help="Only remove pushes with this ID or a greater one",
+    )
+    subparser.add_argument(
+        "--max-push-id",
+        type=int,
+        help="Only remove pushes with this ID or a lower one",
+    )
+    subparser.add_argument(
+        "-u",
+        "--user",
+        type=str,
+        help="Only remove pushes by this user",
+    )
+    subparser.add_argument(
+        "-b",
+        "--branch",
+        type=str,
+        help="Only remove pushes updating this branch",
+    )
+    subparser.add_argument(
+        "--max-messages",
+        type=int,
+        help="Maximum number of messages to scan, which are held until the end of "
+        "the scan (default: 10000)",
+    )
+    subparser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="Only list the matching messages",
+    )
+    add_shard_argument(subparser)
+    subparser.set_defaults(func=dequeue, config_sections=SHARD_CONFIG_SECTIONS)
 
 
 def dequeue(
-    config: Config, logger: commandline.StructuredLogger, args: argparse.Namespace
+    config: "Config", logger: commandline.StructuredLogger, args: argparse.Namespace
 ) -> None:
-    """Remove a message matching the parameters from the Pulse queue."""
-    queue = _queue(config.pulse)
+    """Remove the messages matching the parameters from the Pulse queue.
+
+    The queue is scanned in one pass, and the other messages are put back in their
+    original order.
+    """
+    import sentry_sdk
+
+    from git_hg_sync.queue_scan import DEFAULT_MAX_MESSAGES, PushFilter, scan_queue
+
+    push_filter = PushFilter(
+        repo_url=args.repository_url,
+        min_push_id=args.push_id if args.push_id is not None else args.min_push_id,
+        max_push_id=args.push_id if args.push_id is not None else args.max_push_id,
+        user=args.user,
+        branch=args.branch,
+    )
+    if not push_filter:
+        logger.error("At least one filter is required, to not remove all the messages")
+        sys.exit(1)
+
+    pulse_config = shard_pulse_config(config, logger, args)
+    queue = _queue(pulse_config)
 
     logger.info(
-        f"Removing push message {args.push_id} for repository {args.repository_url} ..."
+        f"Removing push messages matching {push_filter} from {pulse_config.queue} ..."
     )
     try:
-        count = _remove_push_message(queue, logger, args.repository_url, args.push_id)
+        scanned = scan_queue(
+            queue,
+            lambda event: push_filter.matches(event) and not args.dry_run,
+            max_messages=args.max_messages or DEFAULT_MAX_MESSAGES,
+        )
     except Exception as exc:  # noqa: BLE001
         sentry_sdk.capture_exception(exc)
-        logger.error(f"Error removing message from queue: {exc.__class__}, {exc}")
+        logger.error(f"Error removing messages from queue: {exc.__class__}, {exc}")
         sys.exit(1)
-    else:
-        logger.info(f"Removed {count} message for {args.repository_url}")
     finally:
         queue.close()
 
+    matching = [
+        scanned_message
+        for scanned_message in scanned
+        if push_filter.matches(scanned_message.event)
+    ]
+    for scanned_message in matching:
+        print(f"{scanned_message.message.payload}")
+    action = "Found" if args.dry_run else "Removed"
+    logger.info(f"{action} {len(matching)} of {len(scanned)} messages")
+
+
+def _queue(pulse_config: "PulseConfig") -> "SimpleQueue":
+    from git_hg_sync.queues import get_connection
 
-def _queue(pulse_config: PulseConfig) -> SimpleQueue:
     connection = get_connection(pulse_config)
     return connection.SimpleQueue(
         pulse_config.queue,
     )
 
 
-def _remove_push_message(
-    queue: SimpleQueue,
-    logger: commandline.StructuredLogger,
-    repository_url: str,
-    push_id: int,
-) -> int:
-    # Receive a message
-    message = queue.get(block=True, timeout=5)
-    if not message:
-        logger.info("No message received")
-        return 0
-
-    body = message.payload
-    payload = body.get("payload")
-    if not payload:
-        logger.warning(f"No payload in {message}, requeueing")
-        message.requeue()
-        return 0
-
-    try:
-        push = PulseWorker.parse_entity(payload)
-    except:
-        logger.warning(f"Cannot parse message {message}, requeueing")
-        message.requeue()
-        raise
-
-    if push.repo_url != repository_url or push.push_id != push_id:
-        logger.warning(f"Message not matching deletion criteria: {message}, requeueing")
-        message.requeue()
-        return 0
-
-    print(f"{message.payload}")
-
-    # Acknowledge the message
-    message.ack()
-
-    return 1
-
-
 ###
 # fetchrepo
 ###
@@ -168,7 +231,20 @@ def set_subparser_fetchrepo(
         "fetchrepo",
         help="Fetch data from the selected source repository and its configured target",
     )
-    add_repository_argument(subparser)
+    repositories = subparser.add_mutually_exclusive_group(required=True)
+    repositories.add_argument(
+        "-r",
+        "--repository-url",
+        type=str,
+        action="append",
+        help="URL of the repository to process (can be repeated)",
+    )
+    repositories.add_argument(
+        "-A",
+        "--all-repositories",
+        action="store_true",
+        help="Process all tracked repositories",
+    )
     subparser.add_argument(
         "-a",
         "--fetch-all",
@@ -178,6 +254,14 @@ def set_subparser_fetchrepo(
         default=False,
         help="Fetch destination remotes in adition to the source url",
     )
+    subparser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        required=False,
+        default=4,
+        help="Maximum number of clones to fetch into concurrently",
+    )
     subparser.add_argument(
         "-v",
         "--verbose",
@@ -187,100 +271,418 @@ def set_subparser_fetchrepo(
         default=False,
         help="Show output from subprocesses",
     )
-    subparser.set_defaults(func=fetchrepo)
+    subparser.set_defaults(func=fetchrepo, config_sections=None)
 
 
 def fetchrepo(
-    config: Config, logger: commandline.StructuredLogger, args: argparse.Namespace
+    config: "Config", logger: commandline.StructuredLogger, args: argparse.Namespace
 ) -> None:
     """Fetch repository data ahead of time."""
-    repo = None
-    for repo in config.tracked_repositories:
-        if repo.url == args.repository_url:
-            break
-    if not repo or repo.url != args.repository_url:
-        logger.error(f"Can't find repo for url {args.repository_url}")
+    from git_hg_sync.prefetch import FetchJob, fetch_remotes
+    from git_hg_sync.repo_synchronizer import RepoSynchronizer
+
+    if args.all_repositories:
+        repos = config.tracked_repositories
+    else:
+        repos_by_url = {repo.url: repo for repo in config.tracked_repositories}
+        repos = []
+        for url in args.repository_url:
+            if url not in repos_by_url:
+                logger.error(f"Can't find repo for url {url}")
+                sys.exit(1)
+            repos.append(repos_by_url[url])
+
+    jobs = []
+    for repo in repos:
+        syncer = RepoSynchronizer(
+            config.clones.directory / repo.name, repo.url, repo.shards
+        )
+        jobs.append(FetchJob(syncer, repo.url))
+
+        if args.fetch_all:
+            remotes = repo.seed_remotes + syncer.resolve_destination_urls(
+                config.branch_mappings + config.tag_mappings
+            )
+            logger.debug(f"Remotes to fetch for {repo.url}: {remotes} ...")
+            jobs.extend(FetchJob(syncer, f"hg::{remote}") for remote in remotes)
+
+    logger.info(
+        f"Fetching {len(jobs)} remotes into {len(repos)} clones with {args.jobs} jobs ..."
+    )
+    results = fetch_remotes(jobs, max_workers=args.jobs, verbose=args.verbose)
+
+    logger.info("Fetch summary:")
+    for result in results:
+        status = "ok" if result.succeeded else f"FAILED ({result.error})"
+        logger.info(
+            f"  {result.duration:8.1f}s  {result.job.clone_directory.name}  {result.job.remote}  {status}"
+        )
+
+    failed = [result for result in results if not result.succeeded]
+    logger.info(f"Fetched data from {len(results) - len(failed)} remotes.")
+    if failed:
+        logger.error(f"Failed to fetch from {len(failed)} remotes.")
         sys.exit(1)
 
-    clone_path = config.clones.directory / repo.name
-    syncer = RepoSynchronizer(clone_path, repo.url)
 
-    logger.info(f"Setting up local clone for {repo.url} in {clone_path} ...")
-    repo_clone = syncer.get_clone_repo()
+###
+# pause/resume
+###
 
-    logger.info(f"Fetching commits from {repo.url} ...")
-    syncer.fetch_all_from_remote(repo_clone, repo.url, args.verbose)
 
-    if args.fetch_all:
-        # We use a set for efficient lookup, but we want to keep the order from the
-        # configuration file.
-        remote_set = set()
-        remotes = []
-        for mapping in config.branch_mappings + config.tag_mappings:
-            if mapping.source_url != repo.url:
-                continue
-            if "\\" in mapping.destination_url:
-                logger.info(
-                    f"Skipping remote {mapping.destination_url} due to dynamic replacements"
-                )
-                continue
-            if mapping.destination_url in remote_set:
-                continue
+def set_subparser_pause_resume(
+    subparsers: Any,
+) -> None:
+    subparser = subparsers.add_parser(
+        "pause",
+        help="Pause the workers",
+    )
+    subparser.set_defaults(func=pause, config_sections=[])
 
-            remote_set.add(mapping.destination_url)
-            remotes.append(mapping.destination_url)
+    subparser = subparsers.add_parser(
+        "resume",
+        help="Resume the paused workers",
+    )
+    subparser.set_defaults(func=resume, config_sections=[])
 
-        logger.debug(f"Remotes to fetch: {remotes} ...")
 
-        for remote in remotes:
-            logger.info(f"Fetching commits from remote {remote} ...")
-            cinnabar_remote = f"hg::{remote}"
-            syncer.fetch_all_from_remote(repo_clone, cinnabar_remote, args.verbose)
+def pause(
+    config: "Config | None",  # noqa: ARG001
+    logger: commandline.StructuredLogger,
+    args: argparse.Namespace,  # noqa: ARG001
+) -> None:
+    """Pause the workers by sending them the TSTP signal."""
+    _signal_workers(logger, signal.SIGTSTP)
 
-        logger.info(f"Fetched data from {len(remote_set) + 1} remotes.")
+
+def resume(
+    config: "Config | None",  # noqa: ARG001
+    logger: commandline.StructuredLogger,
+    args: argparse.Namespace,  # noqa: ARG001
+) -> None:
+    """Pause the paused workers by sending them the CONT signal."""
+    _signal_workers(logger, signal.SIGCONT)
+
+
+def _signal_workers(logger: commandline.StructuredLogger, sig: signal.Signals) -> None:
+    from git_hg_sync.registry import ProcessRegistry
+
+    pids = ProcessRegistry().pids()
+    if not pids:
+        logger.error("No running worker found")
+        sys.exit(1)
+    for name, pid in pids.items():
+        logger.info(f"Sending {sig.name} to {name} ({pid}) ...")
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            logger.warning(f"Process {name} ({pid}) is not running")
 
 
 ###
-# pause/resume
+# ledger
 ###
 
 
-def set_subparser_pause_resume(
+def set_subparser_ledger(
     subparsers: Any,
 ) -> None:
     subparser = subparsers.add_parser(
-        "pause",
-        help="Pause the worker",
+        "ledger",
+        help="List the syncs recorded in the ledger",
+    )
+    subparser.add_argument(
+        "-r",
+        "--repository-url",
+        type=str,
+        required=False,
+        help="Only list the syncs of this repository",
+    )
+    subparser.add_argument(
+        "-p",
+        "--push-id",
+        type=int,
+        required=False,
+        help="Only list the syncs of this Push",
     )
-    subparser.set_defaults(func=pause)
+    subparser.add_argument(
+        "-n",
+        "--limit",
+        type=int,
+        required=False,
+        default=20,
+        help="Maximum number of syncs to list, most recent first",
+    )
+    subparser.add_argument(
+        "--json",
+        action="store_true",
+        help="Output one JSON object per sync",
+    )
+    subparser.set_defaults(func=ledger, config_sections=["ledger"])
 
     subparser = subparsers.add_parser(
-        "resume",
-        help="Resume the paused worker",
+        "compact-ledger",
+        help="Remove the syncs older than the retention period from the ledger",
     )
-    subparser.set_defaults(func=resume)
+    subparser.set_defaults(func=compact_ledger, config_sections=["ledger"])
 
 
-def pause(
-    config: Config,  # noqa: ARG001
+def ledger(
+    config: "Config", logger: commandline.StructuredLogger, args: argparse.Namespace
+) -> None:
+    """Show the recorded syncs, and the hg changesets they produced."""
+    import dataclasses
+    import json
+    from datetime import datetime
+
+    entries = _ledger(config, logger).entries(
+        args.repository_url, args.push_id, args.limit
+    )
+    for entry in entries:
+        if args.json:
+            print(json.dumps(dataclasses.asdict(entry)))
+            continue
+        synced_at = datetime.fromtimestamp(entry.synced_at).isoformat(
+            timespec="seconds"
+        )
+        print(
+            f"{synced_at}  {entry.repo_url}  {entry.push_id}  {entry.destination_url}"
+        )
+        for commit, hg_sha in entry.hg_shas.items():
+            print(f"    {commit} -> {hg_sha}")
+
+
+def compact_ledger(
+    config: "Config",
     logger: commandline.StructuredLogger,
     args: argparse.Namespace,  # noqa: ARG001
 ) -> None:
-    """Pause the worker by sending it the TSTP signal."""
-    pid = Application.get_pid()
-    logger.info(f"Sending SIGTSTP to {pid} ...")
-    os.kill(pid, signal.SIGTSTP)
+    """Forget the syncs older than the configured retention."""
+    ledger = _ledger(config, logger)
+    assert config.ledger
+    ledger.compact(config.ledger.retention_days * 24 * 3600)
 
 
-def resume(
-    config: Config,  # noqa: ARG001
+def _ledger(config: "Config", logger: commandline.StructuredLogger) -> "Ledger":
+    from git_hg_sync.ledger import Ledger
+
+    if not config.ledger:
+        logger.error("No ledger configured")
+        sys.exit(1)
+    return Ledger(config.ledger.path)
+
+
+###
+# parked/reinject-parked
+###
+
+
+def set_subparser_parked(
+    subparsers: Any,
+) -> None:
+    subparser = subparsers.add_parser(
+        "parked",
+        help="List the messages moved to the parking queue after failing repeatedly",
+    )
+    subparser.add_argument(
+        "--json",
+        action="store_true",
+        help="Output the parked messages as JSON, one per line",
+    )
+    add_shard_argument(subparser)
+    subparser.set_defaults(func=parked, config_sections=SHARD_CONFIG_SECTIONS)
+
+    subparser = subparsers.add_parser(
+        "reinject-parked",
+        help="Move the parked messages back to the queues they failed from, in order",
+    )
+    subparser.add_argument(
+        "-n",
+        "--limit",
+        type=int,
+        required=False,
+        help="Only reinject the oldest LIMIT messages",
+    )
+    add_shard_argument(subparser)
+    subparser.set_defaults(func=reinject_parked, config_sections=SHARD_CONFIG_SECTIONS)
+
+
+def parked(
+    config: "Config", logger: commandline.StructuredLogger, args: argparse.Namespace
+) -> None:
+    """Show the parked messages, and why they failed, leaving them in the queue."""
+    import json
+    from datetime import datetime
+
+    from git_hg_sync.queues import get_connection, get_parking_queue
+
+    pulse_config = shard_pulse_config(config, logger, args)
+    connection = get_connection(pulse_config)
+    queue = connection.SimpleQueue(get_parking_queue(pulse_config))
+    messages = []
+    try:
+        while message := _get_message(queue):
+            messages.append(message)
+    finally:
+        # Put them back in the same order.
+        for message in messages:
+            message.requeue()
+        queue.close()
+
+    for message in messages:
+        if args.json:
+            print(json.dumps(message.payload))
+            continue
+        parked_at = datetime.fromtimestamp(message.payload["parked_at"]).isoformat(
+            timespec="seconds"
+        )
+        error = message.payload["error"].strip().splitlines()[-1]
+        print(
+            f"{parked_at}  {message.payload['queue']}  {message.payload['message'].get('payload')}"
+        )
+        print(f"    {message.payload['attempts']} attempts, {error}")
+    logger.info(f"{len(messages)} parked message(s)")
+
+
+def reinject_parked(
+    config: "Config", logger: commandline.StructuredLogger, args: argparse.Namespace
+) -> None:
+    """Publish the parked messages to their original queues, oldest first."""
+    from git_hg_sync.queues import get_connection, get_parking_queue
+
+    pulse_config = shard_pulse_config(config, logger, args)
+    connection = get_connection(pulse_config)
+    queue = connection.SimpleQueue(get_parking_queue(pulse_config))
+    producer = connection.Producer(serializer="json")
+    count = 0
+    try:
+        while (args.limit is None or count < args.limit) and (
+            message := _get_message(queue)
+        ):
+            producer.publish(
+                message.payload["message"],
+                exchange="",
+                routing_key=message.payload["queue"],
+            )
+            message.ack()
+            count += 1
+    finally:
+        queue.close()
+    logger.info(f"Reinjected {count} parked message(s)")
+
+
+def _get_message(queue: "SimpleQueue") -> "Message | None":
+    try:
+        return queue.get(block=False)
+    except queue.Empty:
+        return None
+
+
+###
+# queue-stats
+###
+
+
+def set_subparser_queue_stats(
+    subparsers: Any,
+) -> None:
+    subparser = subparsers.add_parser(
+        "queue-stats",
+        help="Output the depth and lag of the Pulse queue as JSON, leaving it unchanged",
+    )
+    subparser.add_argument(
+        "--window",
+        type=float,
+        default=3600,
+        help="Period over which the throughput is measured from the ledger, in seconds",
+    )
+    subparser.add_argument(
+        "--max-messages",
+        type=int,
+        help="Maximum number of messages to scan, which are held until the end of "
+        "the scan (default: 10000)",
+    )
+    add_shard_argument(subparser)
+    subparser.set_defaults(
+        func=queue_stats, config_sections=[*SHARD_CONFIG_SECTIONS, "ledger"]
+    )
+
+
+def queue_stats(
+    config: "Config", logger: commandline.StructuredLogger, args: argparse.Namespace
+) -> None:
+    """Report the pending messages per repository and destination, and the lag.
+
+    The drain time is estimated from the pushes synced during the last `--window`
+    seconds, which requires a ledger.
+    """
+    import json
+    import time
+
+    from git_hg_sync.queue_scan import DEFAULT_MAX_MESSAGES, scan_queue
+    from git_hg_sync.queue_scan import queue_stats as get_queue_stats
+
+    max_messages = args.max_messages or DEFAULT_MAX_MESSAGES
+    queue = _queue(shard_pulse_config(config, logger, args))
+    try:
+        scanned = scan_queue(queue, max_messages=max_messages)
+    finally:
+        queue.close()
+
+    throughput = None
+    if config.ledger:
+        from git_hg_sync.ledger import Ledger
+
+        synced = Ledger(config.ledger.path).synced_pushes(time.time() - args.window)
+        throughput = synced / args.window
+    else:
+        logger.warning("No ledger configured, cannot estimate the drain time")
+
+    stats = get_queue_stats(
+        scanned,
+        [*config.branch_mappings, *config.tag_mappings],
+        throughput,
+        truncated=len(scanned) == max_messages,
+    )
+    print(json.dumps(stats))
+
+
+###
+# declare-shard-queues
+###
+
+
+def set_subparser_declare_shard_queues(
+    subparsers: Any,
+) -> None:
+    subparser = subparsers.add_parser(
+        "declare-shard-queues",
+        help="Declare the queues of the supervised workers, so they start receiving "
+        "the messages before the workers run",
+    )
+    subparser.set_defaults(
+        func=declare_shard_queues, config_sections=SHARD_CONFIG_SECTIONS
+    )
+
+
+def declare_shard_queues(
+    config: "Config",
     logger: commandline.StructuredLogger,
     args: argparse.Namespace,  # noqa: ARG001
 ) -> None:
-    """Pause the paused worker by sending it the CONT signal."""
-    pid = Application.get_pid()
-    logger.info(f"Sending SIGCONT to {pid} ...")
-    os.kill(pid, signal.SIGCONT)
+    """Declare and bind the queue of each worker of `git-hg-sync --supervise`.
+
+    This is the first step to switch from a single worker, see the README.
+    """
+    from git_hg_sync.queues import get_connection, get_queue
+    from git_hg_sync.supervisor import shard_configs
+
+    with get_connection(config.pulse) as connection:
+        for name, shard_config in shard_configs(config).items():
+            queue = get_queue(shard_config.pulse)
+            queue(connection).queue_declare()
+            queue(connection).queue_bind()
+            logger.info(f"Declared {queue.name} for shard {name}")
 
 
 def main() -> None:
@@ -292,16 +694,27 @@ def main() -> None:
     set_subparser_dequeue(subparsers)
     set_subparser_fetchrepo(subparsers)
     set_subparser_pause_resume(subparsers)
+    set_subparser_ledger(subparsers)
+    set_subparser_parked(subparsers)
+    set_subparser_queue_stats(subparsers)
+    set_subparser_declare_shard_queues(subparsers)
 
     args = parser.parse_args()
     logger = commandline.setup_logging("service", args)
 
-    logger.info(f"Using configuration file {args.config}")
-    try:
-        config = Config.from_file(args.config)
-    except ValidationError as e:
-        logger.error(f"Invalid configuration: {e}")
-        sys.exit(1)
+    config = None
+    # Commands only load the configuration sections they use, if any.
+    if args.config_sections != []:
+        from pydantic import ValidationError
+
+        from git_hg_sync.config import Config
+
+        logger.info(f"Using configuration file {args.config}")
+        try:
+            config = Config.from_file(args.config, args.config_sections)
+        except ValidationError as e:
+            logger.error(f"Invalid configuration: {e}")
+            sys.exit(1)
 
     args.func(config, logger, args)
 
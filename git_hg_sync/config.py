@@ -1,6 +1,8 @@
 import pathlib
 from collections import Counter
-from typing import Annotated, Self, override
+from collections.abc import Sequence
+from functools import cache
+from typing import Annotated, Literal, Self, override
 
 import tomllib
 from mozlog import get_proxy_logger
@@ -9,6 +11,7 @@ from pydantic import (
     AliasChoices,
     Field,
     ValidationInfo,
+    create_model,
     model_validator,
 )
 from pydantic_settings import (
@@ -17,6 +20,7 @@ from pydantic_settings import (
     SettingsConfigDict,
 )
 
+from git_hg_sync import REGISTRY_DIRECTORY
 from git_hg_sync.mapping import BranchMapping, TagMapping
 
 logger = get_proxy_logger(__name__)
@@ -42,30 +46,194 @@ class PulseConfig(BaseSettings):
     routing_key: Annotated[str, AfterValidator(not_empty)]
     queue: Annotated[str, AfterValidator(not_empty)]
 
+    # Number of messages prepared (e.g. fetching their source commits) while the
+    # current one is being pushed.
+    lookahead: int = 0
+
+    # Failed messages are requeued after `retry_delay` seconds, doubling after each
+    # attempt up to `max_retry_delay`.
+    retry_delay: float = 5
+    max_retry_delay: float = 300
+    # After this many attempts, failed messages are moved to the parking queue
+    # (`<queue>/parked` by default), see `git-hg-cli parked`.
+    max_attempts: int | None = 10
+    parking_queue: str | None = None
+
+
+class CloneShard(BaseSettings):
+    """A group of destinations synced from a dedicated clone.
+
+    The shard clone shares its objects with the primary clone of the tracked
+    repository, but has its own cinnabar metadata, so it can be synced to
+    concurrently with the other shards.
+    """
+
+    name: Annotated[str, AfterValidator(not_empty)]
+    # Regular expression matched against the destination URL.
+    destination_pattern: Annotated[str, AfterValidator(not_empty)]
+
 
 class TrackedRepository(BaseSettings):
     name: str
     url: str
+    shards: list[CloneShard] = []
+    # Mercurial repositories fetched on startup, before any destination, to seed the
+    # cinnabar metadata (e.g. a unified repository, which benefits from bundles).
+    seed_remotes: list[str] = []
+
+    @model_validator(mode="after")
+    def verify_unique_shard_names(self) -> Self:
+        shard_names = Counter(shard.name for shard in self.shards)
+        non_unique = [name for name in shard_names if shard_names[name] > 1]
+        if non_unique:
+            raise ValueError(
+                f"Found non-unique shard names for {self.name}: {', '.join(non_unique)}"
+            )
+        return self
 
 
 class ClonesConfig(BaseSettings):
     directory: pathlib.Path
 
 
+class WarmupConfig(BaseSettings):
+    enabled: bool = True
+    # Maximum number of clones to fetch into concurrently.
+    jobs: int = 4
+
+
+class WorkerShard(BaseSettings):
+    """A group of tracked repositories handled by a dedicated worker process."""
+
+    name: Annotated[str, AfterValidator(not_empty)]
+    # Names of the tracked repositories.
+    tracked_repositories: list[str]
+    # Routing key to bind the queue of the shard with, instead of the Pulse one.
+    routing_key: str = ""
+
+
+class SupervisorConfig(BaseSettings):
+    # If empty, each tracked repository gets its own worker.
+    shards: list[WorkerShard] = []
+    # Delay before restarting a worker that exited, doubled each time it exits
+    # again shortly after, up to max_restart_delay.
+    restart_delay: float = 5
+    max_restart_delay: float = 300
+
+
+class LeasesConfig(BaseSettings):
+    """Leases on tracked repositories, to run several workers on the same queue.
+
+    A worker only handles the messages of a repository while it holds its lease.
+    """
+
+    # Directory shared by all the workers.
+    directory: pathlib.Path
+    # Time after which the lease of a worker which stopped renewing it expires.
+    ttl: float = 60
+    # What to do with messages for repositories leased by another worker:
+    # - requeue: only consume while holding the leases of all the tracked
+    #   repositories, retrying to take them every retry_interval seconds, and
+    #   requeue the messages received when a lease is lost;
+    # - skip: acknowledge them without handling them, when each worker consumes
+    #   from its own queue receiving all messages.
+    on_unavailable: Literal["requeue", "skip"] = "requeue"
+    retry_interval: float = 5
+
+
+class LedgerConfig(BaseSettings):
+    """Record of the completed syncs, to skip redelivered messages."""
+
+    path: pathlib.Path
+    # Entries older than this are removed when compacting the ledger, e.g. on startup.
+    retention_days: float = 30
+
+
+class TimeoutsConfig(BaseSettings):
+    """Maximum durations of the git commands run by the sync stages, in seconds.
+
+    Commands running for longer are killed (SIGTERM, then SIGKILL after kill_grace
+    seconds), and retried. None disables the timeout. The initial fetch of the
+    cinnabar metadata, which can take hours, has no timeout.
+    """
+
+    fetch: float | None = 3600
+    ls_remote: float | None = 300
+    push: float | None = 1800
+    # Adding the mercurial metadata to new commits, and creating tags.
+    cinnabar_tag: float | None = 1800
+    kill_grace: float = 10
+
+
+class ConcurrencyConfig(BaseSettings):
+    """Adaptive limit on the concurrent syncs to each destination host.
+
+    The limit grows by one after a full limit of successful syncs, and is multiplied
+    by backoff when a sync fails or takes longer than latency_threshold seconds.
+    """
+
+    initial_limit: int = 2
+    min_limit: int = 1
+    max_limit: int = 8
+    latency_threshold: float = 300
+    backoff: float = 0.5
+    # Directory of the slot files of each host, shared by the workers of the host.
+    slot_directory: pathlib.Path = REGISTRY_DIRECTORY / "concurrency"
+
+
+class SshMultiplexingConfig(BaseSettings):
+    """Persistent SSH connections to the destination hosts, shared by git commands."""
+
+    # Directory of the control sockets, shared by the workers of the host.
+    control_directory: pathlib.Path = REGISTRY_DIRECTORY / "ssh"
+    # Idle time after which a master connection exits, e.g. once the workers stopped.
+    persist: int = 600
+    connect_timeout: float = 30
+    # Interval between checks of the master connections, restarted if they died.
+    check_interval: float = 60
+
+
 class SentryConfig(BaseSettings):
     sentry_dsn: Annotated[str, Field(alias=AliasChoices("sentry_dsn", "dsn"))] = ""
 
 
-class Config(BaseSettings):
+class _ConfigSettings(BaseSettings):
+    """Settings sources shared by the full configuration and its sections."""
+
     model_config = SettingsConfigDict(
         env_nested_delimiter="_",
         env_nested_max_split=1,
         nested_model_default_partial_update=True,
     )
 
+    @override
+    @classmethod
+    def settings_customise_sources(
+        cls,
+        settings_cls: type[BaseSettings],
+        init_settings: PydanticBaseSettingsSource,
+        env_settings: PydanticBaseSettingsSource,
+        dotenv_settings: PydanticBaseSettingsSource,
+        file_secret_settings: PydanticBaseSettingsSource,
+    ) -> tuple[PydanticBaseSettingsSource, ...]:
+        """Settings sources so the environment takes precedence over init options."""
+        return (
+            env_settings,
+            init_settings,
+        )
+
+
+class Config(_ConfigSettings):
     pulse: PulseConfig
     sentry: SentryConfig | None = None
     clones: ClonesConfig
+    warmup: WarmupConfig = WarmupConfig()
+    supervisor: SupervisorConfig = SupervisorConfig()
+    leases: LeasesConfig | None = None
+    ledger: LedgerConfig | None = None
+    timeouts: TimeoutsConfig = TimeoutsConfig()
+    ssh_multiplexing: SshMultiplexingConfig | None = None
+    concurrency: ConcurrencyConfig | None = None
     tracked_repositories: list[TrackedRepository]
     branch_mappings: list[BranchMapping]
     tag_mappings: list[TagMapping] = []
@@ -94,24 +262,84 @@ class Config(BaseSettings):
             )
         return self
 
-    @override
-    @classmethod
-    def settings_customise_sources(
-        cls,
-        settings_cls: type[BaseSettings],
-        init_settings: PydanticBaseSettingsSource,
-        env_settings: PydanticBaseSettingsSource,
-        dotenv_settings: PydanticBaseSettingsSource,
-        file_secret_settings: PydanticBaseSettingsSource,
-    ) -> tuple[PydanticBaseSettingsSource, ...]:
-        """Settings sources so the environment takes precedence over init options."""
-        return (
-            env_settings,
-            init_settings,
+    @model_validator(mode="after")
+    def verify_priorities_have_lookahead(self) -> Self:
+        # Messages are only reordered among those received in advance, so priorities
+        # would have no effect.
+        if self.pulse.lookahead == 0 and (
+            prioritised := [
+                mapping.destination_url
+                for mapping in [*self.branch_mappings, *self.tag_mappings]
+                if mapping.priority
+            ]
+        ):
+            raise ValueError(
+                f"Found mappings with a priority, which requires a non-zero pulse lookahead: {', '.join(prioritised)}"
+            )
+        return self
+
+    @model_validator(mode="after")
+    def verify_supervisor_shards(self) -> Self:
+        shards = self.supervisor.shards
+        if not shards:
+            return self
+
+        shard_names = Counter(shard.name for shard in shards)
+        non_unique = [name for name in shard_names if shard_names[name] > 1]
+        if non_unique:
+            raise ValueError(
+                f"Found non-unique names in supervisor shards: {', '.join(non_unique)}"
+            )
+
+        tracked_names = [
+            tracked_repo.name for tracked_repo in self.tracked_repositories
+        ]
+        sharded_names = Counter(
+            name for shard in shards for name in shard.tracked_repositories
         )
+        if unknown := [name for name in sharded_names if name not in tracked_names]:
+            raise ValueError(
+                f"Found untracked repositories in supervisor shards: {', '.join(unknown)}"
+            )
+        if duplicated := [name for name in sharded_names if sharded_names[name] > 1]:
+            raise ValueError(
+                f"Found repositories in multiple supervisor shards: {', '.join(duplicated)}"
+            )
+        if missing := [name for name in tracked_names if name not in sharded_names]:
+            raise ValueError(
+                f"Found repositories in no supervisor shard: {', '.join(missing)}"
+            )
+        return self
 
     @staticmethod
-    def from_file(file_path: pathlib.Path) -> "Config":
+    def from_file(
+        file_path: pathlib.Path, sections: Sequence[str] | None = None
+    ) -> "Config":
+        """Load the configuration, or only its `sections` if given.
+
+        When loading sections, the other ones are left unset, and the checks across
+        sections are skipped, so commands only validate what they use.
+        """
         with file_path.open("rb") as config_file:
             config = tomllib.load(config_file)
-        return Config(**config)
+        if sections is None:
+            return Config(**config)
+
+        loaded = _sections_model(tuple(sections))(
+            **{name: config[name] for name in sections if name in config}
+        )
+        return Config.model_construct(
+            **{name: getattr(loaded, name) for name in sections}
+        )
+
+
+@cache
+def _sections_model(sections: tuple[str, ...]) -> type[_ConfigSettings]:
+    return create_model(
+        "ConfigSections",
+        __base__=_ConfigSettings,
+        **{
+            name: (Config.model_fields[name].annotation, Config.model_fields[name])
+            for name in sections
+        },
+    )
@@ -1,3 +1,4 @@
 from pathlib import Path
 
-PID_FILEPATH = Path("/tmp/git-hg-sync.pid")
+# Directory where the running worker processes register their PID and readiness.
+REGISTRY_DIRECTORY = Path("/tmp/git-hg-sync")
@@ -0,0 +1,181 @@
+import fcntl
+import json
+import os
+import socket
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from types import TracebackType
+from typing import Self
+from urllib.parse import quote
+
+from mozlog import get_proxy_logger
+
+from git_hg_sync.metrics import metrics
+from git_hg_sync.pulse_worker import MessageDeferredError
+
+logger = get_proxy_logger("leases")
+
+
+class LeaseUnavailableError(MessageDeferredError):
+    pass
+
+
+def default_holder(name: str) -> str:
+    """Identify the current process across hosts, e.g. `host:1234:worker`."""
+    return f"{socket.gethostname()}:{os.getpid()}:{name}"
+
+
+class LeaseManager(ABC):
+    """Time-limited leases on named resources, each held by at most one holder.
+
+    Leases expire unless renewed, so the resources of a holder which died can be taken
+    over by another one after `ttl` seconds.
+    """
+
+    def __init__(self, holder: str, ttl: float) -> None:
+        self.holder = holder
+        self.ttl = ttl
+        self._held: set[str] = set()
+        self._lock = threading.Lock()
+
+    def acquire(self, name: str) -> bool:
+        """Acquire the lease on `name`, or renew it if already held.
+
+        Return whether the lease is held by this holder.
+        """
+        acquired = self._acquire(name)
+        with self._lock:
+            if acquired and name not in self._held:
+                logger.info(f"Acquired lease on {name} as {self.holder}")
+                metrics.incr("leases.acquired")
+                self._held.add(name)
+            elif not acquired and name in self._held:
+                logger.error(f"Lost lease on {name}, held by another holder")
+                metrics.incr("leases.lost")
+                self._held.discard(name)
+        return acquired
+
+    def release(self, name: str) -> None:
+        with self._lock:
+            self._held.discard(name)
+        self._release(name)
+        logger.info(f"Released lease on {name}")
+
+    def held(self) -> list[str]:
+        with self._lock:
+            return sorted(self._held)
+
+    def renew_all(self) -> None:
+        for name in self.held():
+            self.acquire(name)
+
+    def release_all(self) -> None:
+        for name in self.held():
+            self.release(name)
+
+    @abstractmethod
+    def _acquire(self, name: str) -> bool:
+        """Take or extend the lease on `name`, unless held by another holder."""
+
+    @abstractmethod
+    def _release(self, name: str) -> None:
+        """Drop the lease on `name`, if held by this holder."""
+
+
+class FileLeaseManager(LeaseManager):
+    """Leases stored as files in a directory shared by all the holders.
+
+    Each lease is a JSON file holding the name of its holder and its expiry time.
+    Updates are serialised with `fcntl.flock`, so this is suitable for holders on a
+    single host, or sharing a filesystem with working locks.
+    """
+
+    def __init__(self, directory: Path, holder: str, ttl: float) -> None:
+        super().__init__(holder, ttl)
+        self._directory = directory
+
+    def _acquire(self, name: str) -> bool:
+        with self._locked(name) as lease_path:
+            lease = self._read(lease_path)
+            if (
+                lease
+                and lease["holder"] != self.holder
+                and lease["expires"] > time.time()
+            ):
+                return False
+            self._write(
+                lease_path, {"holder": self.holder, "expires": time.time() + self.ttl}
+            )
+            return True
+
+    def _release(self, name: str) -> None:
+        with self._locked(name) as lease_path:
+            lease = self._read(lease_path)
+            if lease and lease["holder"] == self.holder:
+                lease_path.unlink()
+
+    @contextmanager
+    def _locked(self, name: str) -> Iterator[Path]:
+        """Lock the lease file of `name` exclusively, and yield its path."""
+        lease_path = self._directory / f"{quote(name, safe='')}.lease"
+        self._directory.mkdir(parents=True, exist_ok=True)
+        with lease_path.with_name(f".{lease_path.name}.lock").open("a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield lease_path
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _read(lease_path: Path) -> dict | None:
+        try:
+            return json.loads(lease_path.read_text())
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logger.warning(f"Ignoring corrupted lease file {lease_path}")
+            return None
+
+    @staticmethod
+    def _write(lease_path: Path, lease: dict) -> None:
+        tmp_path = lease_path.with_name(f"{lease_path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(lease))
+        tmp_path.replace(lease_path)
+
+
+class LeaseRenewer:
+    """Renew the held leases in a background thread, every third of their TTL.
+
+    This keeps the leases while syncs longer than the TTL are running, or while idle.
+    """
+
+    def __init__(self, leases: LeaseManager) -> None:
+        self._leases = leases
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="lease-renewer", daemon=True
+        )
+
+    def __enter__(self) -> Self:
+        self._thread.start()
+        return self
+
+    def __exit__(
+        self,
+        _exc_type: type[BaseException] | None,
+        _exc: BaseException | None,
+        _traceback: TracebackType | None,
+    ) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self._leases.ttl / 3):
+            try:
+                self._leases.renew_all()
+            except Exception:
+                logger.error("Failed to renew leases", exc_info=True)
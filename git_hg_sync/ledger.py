@@ -0,0 +1,130 @@
+import json
+import sqlite3
+import time
+from collections.abc import Iterator
+from contextlib import closing, contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+
+from mozlog import get_proxy_logger
+
+logger = get_proxy_logger("ledger")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS synced (
+    repo_url TEXT NOT NULL,
+    push_id INTEGER NOT NULL,
+    destination_url TEXT NOT NULL,
+    -- JSON object mapping the synced git commits to their hg changesets.
+    hg_shas TEXT NOT NULL,
+    synced_at REAL NOT NULL,
+    PRIMARY KEY (repo_url, push_id, destination_url)
+);
+CREATE INDEX IF NOT EXISTS synced_at ON synced (synced_at);
+"""
+
+
+@dataclass(frozen=True)
+class LedgerEntry:
+    repo_url: str
+    push_id: int
+    destination_url: str
+    hg_shas: dict[str, str]
+    synced_at: float
+
+
+class Ledger:
+    """Persistent record of the destinations each push was synced to.
+
+    This allows acknowledging redelivered messages (e.g. after a crash) without
+    syncing them again. The ledger is a SQLite database, which can be shared by the
+    processes of a host. Each operation uses its own connection, so it can be used from
+    any thread.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(self.path, timeout=30)
+        # The inner context commits on success, or rolls back on error.
+        with closing(connection), connection:
+            yield connection
+
+    def record(
+        self,
+        repo_url: str,
+        push_id: int,
+        destination_url: str,
+        hg_shas: dict[str, str],
+    ) -> None:
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO synced VALUES (?, ?, ?, ?, ?)",
+                (repo_url, push_id, destination_url, json.dumps(hg_shas), time.time()),
+            )
+
+    def synced_destinations(self, repo_url: str, push_id: int) -> set[str]:
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT destination_url FROM synced WHERE repo_url = ? AND push_id = ?",
+                (repo_url, push_id),
+            )
+            return {destination_url for (destination_url,) in rows}
+
+    def synced_pushes(self, since: float) -> int:
+        """Count the pushes synced (to any destination) since the `since` timestamp."""
+        with self._connect() as connection:
+            (count,) = connection.execute(
+                "SELECT COUNT(*) FROM "
+                "(SELECT DISTINCT repo_url, push_id FROM synced WHERE synced_at >= ?)",
+                (since,),
+            ).fetchone()
+            return count
+
+    def entries(
+        self,
+        repo_url: str | None = None,
+        push_id: int | None = None,
+        limit: int | None = None,
+    ) -> list[LedgerEntry]:
+        """List the recorded syncs, most recent first."""
+        query = "SELECT * FROM synced"
+        conditions = []
+        parameters: list[str | int] = []
+        if repo_url is not None:
+            conditions.append("repo_url = ?")
+            parameters.append(repo_url)
+        if push_id is not None:
+            conditions.append("push_id = ?")
+            parameters.append(push_id)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY synced_at DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters.append(limit)
+
+        with self._connect() as connection:
+            rows = connection.execute(query, parameters).fetchall()
+        return [
+            LedgerEntry(row[0], row[1], row[2], json.loads(row[3]), row[4])
+            for row in rows
+        ]
+
+    def compact(self, max_age: float) -> int:
+        """Forget the syncs older than `max_age` seconds, and return how many."""
+        with self._connect() as connection:
+            deleted = connection.execute(
+                "DELETE FROM synced WHERE synced_at < ?", (time.time() - max_age,)
+            ).rowcount
+        with closing(sqlite3.connect(self.path, timeout=30)) as connection:
+            # Give the space back, this can't run in a transaction.
+            connection.execute("VACUUM")
+        logger.info(f"Removed {deleted} entries older than {max_age}s from the ledger")
+        return deleted
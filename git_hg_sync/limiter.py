@@ -0,0 +1,151 @@
+import fcntl
+import re
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any
+from urllib.parse import urlsplit
+
+from mozlog import get_proxy_logger
+
+from git_hg_sync.metrics import metrics
+
+logger = get_proxy_logger("limiter")
+
+
+class AdaptiveLimiter:
+    """Limit on concurrent operations, adapted to how the operations fare (AIMD).
+
+    Each operation completing within `latency_threshold` seconds raises the limit by
+    1/limit, i.e. by one once a full limit of operations succeeded. Failing or slower
+    operations multiply it by `backoff`, once per burst: operations started before
+    the last decrease don't decrease it again.
+
+    The limit only applies to the current process, unless given a `slot_directory`:
+    operations then also hold one of the first `limit` slot files of the limiter
+    there, locked with `fcntl.flock`, so the processes of the host share the slots.
+    Each process adapts its own limit.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        initial_limit: int = 2,
+        min_limit: int = 1,
+        max_limit: int = 8,
+        latency_threshold: float = 300,
+        backoff: float = 0.5,
+        slot_directory: Path | None = None,
+        slot_poll_interval: float = 1,
+    ) -> None:
+        self.name = name
+        self._limit = float(initial_limit)
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._latency_threshold = latency_threshold
+        self._backoff = backoff
+        self._slot_directory = slot_directory
+        self._slot_poll_interval = slot_poll_interval
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+        self._metric_name = re.sub(r"\W+", "_", name)
+        self._report()
+
+    @property
+    def limit(self) -> int:
+        return max(self._min_limit, int(self._limit))
+
+    @contextmanager
+    def acquire(self) -> Iterator[None]:
+        """Wait until below the limit, then count the operation run in the context."""
+        queued = time.monotonic()
+        with self._condition:
+            self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+            self._report()
+
+        started = None
+        failed = True
+        try:
+            with self._slot():
+                started = time.monotonic()
+                metrics.timing(
+                    f"concurrency.queue_delay.{self._metric_name}", started - queued
+                )
+                yield
+                failed = False
+        finally:
+            self._release(started, failed)
+
+    @contextmanager
+    def _slot(self) -> Iterator[None]:
+        """Hold a free slot file among the first `limit`, polling until there is one."""
+        if not self._slot_directory:
+            yield
+            return
+        self._slot_directory.mkdir(parents=True, exist_ok=True)
+        while True:
+            for index in range(self.limit):
+                path = self._slot_directory / f"{self._metric_name}.{index}"
+                slot_file = path.open("a")
+                try:
+                    fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    slot_file.close()
+                    continue
+                # Closing the file releases the lock.
+                with slot_file:
+                    yield
+                return
+            time.sleep(self._slot_poll_interval)
+
+    def _release(self, started: float | None, failed: bool) -> None:
+        with self._condition:
+            self._in_flight -= 1
+            # Operations interrupted while waiting for a slot don't adapt the limit.
+            if started is not None:
+                self._adapt(started, failed)
+            self._report()
+            self._condition.notify_all()
+
+    def _adapt(self, started: float, failed: bool) -> None:
+        latency = time.monotonic() - started
+        if failed or latency > self._latency_threshold:
+            if started >= self._last_decrease:
+                self._limit = max(self._min_limit, self._limit * self._backoff)
+                self._last_decrease = time.monotonic()
+                logger.info(
+                    f"Concurrency limit of {self.name} decreased to {self.limit} after {'a failure' if failed else f'{latency:.0f}s'}"
+                )
+        else:
+            self._limit = min(self._max_limit, self._limit + 1 / self._limit)
+
+    def _report(self) -> None:
+        metrics.gauge(f"concurrency.limit.{self._metric_name}", self.limit)
+        metrics.gauge(f"concurrency.in_flight.{self._metric_name}", self._in_flight)
+
+
+class HostLimiters:
+    """Adaptive limiters of the concurrent syncs to each destination host."""
+
+    def __init__(self, **limiter_options: Any) -> None:
+        # Options of each AdaptiveLimiter.
+        self._limiter_options = limiter_options
+        self._limiters: dict[str, AdaptiveLimiter] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def host_of(url: str) -> str:
+        """The host of a destination URL, or the URL itself for local paths."""
+        return urlsplit(url.removeprefix("hg::")).hostname or url
+
+    def for_destination(self, destination_url: str) -> AdaptiveLimiter:
+        host = self.host_of(destination_url)
+        with self._lock:
+            if host not in self._limiters:
+                self._limiters[host] = AdaptiveLimiter(host, **self._limiter_options)
+            return self._limiters[host]
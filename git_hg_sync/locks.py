@@ -0,0 +1,62 @@
+import fcntl
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+from mozlog import get_proxy_logger
+
+from git_hg_sync.metrics import metrics
+
+logger = get_proxy_logger("locks")
+
+
+class CloneLock:
+    """Read/write lock on a local clone, shared between processes and threads.
+
+    This relies on `fcntl.flock` on a lock file next to the clone. As each acquisition
+    opens its own file description, the lock also excludes other threads of the same
+    process. It is not reentrant: acquiring it again while holding it will block.
+
+    Operations updating the clone (e.g. fetching or pushing with cinnabar) must hold the
+    exclusive lock, while operations only reading it can share the lock.
+    """
+
+    def __init__(self, clone_directory: Path) -> None:
+        self._clone_directory = clone_directory
+        self.path = clone_directory.with_name(f".{clone_directory.name}.lock")
+
+    @contextmanager
+    def shared(self) -> Iterator[None]:
+        with self._locked(fcntl.LOCK_SH, "shared"):
+            yield
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        with self._locked(fcntl.LOCK_EX, "exclusive"):
+            yield
+
+    @contextmanager
+    def _locked(self, operation: int, mode: str) -> Iterator[None]:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open("a") as lock_file:
+            start = time.monotonic()
+            try:
+                fcntl.flock(lock_file, operation | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info(
+                    f"Waiting for {mode} lock on {self._clone_directory} held elsewhere ..."
+                )
+                fcntl.flock(lock_file, operation)
+                logger.info(
+                    f"Acquired {mode} lock on {self._clone_directory} after {time.monotonic() - start:.1f}s"
+                )
+            metrics.timing(
+                f"clone_lock.{mode}.wait.{self._clone_directory.name}",
+                time.monotonic() - start,
+            )
+
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
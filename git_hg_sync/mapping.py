@@ -1,5 +1,5 @@
 import re
-from collections.abc import Sequence
+from collections.abc import Iterable, Sequence
 from dataclasses import dataclass
 from functools import cached_property
 from typing import TypeAlias
@@ -42,23 +42,75 @@ class MappingMatch:
 
 class Mapping(pydantic.BaseModel):
     source_url: str
+    destination_url: str
+    # Messages matching mappings with a higher priority are handled first, within the
+    # lookahead of the worker, which must be non-zero.
+    priority: int = 0
+
+    @property
+    def is_dynamic(self) -> bool:
+        """Whether the destination URL is built from the matched reference name."""
+        return "\\" in self.destination_url
 
     def match(self, event: Push) -> Sequence[MappingMatch]:
         raise NotImplementedError()
 
+    def resolve_destination_urls(
+        self, branches: Iterable[str], tags: Iterable[str]
+    ) -> list[str]:
+        """List the destination URLs this mapping would sync the given references to.
+
+        Static destinations are returned as-is, whether any reference matches or not.
+        """
+        raise NotImplementedError()
+
+
+def resolve_destination_urls(
+    mappings: Iterable[Mapping],
+    source_url: str,
+    branches: Iterable[str],
+    tags: Iterable[str],
+) -> list[str]:
+    """List the concrete destination URLs for the references of a source repository.
+
+    Destinations are unique, and in the order of the mappings.
+    """
+    branches = list(branches)
+    tags = list(tags)
+    destination_urls: dict[str, None] = {}
+    for mapping in mappings:
+        if mapping.source_url != source_url:
+            continue
+        destination_urls.update(
+            dict.fromkeys(mapping.resolve_destination_urls(branches, tags))
+        )
+    return list(destination_urls)
+
 
 # Branch Mapping
 
 
 class BranchMapping(Mapping):
     branch_pattern: str
-    destination_url: str
     destination_branch: str
 
     @cached_property
     def _branch_pattern(self) -> re.Pattern:
         return re.compile(self.branch_pattern)
 
+    def resolve_destination_urls(
+        self,
+        branches: Iterable[str],
+        tags: Iterable[str],  # noqa: ARG002
+    ) -> list[str]:
+        if not self.is_dynamic:
+            return [self.destination_url]
+        return [
+            re.sub(self._branch_pattern, self.destination_url, branch_name)
+            for branch_name in branches
+            if self._branch_pattern.match(branch_name)
+        ]
+
     def match(self, event: Push) -> Sequence[MappingMatch]:
         if event.repo_url != self.source_url:
             return []
@@ -89,7 +141,6 @@ class BranchMapping(Mapping):
 
 class TagMapping(Mapping):
     tag_pattern: str
-    destination_url: str
     tags_destination_branch: str
     tag_message_suffix: str = DEFAULT_TAG_MESSAGE_SUFFIX
 
@@ -97,6 +148,19 @@ class TagMapping(Mapping):
     def _tag_pattern(self) -> re.Pattern:
         return re.compile(self.tag_pattern)
 
+    def resolve_destination_urls(
+        self,
+        branches: Iterable[str],  # noqa: ARG002
+        tags: Iterable[str],
+    ) -> list[str]:
+        if not self.is_dynamic:
+            return [self.destination_url]
+        return [
+            re.sub(self._tag_pattern, self.destination_url, tag_name)
+            for tag_name in tags
+            if self._tag_pattern.match(tag_name)
+        ]
+
     def match(self, event: Push) -> Sequence[MappingMatch]:
         if event.repo_url != self.source_url:
             return []
@@ -0,0 +1,209 @@
+import os
+import re
+import selectors
+import subprocess
+import time
+from dataclasses import dataclass
+from typing import IO
+
+from mozlog import get_proxy_logger
+
+from git_hg_sync.metrics import metrics
+from git_hg_sync.status import status
+
+logger = get_proxy_logger("output")
+
+# Progress lines are rewritten in place with carriage returns.
+LINE_END = re.compile(rb"\r\n|\r|\n")
+
+# e.g. `Receiving objects:  45% (4500/10000), 1.20 MiB | 2.40 MiB/s`, or
+# `remote: Counting objects: 1234, done.`
+GIT_PROGRESS = re.compile(
+    r"^(?:remote: )?(?P<phase>[A-Z][a-z]+(?: [a-z]+)*):\s+"
+    r"(?:(?P<percent>\d+)% \((?P<done>\d+)/(?P<total>\d+)\)|(?P<count>\d+))"
+    r"(?:, (?P<size>[\d.]+) (?P<size_unit>bytes|[KMGT]iB))?"
+    r"(?: \| (?P<rate>[\d.]+) (?P<rate_unit>bytes|[KMGT]iB)/s)?"
+)
+# e.g. `Reading 1234 changesets`, or `Reading and importing 42 manifests`.
+CINNABAR_PROGRESS = re.compile(
+    r"^(?P<phase>Reading|Importing|Reading and importing|Bundling|Pushing) "
+    r"(?P<done>\d+) (?P<unit>changesets|manifests|revisions|files)"
+)
+UNITS = {"bytes": 1, "KiB": 1 << 10, "MiB": 1 << 20, "GiB": 1 << 30, "TiB": 1 << 40}
+
+
+@dataclass(frozen=True)
+class Progress:
+    phase: str
+    done: int
+    total: int | None = None
+    # Amount of data transferred, and transfer rate per second, in bytes.
+    size: float | None = None
+    rate: float | None = None
+
+    def metric_name(self, label: str) -> str:
+        """Name of the progress metrics of this phase, for the command of `label`."""
+        return f"git.progress.{_metric_key(label)}.{_metric_key(self.phase.lower())}"
+
+    @property
+    def finished(self) -> bool:
+        return self.total is not None and self.done >= self.total
+
+
+def _metric_key(name: str) -> str:
+    return re.sub(r"\W+", "_", name).strip("_")
+
+
+def parse_progress(line: str) -> Progress | None:
+    """Parse a progress line of git or cinnabar, or return None for other lines."""
+    if match := GIT_PROGRESS.match(line):
+        size = rate = None
+        if match["size"]:
+            size = float(match["size"]) * UNITS[match["size_unit"]]
+        if match["rate"]:
+            rate = float(match["rate"]) * UNITS[match["rate_unit"]]
+        if match["count"] is not None:
+            return Progress(match["phase"], int(match["count"]), size=size, rate=rate)
+        return Progress(
+            match["phase"], int(match["done"]), int(match["total"]), size, rate
+        )
+    if match := CINNABAR_PROGRESS.match(line):
+        return Progress(f"{match['phase']} {match['unit']}", int(match["done"]))
+    return None
+
+
+class _LogLimiter:
+    """Log at most `max_lines` per `interval` seconds, and one update per progress phase.
+
+    The last update of each phase is logged when it finishes, or at the end, so the
+    final state is always reported. Nothing is logged if `max_lines` is 0.
+    """
+
+    def __init__(self, label: str, interval: float, max_lines: int) -> None:
+        self._label = label
+        self._interval = interval
+        self._max_lines = max_lines
+        self._window_start = time.monotonic()
+        self._lines = 0
+        self._suppressed = 0
+        self._progress_logged: dict[str, float] = {}
+        self._progress_pending: dict[str, str] = {}
+
+    def log(self, line: str) -> None:
+        if not self._max_lines:
+            return
+        now = time.monotonic()
+        if now - self._window_start >= self._interval:
+            self._report_suppressed()
+            self._window_start = now
+            self._lines = 0
+        if self._lines < self._max_lines:
+            self._lines += 1
+            logger.info(line)
+        else:
+            self._suppressed += 1
+
+    def log_progress(self, progress: Progress, line: str) -> None:
+        now = time.monotonic()
+        last_logged = self._progress_logged.get(progress.phase)
+        if (
+            progress.finished
+            or last_logged is None
+            or now - last_logged >= self._interval
+        ):
+            self._progress_logged[progress.phase] = now
+            self._progress_pending.pop(progress.phase, None)
+            self.log(line)
+        else:
+            self._progress_pending[progress.phase] = line
+
+    def flush(self) -> None:
+        if not self._max_lines:
+            return
+        for line in self._progress_pending.values():
+            logger.info(line)
+        self._progress_pending.clear()
+        self._report_suppressed()
+
+    def _report_suppressed(self) -> None:
+        if self._suppressed:
+            logger.info(f"{self._label}: {self._suppressed} output lines not logged")
+            self._suppressed = 0
+
+
+def stream_output(
+    proc: subprocess.Popen,
+    label: str,
+    *,
+    log_interval: float = 5,
+    max_lines: int = 50,
+    timeout: float | None = None,
+) -> tuple[bytes, bytes]:
+    """Read the stdout and stderr of `proc` from the current thread, until both close.
+
+    Git and cinnabar progress updates are reported in the `git.progress.<label>.<phase>`
+    gauges, published with the worker status, and as the progress line of `label` in
+    the status. They are logged at most once per `log_interval` seconds for each phase.
+    Other lines are logged up to `max_lines` per `log_interval`, and returned like
+    `Popen.communicate`. With `max_lines` 0, nothing is logged. If the streams are
+    still open after `timeout` seconds, `subprocess.TimeoutExpired` is raised.
+    """
+    limiter = _LogLimiter(label, log_interval, max_lines)
+    streams: dict[str, IO[bytes] | None] = {
+        "STDOUT": proc.stdout,
+        "STDERR": proc.stderr,
+    }
+    buffers: dict[str, bytes] = {}
+    output: dict[str, list[bytes]] = {name: [] for name in streams}
+    deadline = None if timeout is None else time.monotonic() + timeout
+    try:
+        with selectors.DefaultSelector() as selector:
+            for name, stream in streams.items():
+                if stream is not None:
+                    selector.register(stream, selectors.EVENT_READ, name)
+                    buffers[name] = b""
+            while selector.get_map():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise subprocess.TimeoutExpired(proc.args, timeout)
+                for key, _events in selector.select(remaining):
+                    name = key.data
+                    chunk = os.read(key.fd, 65536)
+                    if chunk:
+                        *lines, buffers[name] = LINE_END.split(buffers[name] + chunk)
+                    else:
+                        selector.unregister(key.fileobj)
+                        lines = [buffers.pop(name)]
+                    for line in lines:
+                        if _handle_line(limiter, label, name, line):
+                            output[name].append(line)
+    finally:
+        limiter.flush()
+        status.clear_progress(label)
+    return b"\n".join(output["STDOUT"]), b"\n".join(output["STDERR"])
+
+
+def _handle_line(
+    limiter: _LogLimiter, label: str, stream_name: str, raw_line: bytes
+) -> bool:
+    """Report or log a line of output, and return whether it is neither blank nor a
+    progress update, so it's kept.
+    """
+    line = raw_line.decode(errors="replace").strip()
+    if not line:
+        return False
+    progress = parse_progress(line)
+    if not progress:
+        limiter.log(f"{label}/{stream_name}: {line}")
+        return True
+    metric_name = progress.metric_name(label)
+    metrics.gauge(f"{metric_name}.done", progress.done)
+    if progress.total is not None:
+        metrics.gauge(f"{metric_name}.total", progress.total)
+    if progress.size is not None:
+        metrics.gauge(f"{metric_name}.bytes", progress.size)
+    if progress.rate is not None:
+        metrics.gauge(f"{metric_name}.rate", progress.rate)
+    status.set_progress(label, line)
+    limiter.log_progress(progress, f"{label}/{stream_name}: {line}")
+    return False
@@ -0,0 +1,117 @@
+import threading
+import time
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+from mozlog import get_proxy_logger
+
+from git_hg_sync.repo_synchronizer import RepoSynchronizer
+
+logger = get_proxy_logger("prefetch")
+
+
+@dataclass
+class FetchJob:
+    synchronizer: RepoSynchronizer
+    remote: str
+    # Only fetch from the remote if the clone has no cinnabar metadata yet.
+    metadata_only: bool = False
+
+    @property
+    def destination_url(self) -> str | None:
+        if self.remote.startswith("hg::"):
+            return self.remote.removeprefix("hg::")
+        return None
+
+    @property
+    def clone_directory(self) -> Path:
+        return self.synchronizer.clone_directory_for(self.destination_url)
+
+
+@dataclass
+class FetchResult:
+    job: FetchJob
+    duration: float
+    error: Exception | None = None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
+
+
+class _Progress:
+    """Thread-safe counter used to report progress across concurrent fetches."""
+
+    def __init__(self, total: int) -> None:
+        self._total = total
+        self._done = 0
+        self._lock = threading.Lock()
+
+    def step(self) -> str:
+        with self._lock:
+            self._done += 1
+            return f"[{self._done}/{self._total}]"
+
+
+def fetch_remotes(
+    jobs: Sequence[FetchJob], *, max_workers: int = 4, verbose: bool = False
+) -> list[FetchResult]:
+    """Run the fetch `jobs` concurrently, using at most `max_workers` threads.
+
+    Fetching from an hg:: remote updates the cinnabar metadata of the clone, which
+    doesn't support concurrent writers. Jobs are therefore staged per clone: the
+    remotes of a given clone are fetched one after the other, in the order they were
+    given, while separate clones are fetched in parallel. Each fetch also holds the
+    exclusive lock of its clone, to exclude other processes.
+
+    Failures are reported in the returned results, in the same order as `jobs`,
+    rather than raised.
+    """
+    jobs_by_clone: dict[Path, list[FetchJob]] = {}
+    for job in jobs:
+        jobs_by_clone.setdefault(job.clone_directory, []).append(job)
+
+    progress = _Progress(len(jobs))
+    with ThreadPoolExecutor(
+        max_workers=max(1, max_workers), thread_name_prefix="fetch"
+    ) as executor:
+        futures = [
+            executor.submit(_fetch_clone, clone_jobs, progress, verbose)
+            for clone_jobs in jobs_by_clone.values()
+        ]
+        results = {
+            id(result.job): result for future in futures for result in future.result()
+        }
+
+    return [results[id(job)] for job in jobs]
+
+
+def _fetch_clone(
+    jobs: list[FetchJob], progress: _Progress, verbose: bool
+) -> list[FetchResult]:
+    results: list[FetchResult] = []
+    for job in jobs:
+        action = "Ensuring metadata" if job.metadata_only else "Fetching commits"
+        logger.info(f"{action} from {job.remote} ...")
+        start = time.monotonic()
+        error = None
+        # Only hold the lock of the clone for one remote at a time, so a running worker
+        # can interleave its syncs.
+        try:
+            with job.synchronizer.lock_clone(job.destination_url):
+                repo = job.synchronizer.get_clone_repo(job.destination_url)
+                if job.metadata_only:
+                    job.synchronizer.ensure_cinnabar_metadata(repo, job.remote)
+                else:
+                    job.synchronizer.fetch_all_from_remote(repo, job.remote, verbose)
+        except Exception as exc:  # noqa: BLE001
+            error = exc
+        duration = time.monotonic() - start
+
+        status = f"failed: {error}" if error else "done"
+        logger.info(f"{progress.step()} {job.remote} {status} in {duration:.1f}s")
+        results.append(FetchResult(job, duration, error))
+
+    return results
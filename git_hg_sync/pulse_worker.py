@@ -1,29 +1,144 @@
-import json
+import reprlib
+import threading
+import time
+import traceback
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import Future
+from dataclasses import dataclass
+from functools import partial
+from queue import SimpleQueue
 from typing import Any, Protocol
 
 import kombu
 from kombu.mixins import ConsumerMixin
 from mozlog import get_proxy_logger
-from pydantic import ValidationError
+from pydantic import TypeAdapter, ValidationError
 
 from git_hg_sync.events import Event, Push
+from git_hg_sync.metrics import metrics
+
+try:
+    # Optional faster JSON decoder, see the `fast` extra.
+    from orjson import JSONDecodeError
+    from orjson import loads as json_loads
+except ImportError:
+    from json import JSONDecodeError
+    from json import loads as json_loads
 
 logger = get_proxy_logger("pulse_consumer")
 
+# Validators of the entities of each message type, built once.
+ENTITY_ADAPTERS: dict[str, TypeAdapter] = {"push": TypeAdapter(Push)}
+
+# Messages are logged abbreviated, as formatting those with many tags is costly.
+_message_repr = reprlib.Repr(
+    maxlevel=3, maxdict=10, maxlist=10, maxstring=100, maxother=100
+)
+
 
 class EventHandler(Protocol):
     def __call__(self, event: Event) -> None:
         pass
 
 
+class EventPreparer(Protocol):
+    def __call__(self, event: Event) -> Callable[[], None]:
+        pass
+
+
+@dataclass(frozen=True)
+class Lane:
+    priority: int = 0
+    # Destinations the event will be synced to. Events sharing a destination are
+    # never reordered.
+    destinations: frozenset[str] = frozenset()
+
+
+class EventLaneSelector(Protocol):
+    def __call__(self, event: Event) -> Lane:
+        pass
+
+
 class EntityTypeError(Exception):
     pass
 
 
+class MessageDeferredError(Exception):
+    """Raised by event handlers to requeue a message, without counting an attempt."""
+
+
+@dataclass
+class _PipelineItem:
+    message: kombu.Message
+    body: dict
+    event: Event
+    lane: Lane
+    prepared: Future[Callable[[], None]]
+    handled: Future[None] | None = None
+    # Received on a previous connection, so the broker already requeued it.
+    stale: bool = False
+    # When to requeue the message after handling it failed.
+    retry_at: float | None = None
+
+
+class _SerialExecutor:
+    """Run functions one at a time, in order, in a daemon thread.
+
+    Unlike `ThreadPoolExecutor`, this doesn't hold the process on exit, so the
+    worker can still be killed while a message is being handled.
+    """
+
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._queue: SimpleQueue[tuple[Future, Callable[[], Any]]] = SimpleQueue()
+        self._thread: threading.Thread | None = None
+
+    def submit(self, function: Callable[[], Any]) -> Future:
+        if not self._thread:
+            self._thread = threading.Thread(
+                target=self._run, name=self._name, daemon=True
+            )
+            self._thread.start()
+        future: Future = Future()
+        self._queue.put((future, function))
+        return future
+
+    def _run(self) -> None:
+        while True:
+            future, function = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = function()
+            except BaseException as exc:  # noqa: BLE001
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+
 class PulseWorker(ConsumerMixin):
-    """Function that will be called whenever an event is received"""
+    """Consume events from Pulse, and handle them in the background.
+
+    Events are handled in a separate thread, so the consumer thread keeps servicing the
+    connection (e.g. its heartbeats) during long syncs. Messages are still
+    acknowledged or requeued from the consumer thread, once handled.
+    """
 
-    event_handler: EventHandler | None
+    # Function that will be called whenever an event is received.
+    event_handler: EventHandler | None = None
+    # Split the handling of an event in two stages: the returned function is the
+    # second one. The first stage can run ahead, see `lookahead`.
+    event_preparer: EventPreparer | None = None
+    # Classify events, so those with a higher priority can be handled before the
+    # others received earlier, see `lookahead`.
+    event_lane: EventLaneSelector | None = None
+    # Function called regularly from the consumer thread, e.g. to apply configuration
+    # changes.
+    iteration_callback: Callable[[], None] | None = None
+    # Function called from the consumer thread once the message of an event has been
+    # acknowledged, after handling or parking it, so it won't be received again.
+    event_settled: EventHandler | None = None
 
     def __init__(
         self,
@@ -31,20 +146,49 @@ class PulseWorker(ConsumerMixin):
         queue: kombu.Queue,
         *,
         one_shot: bool = False,
+        lookahead: int = 0,
+        retry_delay: float = 0,
+        max_retry_delay: float = 300,
+        max_attempts: int | None = None,
+        parking_queue: kombu.Queue | None = None,
     ) -> None:
         self.connection = connection
         self.task_queue = queue
         self.one_shot = one_shot
+        # Number of messages to prepare while the current one is being handled, and
+        # among which to pick the one with the highest priority.
+        self.lookahead = lookahead
+        # Failed messages are requeued after a delay, doubling after each attempt.
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        # After this many attempts, failed messages are moved to the parking queue
+        # instead, so they don't block the following ones.
+        self.max_attempts = max_attempts
+        self.parking_queue = parking_queue
+        # Failed attempts of the messages being retried, by message body.
+        self._attempts: dict[Any, int] = {}
+        self._pipeline: deque[_PipelineItem] = deque()
+        self._prepare_executor = _SerialExecutor("prepare")
+        self._handle_executor = _SerialExecutor("handle")
+        self._stopping = False
+
+    @property
+    def should_stop(self) -> bool:
+        # Keep consuming until the messages in the pipeline have been handled, so
+        # they can be acknowledged before the channel is closed.
+        return self._stopping and not self._pipeline
+
+    @should_stop.setter
+    def should_stop(self, value: bool) -> None:
+        self._stopping = value
 
     @staticmethod
     def parse_entity(raw_entity: dict) -> Event:
-        logger.debug(f"parse_entity: {raw_entity}")
-        message_type = raw_entity.pop("type")
-        match message_type:
-            case "push":
-                return Push(**raw_entity)
-            case _:
-                raise EntityTypeError(f"unsupported type {message_type}")
+        message_type = raw_entity["type"]
+        if not (adapter := ENTITY_ADAPTERS.get(message_type)):
+            raise EntityTypeError(f"unsupported type {message_type}")
+        # The `type` key is ignored by the validation.
+        return adapter.validate_python(raw_entity)
 
     def get_consumers(
         self,
@@ -55,10 +199,11 @@ class PulseWorker(ConsumerMixin):
             self.task_queue,
             auto_declare=False,
             callbacks=[self.on_task],
-            # We only fetch one message at a time in case processing it fails.
-            # This allows us to ensure strict ordering, by re-receiving the same message
-            # on the next loop after having requeued it after failure.
-            prefetch_count=1,
+            # We only fetch one message at a time (plus the lookahead) in case
+            # processing it fails. This allows us to ensure strict ordering, by
+            # re-receiving the same message on the next loop after having requeued it
+            # (and the following ones) after failure.
+            prefetch_count=1 + self.lookahead,
         )
         logger.debug(f"Using consumer {consumer=}")
         return [consumer]
@@ -67,29 +212,35 @@ class PulseWorker(ConsumerMixin):
         logger.error(f"Connection error: {exc=}, retrying in {interval}s ...")
 
     def on_task(self, body: Any, message: kombu.Message) -> None:
-        logger.info(f"Received message: {body}")
+        logger.info(f"Received message: {_message_repr.repr(body)}")
 
         if isinstance(body, str):
             logger.debug("Message is a string. Trying to parse as JSON ...")
             try:
-                body = json.loads(body)
-            except json.JSONDecodeError as e:
+                body = json_loads(body)
+            except JSONDecodeError as e:
                 logger.warning(f"Invalid JSON message, rejecting ... `{e}`")
                 message.reject()
                 return
 
         if not isinstance(body, dict):
-            logger.warning(f"Invalid message data, rejecting ... `{body}`")
+            logger.warning(
+                f"Invalid message data, rejecting ... `{_message_repr.repr(body)}`"
+            )
             message.reject()
             return
 
         if not (raw_entity := body.get("payload")):
-            logger.warning(f"Missing or empty payload, rejecting ... `{body}`")
+            logger.warning(
+                f"Missing or empty payload, rejecting ... `{_message_repr.repr(body)}`"
+            )
             message.reject()
             return
 
         if not isinstance(raw_entity, dict):
-            logger.warning(f"Invalid payload, rejecting ... `{raw_entity}`")
+            logger.warning(
+                f"Invalid payload, rejecting ... `{_message_repr.repr(raw_entity)}`"
+            )
             message.reject()
             return
 
@@ -97,22 +248,205 @@ class PulseWorker(ConsumerMixin):
             event = PulseWorker.parse_entity(raw_entity)
         except KeyError as e:
             logger.warning(
-                f"Invalid payload: missing {e}, rejecting ... `{raw_entity}`"
+                f"Invalid payload: missing {e}, rejecting ... `{_message_repr.repr(raw_entity)}`"
             )
             message.reject()
             return
         except (EntityTypeError, TypeError, ValidationError) as e:
-            logger.warning(f"Invalid payload: {e}, rejecting ... `{raw_entity}`")
+            logger.warning(
+                f"Invalid payload: {e}, rejecting ... `{_message_repr.repr(raw_entity)}`"
+            )
             message.reject()
             return
 
-        try:
-            if self.event_handler:
-                self.event_handler(event)
-        except:  # noqa: E722
-            message.requeue()
-        else:
-            message.ack()
-
-        if self.one_shot:
-            self.should_stop = True
+        self._enqueue(event, body, message)
+
+    def on_iteration(self) -> None:
+        if self.iteration_callback:
+            self.iteration_callback()
+        self._advance_pipeline()
+
+    def on_consume_ready(
+        self,
+        _connection: kombu.Connection,
+        _channel: Any,
+        _consumers: list[kombu.Consumer],
+        **_kwargs: Any,
+    ) -> None:
+        # After reconnecting, the messages of the previous connection have been
+        # requeued by the broker, and will be received again. The one being handled
+        # is waited for before handling anything else, to keep the order.
+        handling = []
+        for item in self._pipeline:
+            if item.handled:
+                item.stale = True
+                handling.append(item)
+            else:
+                item.prepared.cancel()
+        self._pipeline = deque(handling)
+
+    def _prepare(self, event: Event) -> Callable[[], None]:
+        if self.event_preparer:
+            return self.event_preparer(event)
+        return partial(self._handle, event)
+
+    def _handle(self, event: Event) -> None:
+        if self.event_handler:
+            self.event_handler(event)
+
+    def _enqueue(self, event: Event, body: dict, message: kombu.Message) -> None:
+        """Start preparing the event in the background, and queue it for handling.
+
+        Events are prepared one at a time, in order, while the oldest queued event is
+        being handled, also in the background. Acknowledgements are done from
+        `on_iteration`, on the thread of the connection.
+        """
+        self._pipeline.append(
+            _PipelineItem(
+                message,
+                body,
+                event,
+                self.event_lane(event) if self.event_lane else Lane(),
+                self._prepare_executor.submit(partial(self._prepare, event)),
+            )
+        )
+        self._advance_pipeline()
+
+    def _advance_pipeline(self) -> None:
+        while (
+            self._pipeline and (handled := self._pipeline[0].handled) and handled.done()
+        ):
+            item = self._pipeline[0]
+            if item.stale:
+                self._pipeline.popleft()
+                logger.warning(
+                    f"Handled {item.event} after losing the connection it was received from, it will be received again"
+                )
+            elif exc := handled.exception():
+                if not self._settle_failure(item, exc):
+                    # Wait before requeueing it, without handling anything else.
+                    return
+            else:
+                self._pipeline.popleft()
+                self._attempts.pop(item.message.body, None)
+                item.message.ack()
+                self._settled(item)
+            if self.one_shot:
+                self.should_stop = True
+
+        if not self._pipeline or self._pipeline[0].handled:
+            return
+        if self._stopping:
+            self._discard_pipeline("stopping")
+            return
+        head = self._prioritise_pipeline()
+        head.handled = self._handle_executor.submit(
+            partial(self._handle_prepared, head)
+        )
+
+    def _prioritise_pipeline(self) -> _PipelineItem:
+        """Move the next message to handle to the front of the pipeline.
+
+        This is the message with the highest priority, unless it shares a destination
+        with a message received before it, or the oldest message otherwise.
+        """
+        next_index = 0
+        earlier_destinations: set[str] = set()
+        for index, item in enumerate(self._pipeline):
+            if (
+                item.lane.priority > self._pipeline[next_index].lane.priority
+                and not item.lane.destinations & earlier_destinations
+            ):
+                next_index = index
+            earlier_destinations |= item.lane.destinations
+
+        if next_index:
+            item = self._pipeline[next_index]
+            del self._pipeline[next_index]
+            self._pipeline.appendleft(item)
+            logger.info(
+                f"Handling {item.event} with priority {item.lane.priority} ahead of {next_index} earlier message(s)"
+            )
+            metrics.incr("pipeline.reordered")
+        return self._pipeline[0]
+
+    def _settle_failure(self, item: _PipelineItem, exc: BaseException) -> bool:
+        """Requeue the failed message once its retry is due, or park it.
+
+        Return whether the message was settled.
+        """
+        if isinstance(exc, MessageDeferredError):
+            # Not a failure, e.g. the repository is leased by another worker.
+            item.retry_at = time.monotonic()
+        elif item.retry_at is None:
+            attempts = self._attempts.get(item.message.body, 0) + 1
+            self._attempts[item.message.body] = attempts
+            metrics.incr("messages.failed")
+            if (
+                self.parking_queue
+                and self.max_attempts
+                and attempts >= self.max_attempts
+            ):
+                self._pipeline.popleft()
+                self._attempts.pop(item.message.body, None)
+                self._park(item, exc, attempts)
+                return True
+
+            delay = min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay)
+            item.retry_at = time.monotonic() + delay
+            if delay:
+                logger.info(
+                    f"Requeueing {item.event} in {delay}s, after {attempts} failed attempt(s) ..."
+                )
+
+        if time.monotonic() < item.retry_at and not self._stopping:
+            return False
+        self._pipeline.popleft()
+        item.message.requeue()
+        self._discard_pipeline(f"handling {item.event} failed")
+        return True
+
+    def _park(self, item: _PipelineItem, exc: BaseException, attempts: int) -> None:
+        """Move the message to the parking queue, along with the error."""
+        assert self.parking_queue
+        logger.error(
+            f"Parking {item.event} in {self.parking_queue.name} after {attempts} failed attempts: {exc}"
+        )
+        # Publish on the channel of the consumer: nothing keeps the connection given to
+        # the worker alive, as ConsumerMixin consumes on a clone of it.
+        producer = kombu.Producer(item.message.channel, serializer="json")
+        producer.publish(
+            {
+                "message": item.body,
+                "queue": self.task_queue.name,
+                "attempts": attempts,
+                "error": "".join(traceback.format_exception(exc)),
+                "parked_at": time.time(),
+            },
+            exchange="",
+            routing_key=self.parking_queue.name,
+            declare=[self.parking_queue],
+        )
+        item.message.ack()
+        metrics.incr("messages.parked")
+        self._settled(item)
+
+    def _settled(self, item: _PipelineItem) -> None:
+        if self.event_settled:
+            self.event_settled(item.event)
+
+    def _discard_pipeline(self, reason: str) -> None:
+        """Requeue the messages which were prepared but not handled yet, in order."""
+        if self._pipeline:
+            logger.info(
+                f"Requeueing {len(self._pipeline)} prepared message(s), {reason} ..."
+            )
+        while self._pipeline:
+            item = self._pipeline.popleft()
+            item.prepared.cancel()
+            item.message.requeue()
+
+    @staticmethod
+    def _handle_prepared(item: _PipelineItem) -> None:
+        handle = item.prepared.result()
+        handle()
@@ -0,0 +1,155 @@
+import json
+import time
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass
+
+from kombu import Message
+from kombu.simple import SimpleQueue
+from mozlog import get_proxy_logger
+
+from git_hg_sync.events import Event, Push
+from git_hg_sync.mapping import Mapping
+from git_hg_sync.pulse_worker import EntityTypeError, PulseWorker
+
+logger = get_proxy_logger("queue_scan")
+
+# Messages are held until the end of the scan, so this bounds the memory it uses.
+DEFAULT_MAX_MESSAGES = 10000
+
+
+@dataclass(frozen=True)
+class PushFilter:
+    """Select pushes by repository, range of push IDs, user and branch."""
+
+    repo_url: str | None = None
+    min_push_id: int | None = None
+    max_push_id: int | None = None
+    user: str | None = None
+    branch: str | None = None
+
+    def __bool__(self) -> bool:
+        return any(value is not None for value in vars(self).values())
+
+    def matches(self, event: Event | None) -> bool:
+        if not isinstance(event, Push):
+            return False
+        return (
+            (self.repo_url is None or event.repo_url == self.repo_url)
+            and (self.min_push_id is None or event.push_id >= self.min_push_id)
+            and (self.max_push_id is None or event.push_id <= self.max_push_id)
+            and (self.user is None or event.user == self.user)
+            and (self.branch is None or self.branch in (event.branches or {}))
+        )
+
+
+@dataclass
+class ScannedMessage:
+    message: Message
+    # None if the message couldn't be parsed.
+    event: Event | None
+    removed: bool = False
+
+
+def parse_message(message: Message) -> Event | None:
+    """Parse the event of a message as the workers do, or return None if invalid."""
+    body = message.payload
+    try:
+        if isinstance(body, str):
+            body = json.loads(body)
+        return PulseWorker.parse_entity(body["payload"])
+    except (EntityTypeError, KeyError, TypeError, ValueError) as exc:
+        logger.warning(f"Cannot parse message {message.delivery_tag}: {exc}")
+        return None
+
+
+def scan_queue(
+    queue: SimpleQueue,
+    remove: Callable[[Event | None], bool] = lambda _event: False,
+    *,
+    max_messages: int = DEFAULT_MAX_MESSAGES,
+) -> list[ScannedMessage]:
+    """Read the messages of `queue` in one pass, and remove those selected by `remove`.
+
+    Messages are fetched one at a time, and held unacknowledged until the end of the
+    scan, so they aren't delivered to the workers in the meantime. The selected
+    messages are then acknowledged, and the others requeued in their original order
+    (the broker puts requeued messages back in their original position). Messages
+    published during the scan stay behind them.
+
+    At most `max_messages` are read, and returned in order.
+    """
+    scanned: list[ScannedMessage] = []
+    try:
+        while len(scanned) < max_messages:
+            try:
+                message = queue.get(block=False)
+            except queue.Empty:
+                break
+            scanned_message = ScannedMessage(message, parse_message(message))
+            scanned.append(scanned_message)
+            scanned_message.removed = remove(scanned_message.event)
+        else:
+            logger.warning(f"Stopped scanning after {max_messages} messages")
+    except BaseException:
+        # Leave the queue as it was.
+        for scanned_message in scanned:
+            scanned_message.removed = False
+        raise
+    finally:
+        for scanned_message in scanned:
+            if scanned_message.removed:
+                scanned_message.message.ack()
+            else:
+                scanned_message.message.requeue()
+    return scanned
+
+
+def queue_stats(
+    scanned: list[ScannedMessage],
+    mappings: Iterable[Mapping],
+    throughput: float | None = None,
+    *,
+    truncated: bool = False,
+    now: float | None = None,
+) -> dict:
+    """Summarise the scanned messages, as a JSON-serialisable dict.
+
+    `throughput` is the recent number of pushes synced per second, used to estimate the
+    time needed to drain the queue. `truncated` tells whether the scan stopped before
+    the end of the queue, in which case the depths are lower bounds.
+    """
+    now = time.time() if now is None else now
+    mappings = list(mappings)
+    repositories: dict[str, dict] = {}
+    destinations: dict[str, int] = {}
+    pushes = [
+        scanned_message.event
+        for scanned_message in scanned
+        if isinstance(scanned_message.event, Push)
+    ]
+    for push in pushes:
+        repository = repositories.setdefault(
+            push.repo_url, {"depth": 0, "oldest_push_time": push.time}
+        )
+        repository["depth"] += 1
+        repository["oldest_push_time"] = min(repository["oldest_push_time"], push.time)
+        destination_urls = {
+            match.destination_url
+            for mapping in mappings
+            for match in mapping.match(push)
+        }
+        for destination_url in destination_urls:
+            destinations[destination_url] = destinations.get(destination_url, 0) + 1
+
+    oldest_push_time = min((push.time for push in pushes), default=None)
+    return {
+        "depth": len(scanned),
+        "invalid": len(scanned) - len(pushes),
+        "truncated": truncated,
+        "repositories": repositories,
+        "destinations": destinations,
+        "oldest_push_time": oldest_push_time,
+        "lag": None if oldest_push_time is None else max(0, now - oldest_push_time),
+        "throughput": throughput,
+        "drain_time": len(scanned) / throughput if throughput else None,
+    }
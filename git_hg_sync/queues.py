@@ -0,0 +1,33 @@
+from kombu import Connection, Exchange, Queue
+
+from git_hg_sync.config import PulseConfig
+
+
+def get_connection(config: PulseConfig) -> Connection:
+    return Connection(
+        hostname=config.host,
+        port=config.port,
+        userid=config.userid,
+        password=config.password,
+        heartbeat=config.heartbeat,
+        ssl=config.ssl,
+    )
+
+
+def get_queue(config: PulseConfig) -> Queue:
+    exchange = Exchange(config.exchange, type="topic")
+    return Queue(
+        name=config.queue,
+        exchange=exchange,
+        routing_key=config.routing_key,
+        exclusive=False,
+    )
+
+
+def get_parking_queue(config: PulseConfig) -> Queue:
+    # Published to through the default exchange, which routes by queue name.
+    return Queue(
+        name=config.parking_queue or f"{config.queue}/parked",
+        routing_key=config.parking_queue or f"{config.queue}/parked",
+        exclusive=False,
+    )
@@ -0,0 +1,61 @@
+import os
+from pathlib import Path
+from typing import Any
+
+from git_hg_sync import REGISTRY_DIRECTORY
+from git_hg_sync.status import read_status
+
+
+class ProcessRegistry:
+    """Registry of the running processes of the service, and their readiness.
+
+    Each process registers under a unique name, with a `<name>.pid` file in the
+    registry directory, and a `<name>.ready` file once it is ready to process messages.
+    Workers also publish their live status in a `<name>.status` file.
+    """
+
+    def __init__(self, directory: Path = REGISTRY_DIRECTORY) -> None:
+        self._directory = directory
+
+    def register(self, name: str, pid: int | None = None) -> None:
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._ready_path(name).unlink(missing_ok=True)
+        self._pid_path(name).write_text(f"{pid or os.getpid()}\n")
+
+    def mark_ready(self, name: str) -> None:
+        self._ready_path(name).touch()
+
+    def unregister(self, name: str) -> None:
+        self._ready_path(name).unlink(missing_ok=True)
+        self._pid_path(name).unlink(missing_ok=True)
+        self.status_path(name).unlink(missing_ok=True)
+
+    def pids(self) -> dict[str, int]:
+        """Return the PIDs of the registered processes, by name.
+
+        Raises ValueError if a pidfile is corrupted.
+        """
+        if not self._directory.exists():
+            return {}
+        return {
+            pid_path.stem: int(pid_path.read_text().strip())
+            for pid_path in sorted(self._directory.glob("*.pid"))
+        }
+
+    def is_ready(self) -> bool:
+        """Whether processes are registered, and all of them are ready."""
+        names = self.pids()
+        return bool(names) and all(self._ready_path(name).exists() for name in names)
+
+    def statuses(self) -> dict[str, dict[str, Any] | None]:
+        """Return the status of the registered processes, by name, if they publish one."""
+        return {name: read_status(self.status_path(name)) for name in self.pids()}
+
+    def status_path(self, name: str) -> Path:
+        return self._directory / f"{name}.status"
+
+    def _pid_path(self, name: str) -> Path:
+        return self._directory / f"{name}.pid"
+
+    def _ready_path(self, name: str) -> Path:
+        return self._directory / f"{name}.ready"
@@ -1,22 +1,38 @@
-import io
-import os
 import re
-import threading
+from collections.abc import Iterable, Sequence
+from contextlib import AbstractContextManager, nullcontext
+from dataclasses import dataclass
 from functools import partial
 from pathlib import Path
 
 import sentry_sdk
-from git import Repo
+from git import Git, Repo
 from git.exc import GitCommandError
 from mozlog import get_proxy_logger
 
-from git_hg_sync.mapping import SyncBranchOperation, SyncOperation, SyncTagOperation
+from git_hg_sync.config import CloneShard, TimeoutsConfig
+from git_hg_sync.limiter import HostLimiters
+from git_hg_sync.locks import CloneLock
+from git_hg_sync.mapping import (
+    Mapping,
+    SyncBranchOperation,
+    SyncOperation,
+    SyncTagOperation,
+    resolve_destination_urls,
+)
 from git_hg_sync.retry import retry
+from git_hg_sync.ssh import SshMultiplexer
+from git_hg_sync.stages import StageGraph
+from git_hg_sync.watchdog import run_git
 
 logger = get_proxy_logger("sync_repo")
 
 REQUEST_USER_ENV_VAR = "AUTOLAND_REQUEST_USER"
 
+CINNABAR_EXPERIMENTS_OPTION = (
+    '--config cinnabar.experiments="branch,tag,git_commit,merge"'
+)
+
 
 class RepoSyncError(Exception):
     """Base exception class for git to mercurial synchronization errors"""
@@ -26,46 +42,233 @@ class MercurialMetadataNotFoundError(RepoSyncError):
     """Raised when a commit is not found"""
 
 
+@dataclass(frozen=True)
+class ExecutionContext:
+    """Identity of the request a sync operation is run for.
+
+    It is passed to git and cinnabar as environment variables of each subprocess,
+    rather than set in the global environment, so concurrent syncs don't interfere.
+    `AUTOLAND_REQUEST_USER` is forwarded to the Mercurial server by SSH (SendEnv).
+    """
+
+    request_user: str
+
+    @property
+    def env(self) -> dict[str, str]:
+        # We don't have the author name in the Pulse message, so we guess from the email
+        # address.
+        userinfo = self.request_user
+        if "@" in userinfo:
+            userinfo, _ = self.request_user.split("@")
+        return {
+            REQUEST_USER_ENV_VAR: self.request_user,
+            "GIT_AUTHOR_EMAIL": self.request_user,
+            "GIT_AUTHOR_NAME": userinfo,
+        }
+
+
 class RepoSynchronizer:
     def __init__(
         self,
         clone_directory: Path,
         url: str,
+        shards: Sequence[CloneShard] = (),
+        timeouts: TimeoutsConfig | None = None,
+        ssh: SshMultiplexer | None = None,
+        limiters: HostLimiters | None = None,
     ) -> None:
         self._clone_directory = clone_directory
         self._src_remote = url
+        self._shards = [
+            (shard, re.compile(shard.destination_pattern)) for shard in shards
+        ]
+        self._timeouts = timeouts or TimeoutsConfig()
+        self._ssh = ssh
+        self._limiters = limiters
+
+    @property
+    def clone_directory(self) -> Path:
+        return self._clone_directory
+
+    def is_configured_as(
+        self,
+        clone_directory: Path,
+        url: str,
+        shards: Sequence[CloneShard] = (),
+        timeouts: TimeoutsConfig | None = None,
+    ) -> bool:
+        """Whether this was created with these settings, so it can be reused."""
+        return (
+            clone_directory == self._clone_directory
+            and url == self._src_remote
+            and list(shards) == [shard for shard, _ in self._shards]
+            and (timeouts or TimeoutsConfig()) == self._timeouts
+        )
 
-    def get_clone_repo(self) -> Repo:
+    def clone_directory_for(self, destination_url: str | None) -> Path:
+        """Get the path of the clone used to sync to `destination_url`."""
+        if shard := self._shard_for(destination_url):
+            return self._shard_directory(shard)
+        return self._clone_directory
+
+    def get_clone_repo(self, destination_url: str | None = None) -> Repo:
         """Get a GitPython Repo object pointing to a git clone of the source
-        remote."""
+        remote.
+
+        If a `destination_url` is given, and it belongs to a shard, the clone for this
+        shard is returned instead of the primary clone.
+
+        The caller should hold the lock of the clone, see `lock_clone`.
+        """
+        if shard := self._shard_for(destination_url):
+            return self._get_shard_repo(shard)
+
         if self._clone_directory.exists():
             repo = Repo(self._clone_directory)
         else:
             repo = Repo.clone_from(
                 self._src_remote,
                 self._clone_directory,
-                multi_options=[
-                    '--config cinnabar.experiments="branch,tag,git_commit,merge"',
-                ],
+                multi_options=[CINNABAR_EXPERIMENTS_OPTION],
+                allow_unsafe_options=True,
+                bare=True,
+            )
+
+        return repo
+
+    def _shard_for(self, destination_url: str | None) -> CloneShard | None:
+        if destination_url is None:
+            return None
+        for shard, pattern in self._shards:
+            if pattern.match(destination_url):
+                return shard
+        return None
+
+    def _shard_directory(self, shard: CloneShard) -> Path:
+        return self._clone_directory.with_name(
+            f"{self._clone_directory.name}.{shard.name}"
+        )
+
+    def _get_shard_repo(self, shard: CloneShard) -> Repo:
+        """Get the clone for a shard, creating it from the primary clone if needed.
+
+        The shard borrows the objects of the primary clone through git alternates, so
+        creating it is cheap. The cinnabar metadata of the primary clone, if any, is
+        copied over, so the shard doesn't need to fetch everything from its
+        destinations again.
+        """
+        shard_directory = self._shard_directory(shard)
+        if shard_directory.exists():
+            return Repo(shard_directory)
+
+        with CloneLock(self._clone_directory).exclusive():
+            primary_repo = self.get_clone_repo()
+            # Shards may reference objects that the primary clone doesn't need anymore,
+            # so never let it prune them.
+            with primary_repo.config_writer() as config:
+                config.set_value("gc", "pruneExpire", "never")
+
+            logger.info(f"Creating clone shard {shard.name} in {shard_directory} ...")
+            repo = Repo.clone_from(
+                str(self._clone_directory),
+                shard_directory,
+                multi_options=[CINNABAR_EXPERIMENTS_OPTION],
                 allow_unsafe_options=True,
                 bare=True,
+                shared=True,
             )
+            if primary_repo.git.execute(
+                ["git", "rev-parse", "--revs-only", "refs/cinnabar/metadata"]
+            ):
+                repo.git.fetch(
+                    [
+                        str(self._clone_directory),
+                        "+refs/cinnabar/metadata:refs/cinnabar/metadata",
+                    ]
+                )
 
         return repo
 
+    def lock_clone(
+        self, destination_url: str | None = None, *, shared: bool = False
+    ) -> AbstractContextManager[None]:
+        """Lock the clone used for `destination_url`, across threads and processes.
+
+        Operations updating the clone need the exclusive lock. Creating a shard clone
+        also briefly locks the primary clone, so locks must be taken in that order.
+        """
+        lock = CloneLock(self.clone_directory_for(destination_url))
+        return lock.shared() if shared else lock.exclusive()
+
+    def list_remote_refs(self) -> tuple[list[str], list[str]]:
+        """List the names of the branches and tags currently on the source remote."""
+        output = retry(
+            f"listing references from {self._src_remote}",
+            lambda: Git().ls_remote("--heads", "--tags", self._src_remote),
+        )
+        branches = []
+        tags = []
+        for line in output.splitlines():
+            _, ref = line.split("\t", maxsplit=1)
+            if ref.endswith("^{}"):
+                # Peeled annotated tag, already listed.
+                continue
+            if ref.startswith("refs/heads/"):
+                branches.append(ref.removeprefix("refs/heads/"))
+            elif ref.startswith("refs/tags/"):
+                tags.append(ref.removeprefix("refs/tags/"))
+        return branches, tags
+
+    def resolve_destination_urls(self, mappings: Iterable[Mapping]) -> list[str]:
+        """List the concrete destination URLs of the `mappings` for this source.
+
+        Dynamic destinations are resolved against the current references of the source
+        remote, which are only listed if needed.
+        """
+        mappings = [
+            mapping for mapping in mappings if mapping.source_url == self._src_remote
+        ]
+        branches: list[str] = []
+        tags: list[str] = []
+        if any(mapping.is_dynamic for mapping in mappings):
+            branches, tags = self.list_remote_refs()
+        return resolve_destination_urls(mappings, self._src_remote, branches, tags)
+
     def _commit_has_mercurial_metadata(self, repo: Repo, git_commit: str) -> bool:
         return not all(char == "0" for char in self._git2hg(repo, git_commit))
 
     def fetch_all_from_remote(
-        self, repo: Repo, remote: str, verbose: bool = False
+        self,
+        repo: Repo,
+        remote: str,
+        verbose: bool = False,
+        env: dict[str, str] | None = None,
     ) -> None:
+        """Fetch the commits and tags of `remote`, without a timeout.
+
+        The progress is reported in the worker status and metrics, and the output of
+        the commands logged if `verbose`.
+        """
+        progress_label = self._progress_label(repo, "fetch")
         try:
             retry(
                 f"fetching changes and tags from {remote}",
-                lambda: self._log_git_execute(
+                lambda: run_git(
                     repo,
-                    ["git", "-c", "cinnabar.graft=true", "fetch", "--tags", remote],
-                    verbose,
+                    [
+                        "-c",
+                        "cinnabar.graft=true",
+                        "fetch",
+                        # Git only reports progress to terminals by default.
+                        "--progress",
+                        "--tags",
+                        remote,
+                    ],
+                    stage="fetch",
+                    timeout=None,
+                    env=env,
+                    progress_label=progress_label,
+                    verbose=verbose,
                 ),
             )
 
@@ -77,47 +280,58 @@ class RepoSynchronizer:
         if remote.startswith("hg::"):
             retry(
                 f"fetching Hg tags with cinnabar from {remote}",
-                lambda: self._log_git_execute(
-                    repo, ["git", "cinnabar", "fetch", "--tags"], verbose
+                lambda: run_git(
+                    repo,
+                    ["cinnabar", "fetch", "--tags"],
+                    stage="fetch",
+                    timeout=None,
+                    env=env,
+                    progress_label=progress_label,
+                    verbose=verbose,
                 ),
             )
 
     @staticmethod
-    def _log_git_execute(repo: Repo, command: list[str], verbose: bool = False) -> None:
-        proc = repo.git.execute(
-            command,
-            stdout_as_string=verbose,
-            as_process=verbose,
-        )
-        if verbose:
-            logger.info(f"Running `{' '.join(command)}` as PID {proc.pid}")
-
-            stdout_thread = threading.Thread(
-                target=RepoSynchronizer._stream_output,
-                args=(proc.stdout, f"{proc.pid}/STDOUT"),
-            )
-            stderr_thread = threading.Thread(
-                target=RepoSynchronizer._stream_output,
-                args=(proc.stderr, f"{proc.pid}/STDERR"),
-            )
-            stdout_thread.start()
-            stderr_thread.start()
-            stdout_thread.join()
-            stderr_thread.join()
+    def _progress_label(repo: Repo, command: str) -> str:
+        """Label of the progress of `command` in the worker status and metrics.
 
-            proc.wait()
-
-    @staticmethod
-    def _stream_output(stream: io.BufferedReader, label: str) -> None:
-        for line in iter(stream.readline, b""):
-            logger.info(f"{label}: {line.decode().strip()}")
+        Commands of separate clones, or different commands of a clone, run
+        concurrently, so they report their progress separately.
+        """
+        return f"{Path(repo.git_dir).name}: {command}"
 
     def sync(
         self, destination_url: str, operations: list[SyncOperation], request_user: str
-    ) -> None:
+    ) -> dict[str, str]:
+        """Sync the `operations` to `destination_url`.
+
+        Syncs using the same clone are serialised, but syncs to destinations in
+        different shards can run concurrently.
+
+        Return the Mercurial changesets of the synced source commits, by git commit.
+        """
+        context = ExecutionContext(request_user)
+        # Only wait for the limit of the destination host once the clone is available.
+        with (
+            self.lock_clone(destination_url),
+            self._limiters.for_destination(destination_url).acquire()
+            if self._limiters
+            else nullcontext(),
+        ):
+            return self._sync(destination_url, operations, context)
+
+    def _sync(
+        self,
+        destination_url: str,
+        operations: list[SyncOperation],
+        context: ExecutionContext,
+    ) -> dict[str, str]:
+        env = context.env
+        if self._ssh:
+            env.update(self._ssh.env(destination_url))
         logger.info(f"Syncing {operations} to {destination_url} ...")
         try:
-            repo = self.get_clone_repo()
+            repo = self.get_clone_repo(destination_url)
         except PermissionError as exc:
             raise PermissionError(
                 f"Failed to create local clone from {destination_url}"
@@ -125,13 +339,10 @@ class RepoSynchronizer:
 
         destination_remote = f"hg::{destination_url}"
 
-        self._ensure_cinnabar_metadata(repo, destination_remote)
-
-        # Get commits we want to send to destination repository
-        commits_to_fetch = [operation.source_commit for operation in operations]
-        retry(
-            "fetching source commits",
-            lambda: repo.git.fetch([self._src_remote, *commits_to_fetch]),
+        # Get commits we want to send to destination repository, unless they were
+        # already fetched, e.g. by `prefetch_source_commits`.
+        commits_to_fetch = self._missing_commits(
+            repo, [operation.source_commit for operation in operations]
         )
         refs_to_push = []
 
@@ -148,55 +359,182 @@ class RepoSynchronizer:
                 sentry_sdk.capture_exception(exc)
                 raise RepoSyncError(branch_operation, exc) from exc
 
-        os.environ[REQUEST_USER_ENV_VAR] = request_user
-        os.environ["GIT_AUTHOR_EMAIL"] = request_user
-        # We don't have the author name in the Pulse message, so we guess from the email
-        # address.
-        userinfo = request_user
-        if "@" in userinfo:
-            userinfo, _ = request_user.split("@")
-        os.environ["GIT_AUTHOR_NAME"] = userinfo
-        logger.debug(f"{REQUEST_USER_ENV_VAR} and GIT_AUTHOR_* set to {request_user}")
+        logger.debug(
+            f"{REQUEST_USER_ENV_VAR} and GIT_AUTHOR_* set to {context.request_user}"
+        )
 
         # Handle tag operations
         tag_ops: list[SyncTagOperation] = [
             op for op in operations if isinstance(op, SyncTagOperation)
         ]
+        tag_branches = list(dict.fromkeys(op.tags_destination_branch for op in tag_ops))
 
-        for tag_operation in tag_ops:
-            tag_branch = tag_operation.tags_destination_branch
+        # The branches of the destination which may need to be fetched (for tags) or
+        # created (when pushing).
+        destination_branches = [ref.split(":")[1] for ref in refs_to_push] + [
+            self._cinnabar_branch(tag_branch) for tag_branch in tag_branches
+        ]
+
+        # Fetching from the source and listing the destination don't touch the cinnabar
+        # metadata, so they run concurrently with the initial fetch from the
+        # destination. Anything else updating the metadata runs after it.
+        stages = StageGraph(f"sync to {destination_url}")
+        stages.add(
+            "cinnabar_metadata",
+            partial(self.ensure_cinnabar_metadata, repo, destination_remote, env),
+            # The initial fetch of the metadata has no timeout, and can take hours.
+            stall_check=False,
+        )
+        stages.add(
+            "source_fetch",
+            partial(self._fetch_source_commits, repo, commits_to_fetch, env),
+        )
+        stages.add(
+            "destination_ls_remote",
+            partial(
+                self._list_destination_branches,
+                repo,
+                destination_remote,
+                destination_branches,
+                env,
+            ),
+        )
+        stages.add(
+            "tag_branches_fetch",
+            lambda: self._fetch_tag_branches(
+                repo,
+                destination_remote,
+                tag_branches,
+                stages.result("destination_ls_remote"),
+                env,
+            ),
+            dependencies=["cinnabar_metadata", "destination_ls_remote"],
+        )
+        stages.add(
+            "tags",
+            lambda: self._create_tags(
+                repo, destination_url, destination_remote, tag_ops, refs_to_push, env
+            ),
+            dependencies=["cinnabar_metadata", "source_fetch", "tag_branches_fetch"],
+        )
+        stages.add(
+            "push",
+            lambda: self._push_refs(
+                repo,
+                destination_url,
+                destination_remote,
+                [
+                    *refs_to_push,
+                    *(
+                        f"{tag_branch}:{self._cinnabar_branch(tag_branch)}"
+                        for tag_branch in stages.result("tags")
+                    ),
+                ],
+                stages.result("destination_ls_remote"),
+                env,
+            ),
+            dependencies=["tags", "destination_ls_remote"],
+        )
+        try:
+            stages.run()
+        finally:
+            logger.info(stages.summary())
+
+        return {
+            commit: self._git2hg(repo, commit)
+            for commit in dict.fromkeys(op.source_commit for op in operations)
+        }
+
+    def _fetch_source_commits(
+        self, repo: Repo, commits: list[str], env: dict[str, str]
+    ) -> None:
+        if not commits:
+            return
+        # Don't write FETCH_HEAD, which concurrent fetches from the destination use, nor
+        # repack the clone under them.
+        retry(
+            "fetching source commits",
+            lambda: self._run_git(
+                repo,
+                [
+                    "fetch",
+                    "--progress",
+                    "--no-write-fetch-head",
+                    "--no-auto-gc",
+                    self._src_remote,
+                    *commits,
+                ],
+                "fetch",
+                env,
+                progress_label=self._progress_label(repo, "source_fetch"),
+            ),
+        )
+
+    def _list_destination_branches(
+        self,
+        repo: Repo,
+        destination_remote: str,
+        branches: list[str],
+        env: dict[str, str],
+    ) -> dict[str, str]:
+        """Map the cinnabar `branches` existing on the destination to their commits."""
+        if not branches:
+            return {}
+        output = retry(
+            "checking which branches already exist remotely",
+            lambda: self._run_git(
+                repo, ["ls-remote", destination_remote, *branches], "ls_remote", env
+            ),
+        )
+        remote_branches = {}
+        for line in output.splitlines():
+            if "\t" in line:
+                commit, branch = line.split("\t", maxsplit=1)
+                remote_branches[branch] = commit
+        return remote_branches
+
+    def _fetch_tag_branches(
+        self,
+        repo: Repo,
+        destination_remote: str,
+        tag_branches: list[str],
+        remote_branches: dict[str, str],
+        env: dict[str, str],
+    ) -> None:
+        for tag_branch in tag_branches:
             # If the destination branch is not present locally, but exists remotely, we
             # explicitly fetch it.
-            local_branch_exists = repo.git.branch("-l", tag_branch)
-            remote_branch_exists = retry(
-                "checking if tag branch already exists remotely",
-                partial(
-                    repo.git.execute,
-                    [
-                        "git",
-                        "ls-remote",
-                        destination_remote,
-                        self._cinnabar_branch(tag_branch),
-                    ],
-                    stdout_as_string=True,
-                ),
-            )
+            local_branch_exists = repo.git.branch("-l", tag_branch, env=env)
+            remote_branch_exists = self._cinnabar_branch(tag_branch) in remote_branches
 
             if not local_branch_exists and remote_branch_exists:
                 retry(
                     f"fetching existing tag branch from {destination_remote}",
                     # https://docs.python-guide.org/writing/gotchas/#late-binding-closures
                     partial(
-                        repo.git.fetch,
+                        self._run_git,
+                        repo,
                         [
+                            "fetch",
                             "-f",
                             destination_remote,
                             f"{self._cinnabar_branch(tag_branch)}:{tag_branch}",
                         ],
+                        "fetch",
+                        env,
                     ),
                 )
 
-        # Create tags
+    def _create_tags(
+        self,
+        repo: Repo,
+        destination_url: str,
+        destination_remote: str,
+        tag_ops: list[SyncTagOperation],
+        refs_to_push: list[str],
+        env: dict[str, str],
+    ) -> set[str]:
+        """Create the tags, and return the names of the tag branches to push."""
 
         # In bug 2012575, we ran into an issue where cinnabar's common-commit detection
         # logic hit an octopus merge that it didn't like once Hg metadata was populated.
@@ -206,7 +544,6 @@ class RepoSynchronizer:
 
         tag_branches_to_push = set()
         for tag_operation in tag_ops:
-
             if not self._commit_has_mercurial_metadata(
                 repo, tag_operation.source_commit
             ):
@@ -217,16 +554,18 @@ class RepoSynchronizer:
                 #
                 # Add mercurial metadata to new commits from synced branches.
                 retry(
-                        "adding mercurial metadata to new git commits for tagging",
-                        lambda: repo.git.execute(
-                            ["git"]
-                            + ["-c", "cinnabar.data=force"]
-                            + ["push"]
-                            + ["--dry-run"]
-                            + [destination_remote]
-                            + refs_to_push,
-                            ),
-                        )
+                    "adding mercurial metadata to new git commits for tagging",
+                    lambda: self._run_git(
+                        repo,
+                        ["-c", "cinnabar.data=force"]
+                        + ["push"]
+                        + ["--dry-run"]
+                        + [destination_remote]
+                        + refs_to_push,
+                        "cinnabar_tag",
+                        env,
+                    ),
+                )
 
                 # Make sure it worked.
                 if not self._commit_has_mercurial_metadata(
@@ -237,8 +576,10 @@ class RepoSynchronizer:
             hg_sha = self._git2hg(repo, tag_operation.source_commit)
             tag_message = f"No bug - Tagging {hg_sha} with {tag_operation.tag} {tag_operation.tag_message_suffix}"
             try:
-                repo.git.cinnabar(
+                self._run_git(
+                    repo,
                     [
+                        "cinnabar",
                         "tag",
                         "--message",
                         tag_message,
@@ -247,6 +588,8 @@ class RepoSynchronizer:
                         tag_operation.tag,
                         tag_operation.source_commit,
                     ],
+                    "cinnabar_tag",
+                    env,
                 )
             except GitCommandError as exc:
                 if re.search("ERROR tag .* already exists", exc.stderr):
@@ -262,12 +605,22 @@ class RepoSynchronizer:
             tag_branches_to_push.add(tag_operation.tags_destination_branch)
 
         if rollback_candidate:
-            logger.debug("rolling back cinnabar metadata update for new commits before push")
+            logger.debug(
+                "rolling back cinnabar metadata update for new commits before push"
+            )
             self._rollback_cinnabar_state(repo, rollback_candidate)
 
-        for tag_branch in tag_branches_to_push:
-            refs_to_push.append(f"{tag_branch}:{self._cinnabar_branch(tag_branch)}")
+        return tag_branches_to_push
 
+    def _push_refs(
+        self,
+        repo: Repo,
+        destination_url: str,
+        destination_remote: str,
+        refs_to_push: list[str],
+        remote_branches: dict[str, str],
+        env: dict[str, str],
+    ) -> None:
         if not refs_to_push:
             logger.warning(
                 "No explicit references to push resulted from processing this message."
@@ -276,27 +629,77 @@ class RepoSynchronizer:
 
         logger.debug(f"References to push: {refs_to_push}")
 
+        remote_branches = dict(remote_branches)
         for ref in refs_to_push:
             # Push commits, branches and tags to destination
             push_args = [destination_remote, ref]
-            # Force-push the branch if it doesn't exist on the remote yet.
+            source, destination_branch = ref.split(":")
+            commit = repo.git.rev_parse(source)
+            # Retrying a completed sync doesn't push anything again.
+            if remote_branches.get(destination_branch) == commit:
+                logger.info(f"{destination_branch} is already at {commit}, skipping")
+                continue
+            # Force-push the branch if it doesn't exist on the remote yet, and wasn't
+            # created by an earlier ref of this sync.
             # This is necessary to create new branches, more specifically for tags.
-            if not retry(
-                "checking if destination branch needs to be created",
-                partial(
-                    repo.git.execute,
-                    ["git", "ls-remote", destination_remote, ref.split(":")[1]],
-                    stdout_as_string=True,
-                ),
-            ):
+            if destination_branch not in remote_branches:
                 push_args = ["-f"] + push_args
             logger.debug(f"Push arguments: {push_args}")
             retry(
                 f"pushing ref {ref} to destination {destination_url}",
-                partial(repo.git.push, push_args),
+                partial(self._run_git, repo, ["push", *push_args], "push", env),
             )
+            remote_branches[destination_branch] = commit
 
-    def _ensure_cinnabar_metadata(self, repo: Repo, destination_remote: str) -> None:
+    def prefetch_source_commits(
+        self, destination_url: str, commits: Sequence[str]
+    ) -> None:
+        """Fetch `commits` from the source into the clone used for `destination_url`.
+
+        This doesn't take the lock of the clone, so it can run while another sync is
+        using it, e.g. to prepare the next message. It only adds objects to the clone,
+        without updating any reference or running garbage collection, and the sync
+        then only fetches the commits which are still missing.
+        """
+        clone_directory = self.clone_directory_for(destination_url)
+        if not clone_directory.exists():
+            # Creating the clone requires its lock, leave it to the sync.
+            return
+        repo = Repo(clone_directory)
+        if missing := self._missing_commits(repo, commits):
+            retry(
+                f"prefetching source commits into {clone_directory}",
+                lambda: self._run_git(
+                    repo,
+                    [
+                        "fetch",
+                        "--progress",
+                        "--no-write-fetch-head",
+                        "--no-auto-gc",
+                        self._src_remote,
+                        *missing,
+                    ],
+                    "fetch",
+                    progress_label=self._progress_label(repo, "prefetch"),
+                ),
+            )
+
+    @staticmethod
+    def _missing_commits(repo: Repo, commits: Sequence[str]) -> list[str]:
+        missing = []
+        for commit in dict.fromkeys(commits):
+            try:
+                repo.git.rev_parse("--verify", "--quiet", f"{commit}^{{commit}}")
+            except GitCommandError:
+                missing.append(commit)
+        return missing
+
+    def ensure_cinnabar_metadata(
+        self,
+        repo: Repo,
+        destination_remote: str,
+        env: dict[str, str] | None = None,
+    ) -> None:
         """Ensure we have all commits from destination repository.
 
         This sets up the correct cinnabar hg2git/git2hg mappings (including
@@ -313,7 +716,26 @@ class RepoSynchronizer:
 
         retry(
             f"fetching commits from {destination_remote}",
-            lambda: self.fetch_all_from_remote(repo, destination_remote),
+            lambda: self.fetch_all_from_remote(repo, destination_remote, env=env),
+        )
+
+    def _run_git(
+        self,
+        repo: Repo,
+        args: list[str],
+        stage: str,
+        env: dict[str, str] | None = None,
+        progress_label: str | None = None,
+    ) -> str:
+        """Run a git command, killing it after the timeout configured for `stage`."""
+        return run_git(
+            repo,
+            args,
+            stage=stage,
+            timeout=getattr(self._timeouts, stage),
+            kill_grace=self._timeouts.kill_grace,
+            env=env,
+            progress_label=progress_label,
         )
 
     def _git2hg(self, repo: Repo, git_commit: str) -> str:
@@ -0,0 +1,194 @@
+import os
+import shlex
+import subprocess
+import tempfile
+import threading
+from collections.abc import Iterable
+from pathlib import Path
+from types import TracebackType
+from typing import Self
+from urllib.parse import urlsplit
+
+from mozlog import get_proxy_logger
+
+from git_hg_sync.metrics import metrics
+
+logger = get_proxy_logger("ssh")
+
+
+class SshMultiplexer:
+    """Persistent SSH master connections to the destination hosts.
+
+    The git commands to a destination reuse the master connection of its host (see
+    `env`), rather than each doing a full SSH handshake. Masters are started on first
+    use, or by `warm`, checked before each use and every `check_interval` seconds
+    while running as a context manager, and restarted if they died.
+
+    Control sockets are named after the connection settings, so workers of the same
+    host share the masters. Masters exit on their own after `persist` idle seconds.
+    """
+
+    def __init__(
+        self,
+        control_directory: Path,
+        *,
+        ssh_command: str | None = None,
+        persist: int = 600,
+        connect_timeout: float = 30,
+        check_interval: float = 60,
+    ) -> None:
+        self._control_directory = control_directory
+        # The docker entrypoint sets the user and options for hg.mozilla.org there.
+        self._ssh_command = shlex.split(
+            ssh_command or os.environ.get("GIT_SSH_COMMAND", "ssh")
+        )
+        self._persist = persist
+        self._connect_timeout = connect_timeout
+        self._check_interval = check_interval
+        # Lock of each host, so concurrent syncs don't start several masters.
+        self._hosts: dict[str, threading.Lock] = {}
+        self._hosts_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="ssh-multiplexer", daemon=True
+        )
+
+    def __enter__(self) -> Self:
+        self._thread.start()
+        return self
+
+    def __exit__(
+        self,
+        _exc_type: type[BaseException] | None,
+        _exc: BaseException | None,
+        _traceback: TracebackType | None,
+    ) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    @staticmethod
+    def host_of(url: str) -> str | None:
+        """The `[user@]host[:port]` of an SSH URL, or None for other URLs."""
+        parts = urlsplit(url.removeprefix("hg::"))
+        if parts.scheme != "ssh" or not parts.hostname:
+            return None
+        return parts.netloc
+
+    def env(self, url: str) -> dict[str, str]:
+        """Environment variables making git reuse the master connection for `url`.
+
+        If the master can't be started, the commands connect on their own.
+        """
+        host = self.host_of(url)
+        if not host:
+            return {}
+        if self.connect(host):
+            metrics.incr("ssh.multiplexed")
+        else:
+            metrics.incr("ssh.fallbacks")
+        command = [*self._ssh_command, "-o", "ControlMaster=no", *self._control_options]
+        return {"GIT_SSH_COMMAND": shlex.join(command)}
+
+    def warm(self, urls: Iterable[str]) -> None:
+        """Start the master connections of the SSH `urls`, e.g. on startup."""
+        for host in dict.fromkeys(filter(None, map(self.host_of, urls))):
+            self.connect(host)
+
+    def connect(self, host: str) -> bool:
+        """Start the master connection to `host` unless running, and return if it is."""
+        with self._hosts_lock:
+            host_lock = self._hosts.setdefault(host, threading.Lock())
+        with host_lock:
+            if self._is_connected(host):
+                return True
+            return self._start_master(host)
+
+    def check_all(self) -> None:
+        """Restart the master connections which died."""
+        with self._hosts_lock:
+            hosts = list(self._hosts)
+        for host in hosts:
+            if not self._is_connected(host):
+                logger.warning(f"SSH master connection to {host} lost, reconnecting")
+                metrics.incr("ssh.reconnects")
+                self.connect(host)
+
+    @property
+    def _control_options(self) -> list[str]:
+        # %C is a hash of the connection settings, which keeps the path short enough
+        # for a socket.
+        return ["-o", f"ControlPath={self._control_directory}/%C"]
+
+    def _destination(self, host: str) -> list[str]:
+        parts = urlsplit(f"ssh://{host}")
+        options = []
+        if parts.username:
+            options += ["-l", parts.username]
+        if parts.port:
+            options += ["-p", str(parts.port)]
+        return [*options, parts.hostname or host]
+
+    def _is_connected(self, host: str) -> bool:
+        try:
+            result = subprocess.run(
+                [*self._ssh_command, *self._control_options, "-O", "check"]
+                + self._destination(host),
+                stdin=subprocess.DEVNULL,
+                capture_output=True,
+                timeout=self._connect_timeout,
+                check=False,
+            )
+        except subprocess.TimeoutExpired:
+            return False
+        return result.returncode == 0
+
+    def _start_master(self, host: str) -> bool:
+        logger.info(f"Starting SSH master connection to {host} ...")
+        self._control_directory.mkdir(parents=True, exist_ok=True)
+        metrics.incr("ssh.handshakes")
+        # The master keeps the output streams of the command once in the background,
+        # so read errors from a file rather than a pipe.
+        with tempfile.TemporaryFile() as stderr:
+            try:
+                result = subprocess.run(
+                    [
+                        *self._ssh_command,
+                        *self._control_options,
+                        "-o",
+                        "ControlMaster=yes",
+                        "-o",
+                        f"ControlPersist={self._persist}",
+                        "-o",
+                        f"ConnectTimeout={int(self._connect_timeout)}",
+                        # Go to the background once connected, without running a
+                        # command.
+                        "-f",
+                        "-N",
+                    ]
+                    + self._destination(host),
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=stderr,
+                    timeout=self._connect_timeout,
+                    check=False,
+                )
+            except subprocess.TimeoutExpired:
+                returncode = None
+            else:
+                returncode = result.returncode
+            stderr.seek(0)
+            error = stderr.read().decode(errors="replace").strip()
+        if returncode != 0:
+            metrics.incr("ssh.failures")
+            logger.warning(
+                f"Failed to start SSH master connection to {host} ({returncode}): {error}"
+            )
+            return False
+        return True
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self._check_interval):
+            try:
+                self.check_all()
+            except Exception:
+                logger.error("Failed to check SSH connections", exc_info=True)
@@ -0,0 +1,139 @@
+import time
+from collections.abc import Callable, Iterable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any
+
+from git_hg_sync.metrics import metrics
+from git_hg_sync.status import status
+
+
+@dataclass
+class Stage:
+    name: str
+    function: Callable[[], Any]
+    dependencies: tuple[str, ...] = ()
+    # Whether the stage is reported as stalled after running for too long, see the
+    # heartbeat of dockerflow. Stages which can legitimately run for hours opt out.
+    stall_check: bool = True
+    # Offsets from the start of the graph, in seconds.
+    started: float | None = None
+    finished: float | None = None
+    result: Any = None
+
+    @property
+    def duration(self) -> float:
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+
+class StageGraph:
+    """Run stages as soon as the stages they depend on are done.
+
+    Independent stages run concurrently, so stages must only be made independent if
+    they can safely run at the same time (e.g. network operations not updating the same
+    references). Stages can access the results of their dependencies with `result`.
+    """
+
+    def __init__(self, name: str, *, max_workers: int = 4) -> None:
+        self.name = name
+        self._max_workers = max_workers
+        self._stages: dict[str, Stage] = {}
+
+    def add(
+        self,
+        name: str,
+        function: Callable[[], Any],
+        dependencies: Iterable[str] = (),
+        *,
+        stall_check: bool = True,
+    ) -> None:
+        """Add a stage, which can only depend on stages added before it."""
+        if name in self._stages:
+            raise ValueError(f"Duplicate stage {name}")
+        dependencies = tuple(dependencies)
+        if unknown := [dep for dep in dependencies if dep not in self._stages]:
+            raise ValueError(f"Unknown dependencies for stage {name}: {unknown}")
+        self._stages[name] = Stage(name, function, dependencies, stall_check)
+
+    def result(self, name: str) -> Any:
+        return self._stages[name].result
+
+    @property
+    def stages(self) -> list[Stage]:
+        return list(self._stages.values())
+
+    def run(self) -> None:
+        """Run all the stages, and raise the first error, if any.
+
+        After an error, no new stage is started, but the running ones are waited for.
+        """
+        start = time.monotonic()
+        pending = dict(self._stages)
+        done: set[str] = set()
+        running: dict[Future, Stage] = {}
+        error: BaseException | None = None
+
+        with ThreadPoolExecutor(
+            max_workers=self._max_workers, thread_name_prefix="stage"
+        ) as executor:
+            while pending or running:
+                if error is None:
+                    for stage in list(pending.values()):
+                        if all(dep in done for dep in stage.dependencies):
+                            del pending[stage.name]
+                            future = executor.submit(self._run_stage, stage, start)
+                            running[future] = stage
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    if exc := future.exception():
+                        error = error or exc
+                    else:
+                        done.add(stage.name)
+
+        if error:
+            raise error
+
+    def _run_stage(self, stage: Stage, start: float) -> None:
+        status_name = f"{self.name}: {stage.name}"
+        status.start_stage(status_name, stall_check=stage.stall_check)
+        stage.started = time.monotonic() - start
+        try:
+            stage.result = stage.function()
+        finally:
+            stage.finished = time.monotonic() - start
+            status.finish_stage(status_name)
+            metrics.timing(f"stage.{stage.name}", stage.duration)
+
+    def critical_path(self) -> list[Stage]:
+        """The chain of dependencies which finished last, and so set the total time."""
+        finished = [
+            stage for stage in self._stages.values() if stage.finished is not None
+        ]
+        if not finished:
+            return []
+        path = [max(finished, key=lambda stage: stage.finished or 0)]
+        while dependencies := [
+            self._stages[dep]
+            for dep in path[-1].dependencies
+            if self._stages[dep].finished is not None
+        ]:
+            path.append(max(dependencies, key=lambda stage: stage.finished or 0))
+        return path[::-1]
+
+    def summary(self) -> str:
+        timings = ", ".join(
+            f"{stage.name} {stage.duration:.1f}s"
+            for stage in self._stages.values()
+            if stage.finished is not None
+        )
+        critical_path = " > ".join(stage.name for stage in self.critical_path())
+        total = max((stage.finished or 0 for stage in self._stages.values()), default=0)
+        return (
+            f"Stages of {self.name} in {total:.1f}s: {timings}; "
+            f"critical path: {critical_path}"
+        )
@@ -0,0 +1,183 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from types import TracebackType
+from typing import Any, Self
+
+from mozlog import get_proxy_logger
+
+from git_hg_sync.metrics import Metrics, metrics
+
+logger = get_proxy_logger("status")
+
+# The status file starts with a sequence number, odd while the status is being written,
+# and the length of the JSON status following it.
+HEADER = struct.Struct("<QI")
+STATUS_FILE_SIZE = 1024 * 1024
+
+# Period over which the throughput is measured, in seconds.
+THROUGHPUT_WINDOW = 3600
+
+
+class WorkerStatus:
+    """Live state of the worker: current message and stages, successes and throughput.
+
+    Updates happen on the hot path of the syncs, so they are single assignments to
+    dicts and deques, which are atomic, rather than taking a lock. `snapshot` copies them
+    from another thread.
+    """
+
+    def __init__(self) -> None:
+        self._message: dict[str, Any] = {}
+        # Start time of the running stages, and whether they're checked for stalls, by
+        # name. Stages of separate destinations can run concurrently.
+        self._stages: dict[str, dict[str, Any]] = {}
+        self._last_success: dict[str, float] = {}
+        # Last progress line of the running commands, by label.
+        self._progress: dict[str, str] = {}
+        self._handled: deque[float] = deque(maxlen=10000)
+
+    def start_message(self, description: str) -> None:
+        self._message = {"message": description, "started": time.time()}
+
+    def finish_message(self, succeeded: bool) -> None:
+        self._message = {}
+        if succeeded:
+            self._handled.append(time.time())
+
+    def start_stage(self, name: str, *, stall_check: bool = True) -> None:
+        self._stages[name] = {"started": time.time(), "stall_check": stall_check}
+
+    def finish_stage(self, name: str) -> None:
+        self._stages.pop(name, None)
+
+    def set_progress(self, label: str, line: str) -> None:
+        self._progress[label] = line
+
+    def clear_progress(self, label: str) -> None:
+        self._progress.pop(label, None)
+
+    def record_success(self, destination_url: str) -> None:
+        self._last_success[destination_url] = time.time()
+
+    def snapshot(self) -> dict[str, Any]:
+        now = time.time()
+        message = self._message
+        recent = [
+            handled
+            for handled in self._handled.copy()
+            if handled > now - THROUGHPUT_WINDOW
+        ]
+        return {
+            "pid": os.getpid(),
+            "updated_at": now,
+            "message": message.get("message"),
+            "message_started": message.get("started"),
+            "stages": self._stages.copy(),
+            "progress": self._progress.copy(),
+            "last_success": self._last_success.copy(),
+            # Messages handled per second.
+            "throughput": len(recent) / THROUGHPUT_WINDOW,
+        }
+
+    def reset(self) -> None:
+        self._message = {}
+        self._stages.clear()
+        self._last_success.clear()
+        self._progress.clear()
+        self._handled.clear()
+
+
+status = WorkerStatus()
+
+
+class StatusPublisher:
+    """Write the worker status and metrics to a memory-mapped file.
+
+    The file is rewritten every `interval` seconds. Readers in other processes (e.g.
+    dockerflow) use `read_status`, which retries if the status changed while being
+    read, so neither side takes a lock.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        worker_status: WorkerStatus = status,
+        interval: float = 1,
+        worker_metrics: Metrics = metrics,
+    ) -> None:
+        self._path = path
+        self._status = worker_status
+        self._metrics = worker_metrics
+        self._interval = interval
+        self._sequence = 0
+        self._mmap: mmap.mmap | None = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="status-publisher", daemon=True
+        )
+
+    def __enter__(self) -> Self:
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        with self._path.open("w+b") as status_file:
+            status_file.truncate(STATUS_FILE_SIZE)
+            self._mmap = mmap.mmap(status_file.fileno(), STATUS_FILE_SIZE)
+        self.publish()
+        self._thread.start()
+        return self
+
+    def __exit__(
+        self,
+        _exc_type: type[BaseException] | None,
+        _exc: BaseException | None,
+        _traceback: TracebackType | None,
+    ) -> None:
+        self._stopped.set()
+        self._thread.join()
+        if self._mmap:
+            self._mmap.close()
+        self._path.unlink(missing_ok=True)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self._interval):
+            try:
+                self.publish()
+            except Exception:
+                logger.error("Failed to publish the worker status", exc_info=True)
+
+    def publish(self) -> None:
+        assert self._mmap
+        data = json.dumps(
+            {**self._status.snapshot(), "metrics": self._metrics.snapshot()}
+        ).encode()
+        if len(data) > STATUS_FILE_SIZE - HEADER.size:
+            logger.warning(f"Worker status too large to publish ({len(data)} bytes)")
+            return
+        self._sequence += 1
+        HEADER.pack_into(self._mmap, 0, self._sequence, 0)
+        self._mmap[HEADER.size : HEADER.size + len(data)] = data
+        self._sequence += 1
+        HEADER.pack_into(self._mmap, 0, self._sequence, len(data))
+
+
+def read_status(path: Path, attempts: int = 10) -> dict[str, Any] | None:
+    """Read a status file written by `StatusPublisher`, or return None if unavailable."""
+    try:
+        with path.open("rb") as status_file:
+            contents = mmap.mmap(status_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    with contents:
+        for _ in range(attempts):
+            sequence, length = HEADER.unpack_from(contents, 0)
+            data = contents[HEADER.size : HEADER.size + length]
+            # Only use the status if it wasn't being written while it was read.
+            if sequence % 2 == 0 and HEADER.unpack_from(contents, 0)[0] == sequence:
+                return json.loads(data) if sequence else None
+            time.sleep(0.001)
+    return None
@@ -0,0 +1,200 @@
+import multiprocessing
+import os
+import signal
+import time
+from collections.abc import Callable
+from dataclasses import dataclass
+from multiprocessing.process import BaseProcess
+from types import FrameType
+
+from mozlog import get_proxy_logger
+
+from git_hg_sync.config import Config, WorkerShard
+from git_hg_sync.registry import ProcessRegistry
+
+logger = get_proxy_logger("supervisor")
+
+SUPERVISOR_NAME = "supervisor"
+
+# A worker running for longer than this is considered healthy, and its restart delay
+# goes back to the configured minimum.
+STABLE_UPTIME = 60
+
+WorkerTarget = Callable[[Config, str], None]
+
+
+def shard_configs(config: Config) -> dict[str, Config]:
+    """Build the configuration of the worker of each shard, by name.
+
+    Each worker only tracks the repositories of its shard, and consumes from its own
+    queue. Unless the shard specifies a routing key, this queue gets the same binding as
+    the main one, so every worker receives all the messages, and ignores those for
+    repositories it doesn't track.
+
+    Without configured shards, each tracked repository gets its own worker.
+    """
+    shards = config.supervisor.shards or [
+        WorkerShard(name=tracked_repo.name, tracked_repositories=[tracked_repo.name])
+        for tracked_repo in config.tracked_repositories
+    ]
+
+    configs = {}
+    for shard in shards:
+        tracked_repositories = [
+            tracked_repo
+            for tracked_repo in config.tracked_repositories
+            if tracked_repo.name in shard.tracked_repositories
+        ]
+        tracked_urls = {tracked_repo.url for tracked_repo in tracked_repositories}
+        pulse = config.pulse.model_copy(
+            update={
+                "queue": f"{config.pulse.queue}/{shard.name}",
+                "routing_key": shard.routing_key or config.pulse.routing_key,
+            }
+        )
+        configs[shard.name] = config.model_copy(
+            update={
+                "pulse": pulse,
+                "tracked_repositories": tracked_repositories,
+                "branch_mappings": [
+                    mapping
+                    for mapping in config.branch_mappings
+                    if mapping.source_url in tracked_urls
+                ],
+                "tag_mappings": [
+                    mapping
+                    for mapping in config.tag_mappings
+                    if mapping.source_url in tracked_urls
+                ],
+            }
+        )
+    return configs
+
+
+def worker_configs(config: Config) -> dict[str, Config]:
+    """Build the configuration of each worker, by worker name."""
+    return {
+        f"worker-{name}": shard_config
+        for name, shard_config in shard_configs(config).items()
+    }
+
+
+@dataclass
+class _Worker:
+    name: str
+    config: Config
+    process: BaseProcess | None = None
+    started_at: float = 0
+    restart_delay: float = 0
+    restart_at: float = 0
+
+
+class Supervisor:
+    """Run one worker process per shard, and restart them when they exit."""
+
+    def __init__(
+        self,
+        config: Config,
+        target: WorkerTarget,
+        *,
+        registry: ProcessRegistry | None = None,
+        poll_interval: float = 1,
+    ) -> None:
+        self._workers = [
+            _Worker(name, worker_config)
+            for name, worker_config in worker_configs(config).items()
+        ]
+        self._target = target
+        self._registry = registry or ProcessRegistry()
+        self._restart_delay = config.supervisor.restart_delay
+        self._max_restart_delay = config.supervisor.max_restart_delay
+        self._poll_interval = poll_interval
+        self._context = multiprocessing.get_context("fork")
+        self.should_stop = False
+
+    def run(self) -> None:
+        def signal_handler(_sig: int, _frame: FrameType | None) -> None:
+            if self.should_stop:
+                logger.info("Supervisor killed by user, killing workers")
+                self._signal_workers(signal.SIGTERM)
+                return
+            self.should_stop = True
+            logger.info("Supervisor exiting gracefully")
+
+        signal.signal(signal.SIGINT, signal_handler)
+        signal.signal(signal.SIGTERM, signal_handler)
+        # Pausing only applies to the workers, see `git-hg-cli pause`.
+        signal.signal(signal.SIGTSTP, signal.SIG_IGN)
+        # Workers reload their part of the configuration. New shards are only started
+        # by restarting the supervisor.
+        signal.signal(
+            signal.SIGHUP, lambda _sig, _frame: self._signal_workers(signal.SIGHUP)
+        )
+
+        self._registry.register(SUPERVISOR_NAME)
+        self._registry.mark_ready(SUPERVISOR_NAME)
+        try:
+            for worker in self._workers:
+                self._start(worker)
+            while not self.should_stop:
+                self._check_workers()
+                time.sleep(self._poll_interval)
+        finally:
+            self._stop_workers()
+            self._registry.unregister(SUPERVISOR_NAME)
+
+    def _start(self, worker: _Worker) -> None:
+        worker.process = self._context.Process(
+            target=_run_worker,
+            args=(self._target, worker.config, worker.name),
+            name=worker.name,
+        )
+        worker.process.start()
+        worker.started_at = time.monotonic()
+        logger.info(f"Started {worker.name} as PID {worker.process.pid}")
+
+    def _check_workers(self) -> None:
+        now = time.monotonic()
+        for worker in self._workers:
+            if worker.process and not worker.process.is_alive():
+                exitcode = worker.process.exitcode
+                worker.process = None
+                # Clean up after workers which couldn't do it themselves.
+                self._registry.unregister(worker.name)
+
+                if now - worker.started_at < STABLE_UPTIME:
+                    worker.restart_delay = min(
+                        max(worker.restart_delay * 2, self._restart_delay),
+                        self._max_restart_delay,
+                    )
+                else:
+                    worker.restart_delay = self._restart_delay
+                worker.restart_at = now + worker.restart_delay
+                logger.warning(
+                    f"{worker.name} exited with code {exitcode}, restarting in {worker.restart_delay}s ..."
+                )
+
+            if not worker.process and now >= worker.restart_at:
+                self._start(worker)
+
+    def _signal_workers(self, sig: signal.Signals) -> None:
+        for worker in self._workers:
+            if worker.process and worker.process.is_alive() and worker.process.pid:
+                os.kill(worker.process.pid, sig)
+
+    def _stop_workers(self) -> None:
+        # Workers finish processing their current message before exiting.
+        self._signal_workers(signal.SIGTERM)
+        for worker in self._workers:
+            if worker.process:
+                worker.process.join()
+                logger.info(f"{worker.name} exited with code {worker.process.exitcode}")
+
+
+def _run_worker(target: WorkerTarget, config: Config, name: str) -> None:
+    # Leave the process group of the supervisor, so signals from the terminal (e.g.
+    # Ctrl-C) only reach the supervisor, which forwards them.
+    os.setpgrp()
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGTSTP, signal.SIGHUP):
+        signal.signal(sig, signal.SIG_DFL)
+    target(config, name)
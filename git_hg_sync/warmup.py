@@ -0,0 +1,80 @@
+import time
+from collections.abc import Mapping as MappingType
+from collections.abc import Sequence
+from typing import TYPE_CHECKING
+
+from mozlog import get_proxy_logger
+
+from git_hg_sync.config import TrackedRepository
+from git_hg_sync.mapping import Mapping
+from git_hg_sync.prefetch import FetchJob, FetchResult, fetch_remotes
+from git_hg_sync.repo_synchronizer import RepoSynchronizer
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+logger = get_proxy_logger("warmup")
+
+
+def warm_up(
+    tracked_repositories: Sequence[TrackedRepository],
+    synchronizers: MappingType[str, RepoSynchronizer],
+    mappings: Sequence[Mapping],
+    *,
+    max_workers: int = 4,
+) -> bool:
+    """Prepare the clones so the first messages don't pay the bootstrap costs.
+
+    This first fetches the seed remotes of each tracked repository, then makes sure
+    each clone used by the concrete destinations of the mappings, including dynamic
+    ones, exists and has cinnabar metadata. Clones are warmed up concurrently.
+
+    Failures are logged but not raised, so the worker can still start. Returns whether
+    the warmup completed without errors.
+    """
+    logger.info("Warming up clones ...")
+    start = time.monotonic()
+
+    seed_jobs = [
+        FetchJob(synchronizers[tracked_repo.url], f"hg::{seed_remote}")
+        for tracked_repo in tracked_repositories
+        for seed_remote in tracked_repo.seed_remotes
+    ]
+    results = fetch_remotes(seed_jobs, max_workers=max_workers)
+
+    # Destinations are resolved after seeding, so shard clones get created from the
+    # seeded metadata of the primary clone.
+    metadata_jobs = []
+    for tracked_repo in tracked_repositories:
+        synchronizer = synchronizers[tracked_repo.url]
+        try:
+            destination_urls = synchronizer.resolve_destination_urls(mappings)
+        except Exception as exc:  # noqa: BLE001
+            logger.error(f"Failed to resolve destinations of {tracked_repo.url}: {exc}")
+            results.append(
+                FetchResult(FetchJob(synchronizer, tracked_repo.url), 0, exc)
+            )
+            continue
+        # The metadata is shared by all the destinations of a clone, so it's only
+        # fetched from the first destination of each clone, if missing.
+        first_destinations: dict[Path, str] = {}
+        for destination_url in destination_urls:
+            first_destinations.setdefault(
+                synchronizer.clone_directory_for(destination_url), destination_url
+            )
+        metadata_jobs.extend(
+            FetchJob(synchronizer, f"hg::{destination_url}", metadata_only=True)
+            for destination_url in first_destinations.values()
+        )
+    results.extend(fetch_remotes(metadata_jobs, max_workers=max_workers))
+
+    failed = [result for result in results if not result.succeeded]
+    duration = time.monotonic() - start
+    if failed:
+        failed_remotes = ", ".join(result.job.remote for result in failed)
+        logger.warning(
+            f"Warmup completed with {len(failed)} failures out of {len(results)} remotes: {failed_remotes}"
+        )
+    else:
+        logger.info(f"Warmup of {len(results)} remotes completed in {duration:.1f}s.")
+    return not failed
@@ -0,0 +1,110 @@
+import os
+import signal
+import subprocess
+import time
+
+from git import Repo
+from git.exc import GitCommandError
+from mozlog import get_proxy_logger
+
+from git_hg_sync.metrics import metrics
+from git_hg_sync.output import stream_output
+
+logger = get_proxy_logger("watchdog")
+
+
+class CommandTimeoutError(GitCommandError):
+    """Raised when a git command was killed after running for too long."""
+
+    def __init__(self, command: list[str], timeout: float) -> None:
+        super().__init__(command, f"timed out after {timeout}s")
+        self.timeout = timeout
+
+
+def run_git(
+    repo: Repo,
+    args: list[str],
+    *,
+    stage: str,
+    timeout: float | None,
+    kill_grace: float = 10,
+    env: dict[str, str] | None = None,
+    progress_label: str | None = None,
+    verbose: bool = False,
+) -> str:
+    """Run `git <args>` in `repo`, and return its output, like `repo.git.<command>`.
+
+    With a `progress_label`, the output is read with `stream_output`, which reports
+    the progress of the command (given `--progress`) in the worker status and metrics
+    under that label, and logs the output if `verbose`.
+
+    If the command runs for longer than `timeout` seconds, its process group, which
+    includes the processes it started (e.g. ssh or cinnabar), is sent SIGTERM, then
+    SIGKILL if still running after `kill_grace` seconds, and CommandTimeoutError is
+    raised. Timeouts and kills are logged as warnings, and counted in the
+    `timeouts.<stage>`, `watchdog.sigterm` and `watchdog.sigkill` metrics.
+    """
+    command = ["git", *args]
+    start = time.monotonic()
+    # Killing the process is left to us, but this must be kept until it exits: it
+    # terminates the process when garbage collected.
+    auto_interrupt = repo.git.execute(
+        command, as_process=True, env=env, start_new_session=True
+    )
+    proc: subprocess.Popen = auto_interrupt.proc
+    try:
+        if progress_label is None:
+            stdout, stderr = proc.communicate(timeout=timeout)
+        else:
+            stdout, stderr = stream_output(
+                proc,
+                progress_label,
+                max_lines=50 if verbose else 0,
+                timeout=timeout,
+            )
+            proc.wait()
+    except subprocess.TimeoutExpired:
+        assert timeout is not None
+        logger.warning(
+            f"{stage}: `{' '.join(command)}` (PID {proc.pid}) timed out after {timeout}s, sending SIGTERM"
+        )
+        metrics.incr(f"timeouts.{stage}")
+        _kill_process_group(proc, kill_grace, stage, start)
+        duration = time.monotonic() - start
+        metrics.timing(f"timeouts.{stage}.duration", duration)
+        logger.warning(
+            f"{stage}: `{' '.join(command)}` (PID {proc.pid}) killed after {duration:.1f}s"
+        )
+        raise CommandTimeoutError(command, timeout) from None
+
+    if proc.returncode:
+        raise GitCommandError(command, proc.returncode, stderr, stdout)
+    return stdout.decode(errors="replace").removesuffix("\n")
+
+
+def _kill_process_group(
+    proc: subprocess.Popen, kill_grace: float, stage: str, start: float
+) -> None:
+    # The process leads its own group, see `start_new_session`.
+    process_group = proc.pid
+    try:
+        os.killpg(process_group, signal.SIGTERM)
+        metrics.incr("watchdog.sigterm")
+        try:
+            proc.wait(timeout=kill_grace)
+        except subprocess.TimeoutExpired:
+            pass
+        # Check whether anything is left in the group, even if the process exited.
+        os.killpg(process_group, 0)
+        logger.warning(
+            f"{stage}: process group {process_group} still running after {time.monotonic() - start:.1f}s, sending SIGKILL"
+        )
+        os.killpg(process_group, signal.SIGKILL)
+        metrics.incr("watchdog.sigkill")
+    except ProcessLookupError:
+        pass
+    finally:
+        proc.wait()
+        for stream in (proc.stdout, proc.stderr):
+            if stream:
+                stream.close()
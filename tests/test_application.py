@@ -0,0 +1,421 @@
+import os
+import signal
+import threading
+import time
+from pathlib import Path
+from unittest import mock
+
+import kombu
+import pytest
+
+from git_hg_sync.application import Application
+from git_hg_sync.events import Push
+from git_hg_sync.leases import FileLeaseManager, LeaseUnavailableError
+from git_hg_sync.ledger import Ledger
+from git_hg_sync.mapping import BranchMapping
+from git_hg_sync.pulse_worker import Lane, PulseWorker
+from git_hg_sync.registry import ProcessRegistry
+
+
+@pytest.fixture
+def mappings() -> list[BranchMapping]:
+    return [
+        BranchMapping(
+            source_url="repo.git",
+            branch_pattern="^(.*)$",
+            destination_url="hg-remotes/\\1",
+            destination_branch="default",
+        )
+    ]
+
+
+@pytest.fixture
+def push_event() -> Push:
+    return Push(
+        repo_url="repo.git",
+        branches={"central": "a" * 40, "comm": "b" * 40, "beta": "c" * 40},
+        time=0,
+        push_id=1,
+        user="user@example.com",
+        push_json_url="push_json_url",
+    )
+
+
+def test_handle_push_event_sync_shards_concurrently(
+    mappings: list[BranchMapping], push_event: Push
+) -> None:
+    synchronizer = mock.MagicMock()
+    # `comm` is in its own shard, while the others use the primary clone.
+    synchronizer.clone_directory_for.side_effect = lambda destination: Path(
+        "clones/repo.comm" if destination.endswith("comm") else "clones/repo"
+    )
+    running = threading.Barrier(2, timeout=5)
+    synced = []
+
+    def sync(destination: str, _operations: list, _request_user: str) -> None:
+        if destination.endswith(("central", "comm")):
+            # Both clones need to be synced at the same time to get past this.
+            running.wait()
+        synced.append(destination)
+
+    synchronizer.sync.side_effect = sync
+    worker = mock.MagicMock()
+    Application(worker, {"repo.git": synchronizer}, mappings)
+
+    worker.event_handler(push_event)
+
+    assert sorted(synced) == [
+        "hg-remotes/beta",
+        "hg-remotes/central",
+        "hg-remotes/comm",
+    ]
+    # Destinations sharing a clone are still synced in order.
+    assert synced.index("hg-remotes/central") < synced.index("hg-remotes/beta")
+
+
+def test_handle_push_event_failure(
+    mappings: list[BranchMapping], push_event: Push
+) -> None:
+    synchronizer = mock.MagicMock()
+    synchronizer.clone_directory_for.return_value = Path("clones/repo")
+    synchronizer.sync.side_effect = [None, RuntimeError("push failed"), None]
+    worker = mock.MagicMock()
+    Application(worker, {"repo.git": synchronizer}, mappings)
+
+    with pytest.raises(RuntimeError, match="push failed"):
+        worker.event_handler(push_event)
+
+    # Destinations after the failing one are not synced.
+    assert synchronizer.sync.call_count == 2
+
+
+@pytest.mark.parametrize("skip_without_lease", [False, True])
+def test_handle_event_without_lease(
+    tmp_path: Path,
+    mappings: list[BranchMapping],
+    push_event: Push,
+    skip_without_lease: bool,
+) -> None:
+    FileLeaseManager(tmp_path, "other-worker", ttl=60).acquire("repo.git")
+    synchronizer = mock.MagicMock()
+    worker = mock.MagicMock()
+    Application(
+        worker,
+        {"repo.git": synchronizer},
+        mappings,
+        leases=FileLeaseManager(tmp_path, "worker", ttl=60),
+        skip_without_lease=skip_without_lease,
+    )
+
+    if skip_without_lease:
+        # The message gets acknowledged.
+        worker.event_handler(push_event)
+    else:
+        # The message gets requeued, and the worker stops consuming.
+        with pytest.raises(LeaseUnavailableError):
+            worker.event_handler(push_event)
+        assert worker.should_stop is True
+
+    synchronizer.sync.assert_not_called()
+
+
+def test_workers_sharing_queue(tmp_path: Path, mappings: list[BranchMapping]) -> None:
+    queue = kombu.Queue(f"queue-{id(tmp_path)}", routing_key=f"queue-{id(tmp_path)}")
+    handled: list[tuple[str, int]] = []
+    handling = threading.Event()
+    release = threading.Event()
+    signal_handlers = {}
+
+    def publish(push_id: int) -> None:
+        with kombu.Connection("memory://") as connection:
+            queue(connection).declare()
+            connection.Producer(serializer="json").publish(
+                {
+                    "payload": {
+                        "type": "push",
+                        "repo_url": "repo.git",
+                        "branches": {"central": str(push_id) * 40},
+                        "time": 0,
+                        "push_id": push_id,
+                        "user": "user",
+                        "push_json_url": "push_json_url",
+                    }
+                },
+                exchange="",
+                routing_key=queue.name,
+            )
+
+    def run_worker(name: str) -> threading.Thread:
+        def sync(_destination: str, operations: list, _request_user: str) -> None:
+            handling.set()
+            assert release.wait(timeout=5)
+            handled.append((name, int(operations[0].source_commit[0])))
+
+        synchronizer = mock.MagicMock()
+        synchronizer.clone_directory_for.return_value = Path("clones/repo")
+        synchronizer.sync.side_effect = sync
+        app = Application(
+            PulseWorker(kombu.Connection("memory://"), queue),
+            {"repo.git": synchronizer},
+            mappings,
+            name=name,
+            registry=ProcessRegistry(tmp_path / "registry"),
+            leases=FileLeaseManager(tmp_path / "leases", name, ttl=60),
+            lease_retry_interval=0.05,
+        )
+        thread = threading.Thread(target=app.run, name=name, daemon=True)
+        thread.start()
+        return thread
+
+    def stop_worker(thread: threading.Thread) -> None:
+        signal_handlers[thread.name](signal.SIGTERM, None)
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+
+    def wait_for_handled(count: int) -> None:
+        deadline = time.monotonic() + 5
+        while len(handled) < count:
+            assert time.monotonic() < deadline, "Messages were not handled in time"
+            time.sleep(0.01)
+
+    def install_handler(sig: int, handler: object) -> None:
+        if sig == signal.SIGTERM:
+            signal_handlers[threading.current_thread().name] = handler
+
+    for push_id in (1, 2, 3):
+        publish(push_id)
+
+    with mock.patch.object(signal, "signal", side_effect=install_handler):
+        worker_a = run_worker("worker-a")
+        assert handling.wait(timeout=5)
+        worker_b = run_worker("worker-b")
+        # While the first worker holds the lease, the other one doesn't take the
+        # following messages.
+        time.sleep(0.3)
+        release.set()
+        wait_for_handled(3)
+
+        # The other worker takes over once the lease is released.
+        stop_worker(worker_a)
+        publish(4)
+        wait_for_handled(4)
+        stop_worker(worker_b)
+
+    assert handled == [
+        ("worker-a", 1),
+        ("worker-a", 2),
+        ("worker-a", 3),
+        ("worker-b", 4),
+    ]
+
+
+@pytest.mark.parametrize("with_ledger", [False, True])
+def test_handle_push_event_resume(
+    tmp_path: Path,
+    mappings: list[BranchMapping],
+    push_event: Push,
+    with_ledger: bool,
+) -> None:
+    synchronizer = mock.MagicMock()
+    synchronizer.clone_directory_for.return_value = Path("clones/repo")
+    synchronizer.sync.side_effect = [{}, {}, RuntimeError("push failed"), {}]
+    worker = mock.MagicMock()
+    Application(
+        worker,
+        {"repo.git": synchronizer},
+        mappings,
+        ledger=Ledger(tmp_path / "ledger.db") if with_ledger else None,
+    )
+
+    with pytest.raises(RuntimeError, match="push failed"):
+        worker.event_handler(push_event)
+    # On redelivery, only the destination which failed is synced.
+    worker.event_handler(push_event)
+
+    assert [call.args[0] for call in synchronizer.sync.call_args_list] == [
+        "hg-remotes/central",
+        "hg-remotes/comm",
+        "hg-remotes/beta",
+        "hg-remotes/beta",
+    ]
+
+
+def test_checkpoints_forgotten_once_settled(
+    mappings: list[BranchMapping], push_event: Push
+) -> None:
+    synchronizer = mock.MagicMock()
+    synchronizer.clone_directory_for.return_value = Path("clones/repo")
+    synchronizer.sync.side_effect = [{}, RuntimeError("push failed"), {}, {}, {}]
+    worker = mock.MagicMock()
+    Application(worker, {"repo.git": synchronizer}, mappings)
+
+    with pytest.raises(RuntimeError, match="push failed"):
+        worker.event_handler(push_event)
+    # e.g. the message was parked after its last attempt.
+    worker.event_settled(push_event)
+    # Reinjected messages are synced to all their destinations again.
+    worker.event_handler(push_event)
+
+    assert [call.args[0] for call in synchronizer.sync.call_args_list] == [
+        "hg-remotes/central",
+        "hg-remotes/comm",
+        "hg-remotes/central",
+        "hg-remotes/comm",
+        "hg-remotes/beta",
+    ]
+
+
+def test_handle_event_with_lease(
+    tmp_path: Path, mappings: list[BranchMapping], push_event: Push
+) -> None:
+    leases = FileLeaseManager(tmp_path, "worker", ttl=60)
+    synchronizer = mock.MagicMock()
+    synchronizer.clone_directory_for.return_value = Path("clones/repo")
+    worker = mock.MagicMock()
+    Application(worker, {"repo.git": synchronizer}, mappings, leases=leases)
+
+    worker.event_handler(push_event)
+
+    assert synchronizer.sync.call_count == 3
+    assert leases.held() == ["repo.git"]
+
+
+def test_handle_event_with_ledger(
+    tmp_path: Path, mappings: list[BranchMapping], push_event: Push
+) -> None:
+    ledger = Ledger(tmp_path / "ledger.db")
+    synchronizer = mock.MagicMock()
+    synchronizer.clone_directory_for.return_value = Path("clones/repo")
+    synchronizer.sync.side_effect = lambda destination, operations, _user: {
+        operation.source_commit: destination[-1] * 40 for operation in operations
+    }
+    worker = mock.MagicMock()
+    Application(worker, {"repo.git": synchronizer}, mappings, ledger=ledger)
+
+    worker.event_handler(push_event)
+
+    assert synchronizer.sync.call_count == 3
+    assert {
+        entry.destination_url: entry.hg_shas for entry in ledger.entries("repo.git", 1)
+    } == {
+        "hg-remotes/central": {"a" * 40: "l" * 40},
+        "hg-remotes/comm": {"b" * 40: "m" * 40},
+        "hg-remotes/beta": {"c" * 40: "a" * 40},
+    }
+
+    # A redelivered message is acknowledged without syncing again.
+    synchronizer.sync.reset_mock()
+    worker.event_handler(push_event)
+
+    synchronizer.sync.assert_not_called()
+
+
+def test_prepare_event(mappings: list[BranchMapping], push_event: Push) -> None:
+    synchronizer = mock.MagicMock()
+    synchronizer.clone_directory_for.return_value = Path("clones/repo")
+    synchronizer.prefetch_source_commits.side_effect = [
+        None,
+        RuntimeError("fetch failed"),
+        None,
+    ]
+    worker = mock.MagicMock()
+    Application(worker, {"repo.git": synchronizer}, mappings)
+
+    handle = worker.event_preparer(push_event)
+
+    # Prefetch failures are left for the sync to deal with.
+    assert synchronizer.prefetch_source_commits.call_args_list == [
+        mock.call("hg-remotes/central", ["a" * 40]),
+        mock.call("hg-remotes/comm", ["b" * 40]),
+        mock.call("hg-remotes/beta", ["c" * 40]),
+    ]
+    synchronizer.sync.assert_not_called()
+
+    handle()
+
+    assert [call.args[0] for call in synchronizer.sync.call_args_list] == [
+        "hg-remotes/central",
+        "hg-remotes/comm",
+        "hg-remotes/beta",
+    ]
+
+
+def test_event_lane(mappings: list[BranchMapping], push_event: Push) -> None:
+    mappings.append(
+        BranchMapping(
+            source_url="repo.git",
+            branch_pattern="^beta$",
+            destination_url="hg-remotes/beta",
+            destination_branch="default",
+            priority=10,
+        )
+    )
+    worker = mock.MagicMock()
+    Application(worker, {"repo.git": mock.MagicMock()}, mappings)
+
+    lane = worker.event_lane(push_event)
+
+    assert lane.priority == 10
+    assert lane.destinations == {
+        "hg-remotes/central",
+        "hg-remotes/comm",
+        "hg-remotes/beta",
+    }
+    assert worker.event_lane(push_event.model_copy(update={"repo_url": "other"})) == (
+        Lane()
+    )
+
+
+def test_reload(
+    request: pytest.FixtureRequest,
+    tmp_path: Path,
+    mappings: list[BranchMapping],
+    push_event: Push,
+) -> None:
+    synchronizer = mock.MagicMock()
+    synchronizer.clone_directory_for.return_value = Path("clones/repo")
+    other_synchronizer = mock.MagicMock()
+    other_synchronizer.clone_directory_for.return_value = Path("clones/other")
+    reloads = [
+        RuntimeError("invalid configuration"),
+        ({"other.git": other_synchronizer}, []),
+    ]
+
+    def reloader(current: dict) -> tuple[dict, list]:
+        assert current == {"repo.git": synchronizer}
+        if isinstance(result := reloads.pop(0), Exception):
+            raise result
+        return result
+
+    worker = mock.MagicMock()
+    app = Application(
+        worker,
+        {"repo.git": synchronizer},
+        mappings,
+        registry=ProcessRegistry(tmp_path),
+        reloader=reloader,
+    )
+    previous_handler = signal.getsignal(signal.SIGHUP)
+    # Installs the signal handlers, the worker returning straight away.
+    app.run()
+    request.addfinalizer(lambda: signal.signal(signal.SIGHUP, previous_handler))
+
+    # Nothing happens until a reload is requested.
+    worker.iteration_callback()
+    assert len(reloads) == 2
+
+    os.kill(os.getpid(), signal.SIGHUP)
+    worker.iteration_callback()
+    # The current configuration is kept when the new one is invalid.
+    assert worker.event_lane(push_event).destinations
+
+    os.kill(os.getpid(), signal.SIGHUP)
+    prepared = worker.event_preparer(push_event)
+    worker.iteration_callback()
+
+    assert worker.event_lane(push_event) == Lane()
+    # Events prepared before the reload use the previous configuration.
+    prepared()
+    assert synchronizer.sync.call_count == 3
+    worker.event_handler(push_event)
+    assert synchronizer.sync.call_count == 3
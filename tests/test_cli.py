@@ -0,0 +1,47 @@
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from git_hg_sync.cli import SHARD_CONFIG_SECTIONS, shard_pulse_config
+from git_hg_sync.config import Config
+
+HERE = Path(__file__).parent
+
+
+def test_cli_imports_lazily() -> None:
+    # Importing the dependencies of all the commands would slow down every command.
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, git_hg_sync.cli; print(' '.join(sys.modules))",
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.split()
+
+    for module in ["devtools", "git", "kombu", "pydantic", "sentry_sdk"]:
+        assert module not in output
+
+
+def test_shard_pulse_config() -> None:
+    config = Config.from_file(HERE / "data" / "config.toml", SHARD_CONFIG_SECTIONS)
+    logger = mock.MagicMock()
+
+    main = shard_pulse_config(config, logger, argparse.Namespace(shard=None))
+    assert main.queue == "queue/git-hg-sync/test"
+    shard = shard_pulse_config(
+        config, logger, argparse.Namespace(shard="firefox-releases")
+    )
+    assert shard.queue == "queue/git-hg-sync/test/firefox-releases"
+
+    with pytest.raises(SystemExit):
+        shard_pulse_config(config, logger, argparse.Namespace(shard="unknown"))
+    logger.error.assert_called_once_with(
+        "Unknown shard unknown, expected one of: firefox-releases"
+    )
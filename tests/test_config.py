@@ -5,6 +5,7 @@ import tomllib
 
 from git_hg_sync.config import Config, PulseConfig
 from git_hg_sync.events import Push
+from git_hg_sync.mapping import resolve_destination_urls
 
 HERE = Path(__file__).parent
 
@@ -16,6 +17,21 @@ def test_load_config() -> None:
     assert config.branch_mappings[0].destination_branch == "default"
 
 
+def test_load_config_sections(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    config_file = tmp_path / "config.toml"
+    # Other sections are neither needed nor validated.
+    config_file.write_text(
+        (HERE / "data" / "config.toml").read_text()
+        + '\n[supervisor]\nrestart_delay = "invalid"\n'
+    )
+    monkeypatch.setenv("PULSE_HOST", "overridden host")
+
+    config = Config.from_file(config_file, ["pulse"])
+
+    assert config.pulse.host == "overridden host"
+    assert not hasattr(config, "tracked_repositories")
+
+
 def test_load_config_env_override(monkeypatch: pytest.MonkeyPatch) -> None:
     overrides = {
         "pulse": {
@@ -67,6 +83,29 @@ def test_unique_tracked_repository_name() -> None:
         _ = Config(**config)
 
 
+def test_unique_shard_name() -> None:
+    config = tomllib.loads((HERE / "data" / "config.toml").read_text())
+
+    shard = {"name": "esr", "destination_pattern": ".*esr.*"}
+    config["tracked_repositories"][0]["shards"] = [shard]
+    _ = Config(**config)
+
+    config["tracked_repositories"][0]["shards"].append(shard)
+    with pytest.raises(ValueError, match="non-unique shard names"):
+        _ = Config(**config)
+
+
+def test_priority_requires_lookahead() -> None:
+    config = tomllib.loads((HERE / "data" / "config.toml").read_text())
+    config["branch_mappings"][0]["priority"] = 10
+
+    with pytest.raises(ValueError, match="requires a non-zero pulse lookahead"):
+        _ = Config(**config)
+
+    config["pulse"]["lookahead"] = 1
+    _ = Config(**config)
+
+
 @pytest.mark.parametrize(
     "source_url,source_branch,expected_urls,expected_branches",
     [
@@ -169,6 +208,40 @@ def test_tag_mapping(
     # tags_mappings = config.tag_mappings
 
 
+def test_resolve_destination_urls() -> None:
+    config = Config.from_file(HERE / "data" / "config.toml")
+    source_url = "{directory}/git-remotes/firefox-releases"
+
+    destination_urls = resolve_destination_urls(
+        config.branch_mappings + config.tag_mappings,
+        source_url,
+        branches=["main", "esr115", "esr128", "test12"],
+        tags=["FIREFOX_128_0esr_RELEASE", "FIREFOX_140_1_0esr_BUILD1", "not-a-match"],
+    )
+
+    assert destination_urls == [
+        "{directory}/hg-remotes/mozilla-esr115",
+        "{directory}/hg-remotes/mozilla-esr128",
+        "{directory}/hg-remotes/mozilla-test12",
+        "{directory}/hg-remotes/mozilla-esr140",
+    ]
+
+
+def test_resolve_destination_urls_static() -> None:
+    config = Config.from_file(HERE / "data" / "config.toml")
+    mapping = config.branch_mappings[0].model_copy(
+        update={"destination_url": "{directory}/hg-remotes/static"}
+    )
+
+    assert not mapping.is_dynamic
+    assert resolve_destination_urls(
+        [mapping], mapping.source_url, branches=[], tags=[]
+    ) == ["{directory}/hg-remotes/static"]
+    assert (
+        resolve_destination_urls([mapping], "not-a-match", branches=[], tags=[]) == []
+    )
+
+
 @pytest.mark.parametrize(
     "field_name",
     (
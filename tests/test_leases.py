@@ -0,0 +1,48 @@
+import time
+from pathlib import Path
+
+from git_hg_sync.leases import FileLeaseManager
+
+
+def test_file_lease_exclusive(tmp_path: Path) -> None:
+    first = FileLeaseManager(tmp_path, "first", ttl=60)
+    second = FileLeaseManager(tmp_path, "second", ttl=60)
+
+    assert first.acquire("ssh://git.example/firefox")
+    # Renewing a held lease succeeds.
+    assert first.acquire("ssh://git.example/firefox")
+    assert not second.acquire("ssh://git.example/firefox")
+    # Leases are per name.
+    assert second.acquire("ssh://git.example/thunderbird")
+
+    assert first.held() == ["ssh://git.example/firefox"]
+    assert second.held() == ["ssh://git.example/thunderbird"]
+
+    first.release_all()
+    assert first.held() == []
+    assert second.acquire("ssh://git.example/firefox")
+
+
+def test_file_lease_expiry(tmp_path: Path) -> None:
+    dead = FileLeaseManager(tmp_path, "dead", ttl=0.1)
+    alive = FileLeaseManager(tmp_path, "alive", ttl=60)
+
+    assert dead.acquire("firefox")
+    assert not alive.acquire("firefox")
+
+    time.sleep(0.2)
+    assert alive.acquire("firefox")
+
+    # The previous holder notices it lost the lease.
+    assert not dead.acquire("firefox")
+    assert dead.held() == []
+
+
+def test_file_lease_release_only_own(tmp_path: Path) -> None:
+    first = FileLeaseManager(tmp_path, "first", ttl=60)
+    second = FileLeaseManager(tmp_path, "second", ttl=60)
+
+    assert first.acquire("firefox")
+    second.release("firefox")
+
+    assert not second.acquire("firefox")
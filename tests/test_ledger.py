@@ -0,0 +1,45 @@
+import time
+from pathlib import Path
+from unittest import mock
+
+from git_hg_sync.ledger import Ledger
+
+
+def test_ledger_record(tmp_path: Path) -> None:
+    ledger = Ledger(tmp_path / "ledger.db")
+
+    ledger.record("repo.git", 1, "hg-remotes/central", {"a" * 40: "1" * 40})
+    ledger.record("repo.git", 1, "hg-remotes/beta", {"a" * 40: "2" * 40})
+    ledger.record("repo.git", 2, "hg-remotes/central", {"b" * 40: "3" * 40})
+    ledger.record("other.git", 1, "hg-remotes/other", {})
+
+    assert ledger.synced_destinations("repo.git", 1) == {
+        "hg-remotes/central",
+        "hg-remotes/beta",
+    }
+    assert ledger.synced_destinations("repo.git", 3) == set()
+
+    # The ledger persists across instances.
+    entries = Ledger(tmp_path / "ledger.db").entries("repo.git")
+    assert [(entry.push_id, entry.destination_url) for entry in entries] == [
+        (2, "hg-remotes/central"),
+        (1, "hg-remotes/beta"),
+        (1, "hg-remotes/central"),
+    ]
+    assert entries[0].hg_shas == {"b" * 40: "3" * 40}
+    assert len(ledger.entries(push_id=1)) == 3
+    # Pushes synced to several destinations count once.
+    assert ledger.synced_pushes(since=0) == 3
+    assert ledger.synced_pushes(since=time.time() + 1) == 0
+    assert len(ledger.entries(limit=1)) == 1
+
+
+def test_ledger_compact(tmp_path: Path) -> None:
+    ledger = Ledger(tmp_path / "ledger.db")
+    with mock.patch("time.time", return_value=time.time() - 3600):
+        ledger.record("repo.git", 1, "hg-remotes/central", {})
+    ledger.record("repo.git", 2, "hg-remotes/central", {})
+
+    assert ledger.compact(max_age=60) == 1
+
+    assert [entry.push_id for entry in ledger.entries()] == [2]
@@ -0,0 +1,133 @@
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from git_hg_sync.limiter import AdaptiveLimiter, HostLimiters
+from git_hg_sync.metrics import metrics
+
+
+def _run(limiter: AdaptiveLimiter, *, fail: bool = False) -> None:
+    try:
+        with limiter.acquire():
+            if fail:
+                raise RuntimeError("push failed")
+    except RuntimeError:
+        pass
+
+
+def test_adaptive_limiter_aimd() -> None:
+    metrics.reset()
+    limiter = AdaptiveLimiter("hg.example", initial_limit=2, max_limit=4)
+
+    # The limit grows by one after a full limit of successes.
+    for _ in range(3):
+        _run(limiter)
+    assert limiter.limit == 3
+    for _ in range(20):
+        _run(limiter)
+    assert limiter.limit == 4
+
+    _run(limiter, fail=True)
+    assert limiter.limit == 2
+    _run(limiter, fail=True)
+    assert limiter.limit == 1
+    assert metrics.snapshot()["gauges"]["concurrency.limit.hg_example"] == 1
+
+
+def test_adaptive_limiter_slow_operation() -> None:
+    limiter = AdaptiveLimiter("hg.example", initial_limit=4, latency_threshold=0)
+
+    _run(limiter)
+
+    assert limiter.limit == 2
+
+
+def test_adaptive_limiter_decreases_once_per_burst() -> None:
+    limiter = AdaptiveLimiter("hg.example", initial_limit=4)
+
+    # Both operations started before the first failure.
+    with pytest.raises(RuntimeError), limiter.acquire():
+        with pytest.raises(RuntimeError), limiter.acquire():
+            raise RuntimeError("push failed")
+        raise RuntimeError("push failed")
+
+    assert limiter.limit == 2
+
+
+def test_adaptive_limiter_waits_below_limit() -> None:
+    metrics.reset()
+    limiter = AdaptiveLimiter("hg.example", initial_limit=1)
+    waiting = threading.Event()
+    acquired = threading.Event()
+
+    def acquire() -> None:
+        waiting.set()
+        with limiter.acquire():
+            acquired.set()
+
+    with limiter.acquire():
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        waiting.wait(timeout=5)
+        assert not acquired.wait(timeout=0.1)
+    thread.join(timeout=5)
+
+    assert acquired.is_set()
+    queue_delay = metrics.snapshot()["timings"]["concurrency.queue_delay.hg_example"]
+    assert queue_delay["count"] == 2
+    assert queue_delay["max"] >= 0.1
+
+
+def test_adaptive_limiters_share_slots(tmp_path: Path) -> None:
+    # Limiters of separate workers, whose flocks exclude each other like processes.
+    limiters = [
+        AdaptiveLimiter(
+            "hg.example",
+            initial_limit=1,
+            slot_directory=tmp_path / "concurrency",
+            slot_poll_interval=0.05,
+        )
+        for _ in range(2)
+    ]
+    waiting = threading.Event()
+    acquired = threading.Event()
+
+    def acquire() -> None:
+        waiting.set()
+        with limiters[1].acquire():
+            acquired.set()
+
+    with limiters[0].acquire():
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        waiting.wait(timeout=5)
+        assert not acquired.wait(timeout=0.2)
+    thread.join(timeout=5)
+
+    assert acquired.is_set()
+    assert (tmp_path / "concurrency" / "hg_example.0").exists()
+
+
+def test_adaptive_limiter_uses_first_limit_slots(tmp_path: Path) -> None:
+    limiter = AdaptiveLimiter(
+        "hg.example", initial_limit=2, slot_directory=tmp_path, slot_poll_interval=0.05
+    )
+    start = time.monotonic()
+
+    with limiter.acquire(), limiter.acquire():
+        assert time.monotonic() - start < 1
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "hg_example.0",
+        "hg_example.1",
+    ]
+
+
+def test_host_limiters() -> None:
+    limiters = HostLimiters(initial_limit=3)
+
+    limiter = limiters.for_destination("hg::ssh://hg.example/mozilla-central")
+    assert limiter is limiters.for_destination("ssh://hg.example/mozilla-beta")
+    assert limiter.limit == 3
+    assert limiters.for_destination("hg-remotes/beta").name == "hg-remotes/beta"
@@ -0,0 +1,74 @@
+import threading
+import time
+from pathlib import Path
+
+from git_hg_sync.locks import CloneLock
+from git_hg_sync.metrics import metrics
+
+
+def _hold(lock_context: CloneLock, mode: str, held: threading.Event) -> None:
+    with getattr(lock_context, mode)():
+        held.set()
+        time.sleep(0.2)
+
+
+def test_exclusive_lock_excludes_other_holders(tmp_path: Path) -> None:
+    clone_directory = tmp_path / "clones" / "myrepo"
+    held = threading.Event()
+    holder = threading.Thread(
+        target=_hold, args=(CloneLock(clone_directory), "exclusive", held)
+    )
+    holder.start()
+    held.wait()
+
+    start = time.monotonic()
+    with CloneLock(clone_directory).shared():
+        waited = time.monotonic() - start
+    holder.join()
+
+    assert waited >= 0.1
+    assert (tmp_path / "clones" / ".myrepo.lock").exists()
+    assert not clone_directory.exists()
+
+
+def test_shared_locks_are_shared(tmp_path: Path) -> None:
+    clone_directory = tmp_path / "myrepo"
+    held = threading.Event()
+    holder = threading.Thread(
+        target=_hold, args=(CloneLock(clone_directory), "shared", held)
+    )
+    holder.start()
+    held.wait()
+
+    start = time.monotonic()
+    with CloneLock(clone_directory).shared():
+        waited = time.monotonic() - start
+    holder.join()
+
+    assert waited < 0.1
+
+
+def test_locks_are_per_clone(tmp_path: Path) -> None:
+    held = threading.Event()
+    holder = threading.Thread(
+        target=_hold, args=(CloneLock(tmp_path / "one"), "exclusive", held)
+    )
+    holder.start()
+    held.wait()
+
+    start = time.monotonic()
+    with CloneLock(tmp_path / "two").exclusive():
+        waited = time.monotonic() - start
+    holder.join()
+
+    assert waited < 0.1
+
+
+def test_lock_wait_metrics(tmp_path: Path) -> None:
+    metrics.reset()
+
+    with CloneLock(tmp_path / "myrepo").exclusive():
+        pass
+
+    timings = metrics.snapshot()["timings"]
+    assert timings["clone_lock.exclusive.wait.myrepo"]["count"] == 1
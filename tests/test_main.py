@@ -0,0 +1,21 @@
+from pathlib import Path
+
+from git_hg_sync.__main__ import get_synchronizers
+from git_hg_sync.config import Config
+
+HERE = Path(__file__).parent
+
+
+def test_get_synchronizers_reuse() -> None:
+    config = Config.from_file(HERE / "data" / "config.toml")
+    current = get_synchronizers(config)
+
+    moved = config.model_copy(
+        update={"clones": config.clones.model_copy(update={"directory": Path("new")})}
+    )
+
+    for url, synchronizer in get_synchronizers(config, current).items():
+        assert synchronizer is current[url]
+    for url, synchronizer in get_synchronizers(moved, current).items():
+        assert synchronizer is not current[url]
+        assert synchronizer.clone_directory.parent == Path("new")
@@ -0,0 +1,96 @@
+import subprocess
+import sys
+from unittest import mock
+
+import pytest
+
+from git_hg_sync.metrics import metrics
+from git_hg_sync.output import Progress, parse_progress, stream_output
+
+
+@pytest.mark.parametrize(
+    ("line", "progress"),
+    [
+        (
+            "Receiving objects:  45% (4500/10000), 1.50 MiB | 512.00 KiB/s",
+            Progress("Receiving objects", 4500, 10000, 1.5 * 2**20, 512 * 2**10),
+        ),
+        (
+            "remote: Compressing objects: 100% (12/12), done.",
+            Progress("Compressing objects", 12, 12),
+        ),
+        (
+            "remote: Enumerating objects: 1234, done.",
+            Progress("Enumerating objects", 1234),
+        ),
+        ("Reading 42 changesets", Progress("Reading changesets", 42)),
+        (
+            "Reading and importing 7 manifests",
+            Progress("Reading and importing manifests", 7),
+        ),
+        ("From hg::https://hg.mozilla.org/mozilla-unified", None),
+        ("error: some error: 1", None),
+    ],
+)
+def test_parse_progress(line: str, progress: Progress | None) -> None:
+    assert parse_progress(line) == progress
+
+
+def test_stream_output() -> None:
+    metrics.reset()
+    script = "\n".join(
+        [
+            "import sys",
+            "for i in range(100):",
+            "    sys.stderr.write(f'Receiving objects: {i}% ({i}/100)\\r')",
+            "sys.stderr.write('Receiving objects: 100% (100/100), done.\\n')",
+            "for i in range(20):",
+            "    print(f'line {i}')",
+            "print('no newline', end='')",
+        ]
+    )
+    proc = subprocess.Popen(
+        [sys.executable, "-c", script], stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+
+    with mock.patch("git_hg_sync.output.logger") as logger:
+        stdout, stderr = stream_output(proc, "clone: fetch", max_lines=10)
+    proc.wait()
+
+    logged = [call.args[0] for call in logger.info.call_args_list]
+    # The first and last progress updates, then the first lines, up to the limit.
+    assert "clone: fetch/STDERR: Receiving objects: 0% (0/100)" in logged
+    assert "clone: fetch/STDERR: Receiving objects: 100% (100/100), done." in logged
+    assert "clone: fetch/STDOUT: line 0" in logged
+    assert "clone: fetch/STDOUT: no newline" not in logged
+    assert len(logged) == 11
+    assert logged[-1] == "clone: fetch: 13 output lines not logged"
+    gauges = metrics.snapshot()["gauges"]
+    assert gauges["git.progress.clone_fetch.receiving_objects.done"] == 100
+    # The other lines are returned, like by `communicate`.
+    assert stdout.splitlines() == [f"line {i}".encode() for i in range(20)] + [
+        b"no newline"
+    ]
+    assert stderr == b""
+
+
+def test_stream_output_quiet_timeout() -> None:
+    script = (
+        "import sys, time; print('Receiving objects: 1', flush=True); time.sleep(30)"
+    )
+    proc = subprocess.Popen(
+        [sys.executable, "-c", script], stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+
+    with (
+        mock.patch("git_hg_sync.output.logger") as logger,
+        mock.patch("git_hg_sync.output.status") as status,
+        pytest.raises(subprocess.TimeoutExpired),
+    ):
+        stream_output(proc, "clone: fetch", max_lines=0, timeout=0.5)
+    proc.kill()
+    proc.communicate()
+
+    logger.info.assert_not_called()
+    status.set_progress.assert_called_once_with("clone: fetch", "Receiving objects: 1")
+    status.clear_progress.assert_called_once_with("clone: fetch")
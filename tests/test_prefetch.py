@@ -0,0 +1,110 @@
+import contextlib
+import threading
+import time
+from pathlib import Path
+from unittest import mock
+
+from git_hg_sync.prefetch import FetchJob, fetch_remotes
+
+
+class FakeSynchronizer:
+    """Record the fetches happening in each clone, and how many ran concurrently."""
+
+    def __init__(self, clone_directory: Path, tracker: dict) -> None:
+        self.clone_directory = clone_directory
+        self._tracker = tracker
+        self.fetched: list[str] = []
+
+    def clone_directory_for(self, _destination_url: str | None) -> Path:
+        return self.clone_directory
+
+    def lock_clone(
+        self, _destination_url: str | None = None
+    ) -> contextlib.AbstractContextManager:
+        return contextlib.nullcontext()
+
+    def get_clone_repo(self, _destination_url: str | None = None) -> mock.MagicMock:
+        return mock.MagicMock()
+
+    def fetch_all_from_remote(
+        self,
+        _repo: mock.MagicMock,
+        remote: str,
+        _verbose: bool = False,
+    ) -> None:
+        with self._tracker["lock"]:
+            self._tracker["running"][self.clone_directory] += 1
+            self._tracker["max_per_clone"] = max(
+                self._tracker["max_per_clone"],
+                self._tracker["running"][self.clone_directory],
+            )
+            self._tracker["total"] += 1
+            self._tracker["max_total"] = max(
+                self._tracker["max_total"], self._tracker["total"]
+            )
+        try:
+            time.sleep(0.05)
+            if "broken" in remote:
+                raise RuntimeError("fetch failed")
+            self.fetched.append(remote)
+        finally:
+            with self._tracker["lock"]:
+                self._tracker["running"][self.clone_directory] -= 1
+                self._tracker["total"] -= 1
+
+
+def _tracker(clones: list[Path]) -> dict:
+    return {
+        "lock": threading.Lock(),
+        "running": dict.fromkeys(clones, 0),
+        "max_per_clone": 0,
+        "total": 0,
+        "max_total": 0,
+    }
+
+
+def test_fetch_remotes_serialises_per_clone(tmp_path: Path) -> None:
+    clones = [tmp_path / "one", tmp_path / "two", tmp_path / "three"]
+    tracker = _tracker(clones)
+    synchronizers = [FakeSynchronizer(clone, tracker) for clone in clones]
+
+    jobs = [
+        FetchJob(synchronizer, f"hg::remote-{i}")
+        for i in range(3)
+        for synchronizer in synchronizers
+    ]
+
+    results = fetch_remotes(jobs, max_workers=3)
+
+    assert [result.job for result in results] == jobs
+    assert all(result.succeeded for result in results)
+    assert tracker["max_per_clone"] == 1, "Concurrent fetches ran in the same clone"
+    assert tracker["max_total"] > 1, "Clones were not fetched concurrently"
+    for synchronizer in synchronizers:
+        assert synchronizer.fetched == ["hg::remote-0", "hg::remote-1", "hg::remote-2"]
+
+
+def test_fetch_remotes_concurrency_limit(tmp_path: Path) -> None:
+    clones = [tmp_path / f"clone-{i}" for i in range(4)]
+    tracker = _tracker(clones)
+    jobs = [FetchJob(FakeSynchronizer(clone, tracker), "remote") for clone in clones]
+
+    fetch_remotes(jobs, max_workers=2)
+
+    assert tracker["max_total"] <= 2
+
+
+def test_fetch_remotes_reports_failures(tmp_path: Path) -> None:
+    tracker = _tracker([tmp_path])
+    synchronizer = FakeSynchronizer(tmp_path, tracker)
+    jobs = [
+        FetchJob(synchronizer, "hg::broken"),
+        FetchJob(synchronizer, "hg::working"),
+    ]
+
+    results = fetch_remotes(jobs)
+
+    assert not results[0].succeeded
+    assert isinstance(results[0].error, RuntimeError)
+    assert results[1].succeeded
+    assert synchronizer.fetched == ["hg::working"]
@@ -1,13 +1,22 @@
 import signal
+import threading
 import time
+from collections.abc import Callable
 from pathlib import Path
 from subprocess import PIPE, Popen
+from unittest import mock
 
+import kombu
 import pytest
 from pydantic import ValidationError
 
-from git_hg_sync.events import Push
-from git_hg_sync.pulse_worker import EntityTypeError, PulseWorker
+from git_hg_sync.events import Event, Push
+from git_hg_sync.pulse_worker import (
+    EntityTypeError,
+    Lane,
+    MessageDeferredError,
+    PulseWorker,
+)
 
 HERE = Path(__file__).parent
 
@@ -29,6 +38,8 @@ def raw_push_entity() -> dict:
 def test_parse_entity_valid(raw_push_entity: dict) -> None:
     push_entity = PulseWorker.parse_entity(raw_push_entity)
     assert isinstance(push_entity, Push)
+    # The payload is left untouched, e.g. to be parked.
+    assert raw_push_entity["type"] == "push"
 
 
 def test_parse_invalid_type(raw_push_entity: dict) -> None:
@@ -81,3 +92,283 @@ def test_sigint_signal_interception() -> None:
     except AssertionError as e:
         process.kill()
         raise e
+
+
+def _wait_for_messages(worker: PulseWorker, messages: list[mock.MagicMock]) -> None:
+    """Run the iterations of the consumer loop until all messages are settled."""
+    deadline = time.monotonic() + 5
+    while not all(message.ack.called or message.requeue.called for message in messages):
+        assert time.monotonic() < deadline, "Messages were not acknowledged in time"
+        worker.on_iteration()
+        time.sleep(0.01)
+
+
+def _pipelined_worker(handle: Callable[[Event], None], calls: list[str]) -> PulseWorker:
+    worker = PulseWorker(mock.MagicMock(), mock.MagicMock(), lookahead=1)
+
+    def prepare(event: Event) -> Callable[[], None]:
+        calls.append(f"prepare {event.push_id}")
+
+        def handle_prepared() -> None:
+            handle(event)
+            calls.append(f"handle {event.push_id}")
+
+        return handle_prepared
+
+    worker.event_preparer = prepare
+    return worker
+
+
+def test_pipeline_prepares_next_message(raw_push_entity: dict) -> None:
+    calls: list[str] = []
+    next_prepared = threading.Event()
+
+    def handle(event: Event) -> None:
+        if event.push_id == 0:
+            # The next message needs to be prepared to get past this.
+            assert next_prepared.wait(timeout=5)
+
+    worker = _pipelined_worker(handle, calls)
+    messages = [mock.MagicMock(), mock.MagicMock()]
+    for push_id, message in enumerate(messages):
+        worker.on_task({"payload": {**raw_push_entity, "push_id": push_id}}, message)
+    while "prepare 1" not in calls:
+        time.sleep(0.01)
+    next_prepared.set()
+
+    _wait_for_messages(worker, messages)
+
+    assert calls == ["prepare 0", "prepare 1", "handle 0", "handle 1"]
+    for message in messages:
+        message.ack.assert_called_once()
+        message.requeue.assert_not_called()
+
+
+def test_pipeline_failure_requeues_prepared(raw_push_entity: dict) -> None:
+    calls: list[str] = []
+    next_prepared = threading.Event()
+
+    def handle(event: Event) -> None:
+        assert next_prepared.wait(timeout=5)
+        raise RuntimeError(f"push {event.push_id} failed")
+
+    worker = _pipelined_worker(handle, calls)
+    messages = [mock.MagicMock(), mock.MagicMock()]
+    for push_id, message in enumerate(messages):
+        worker.on_task({"payload": {**raw_push_entity, "push_id": push_id}}, message)
+    while "prepare 1" not in calls:
+        time.sleep(0.01)
+    next_prepared.set()
+
+    _wait_for_messages(worker, messages)
+
+    # The prepared message is not handled, but put back behind the failed one.
+    assert calls == ["prepare 0", "prepare 1"]
+    for message in messages:
+        message.requeue.assert_called_once()
+        message.ack.assert_not_called()
+    assert worker.should_stop is False
+
+
+def test_handle_in_background(raw_push_entity: dict) -> None:
+    handling = threading.Event()
+    release = threading.Event()
+    settled_from = []
+
+    def handle(_event: Event) -> None:
+        handling.set()
+        assert release.wait(timeout=5)
+
+    worker = PulseWorker(mock.MagicMock(), mock.MagicMock())
+    worker.event_handler = handle
+    message = mock.MagicMock()
+    message.ack.side_effect = lambda: settled_from.append(threading.current_thread())
+
+    # The consumer thread isn't blocked while the event is handled.
+    worker.on_task({"payload": raw_push_entity}, message)
+    assert handling.wait(timeout=5)
+    worker.on_iteration()
+    message.ack.assert_not_called()
+
+    release.set()
+    _wait_for_messages(worker, [message])
+
+    # Messages are acknowledged from the consumer thread.
+    assert settled_from == [threading.current_thread()]
+
+
+def test_reconnect_while_handling(raw_push_entity: dict) -> None:
+    handling = threading.Event()
+    release = threading.Event()
+    handled = []
+
+    def handle(event: Event) -> None:
+        handling.set()
+        assert release.wait(timeout=5)
+        handled.append(event.push_id)
+
+    worker = PulseWorker(mock.MagicMock(), mock.MagicMock())
+    worker.event_handler = handle
+    messages = [mock.MagicMock(), mock.MagicMock()]
+    for push_id, message in enumerate(messages):
+        worker.on_task({"payload": {**raw_push_entity, "push_id": push_id}}, message)
+    assert handling.wait(timeout=5)
+
+    worker.on_consume_ready(mock.MagicMock(), mock.MagicMock(), [])
+    release.set()
+    worker.should_stop = True
+    deadline = time.monotonic() + 5
+    while not worker.should_stop:
+        assert time.monotonic() < deadline
+        worker.on_iteration()
+        time.sleep(0.01)
+
+    # The broker requeued the messages of the lost connection, so they are left alone,
+    # and the next one isn't handled before being received again.
+    assert handled == [0]
+    for message in messages:
+        message.ack.assert_not_called()
+        message.requeue.assert_not_called()
+
+
+def test_pipeline_priorities(raw_push_entity: dict) -> None:
+    lanes = {
+        0: Lane(0, frozenset(["hg/autoland"])),
+        1: Lane(0, frozenset(["hg/beta"])),
+        # Can't go before the previous message, which has the same destination.
+        2: Lane(10, frozenset(["hg/beta"])),
+        3: Lane(5, frozenset(["hg/release"])),
+    }
+    calls: list[str] = []
+    release = threading.Event()
+
+    def handle(event: Event) -> None:
+        if event.push_id == 0:
+            assert release.wait(timeout=5)
+
+    worker = _pipelined_worker(handle, calls)
+    worker.lookahead = 3
+    worker.event_lane = lambda event: lanes[event.push_id]
+    messages = [mock.MagicMock() for _ in lanes]
+    for push_id, message in enumerate(messages):
+        worker.on_task({"payload": {**raw_push_entity, "push_id": push_id}}, message)
+    release.set()
+
+    _wait_for_messages(worker, messages)
+
+    assert [call for call in calls if call.startswith("handle")] == [
+        "handle 0",
+        "handle 3",
+        "handle 1",
+        "handle 2",
+    ]
+    for message in messages:
+        message.ack.assert_called_once()
+
+
+def test_failure_requeue_delay(raw_push_entity: dict) -> None:
+    def handle(_event: Event) -> None:
+        raise RuntimeError("push failed")
+
+    worker = PulseWorker(mock.MagicMock(), mock.MagicMock(), retry_delay=0.2)
+    worker.event_handler = handle
+    message = mock.MagicMock()
+
+    # The delay doubles each time the same message fails.
+    for delay in (0.2, 0.4):
+        message.reset_mock()
+        start = time.monotonic()
+        worker.on_task({"payload": dict(raw_push_entity)}, message)
+        _wait_for_messages(worker, [message])
+        assert time.monotonic() - start >= delay
+        message.requeue.assert_called_once()
+
+
+def test_failure_parks_message(raw_push_entity: dict) -> None:
+    def handle(_event: Event) -> None:
+        raise RuntimeError("push failed")
+
+    connection = kombu.Connection("memory://")
+    parking_queue = kombu.Queue("queue/parked", routing_key="queue/parked")
+    queue = mock.MagicMock()
+    queue.name = "queue"
+    worker = PulseWorker(connection, queue, max_attempts=2, parking_queue=parking_queue)
+    worker.event_handler = handle
+    settled: list[Event] = []
+    worker.event_settled = settled.append
+    message = mock.MagicMock()
+    message.channel = connection.default_channel
+    body = {"payload": raw_push_entity}
+
+    worker.on_task(dict(body), message)
+    _wait_for_messages(worker, [message])
+    message.requeue.assert_called_once()
+    assert settled == []
+
+    message.reset_mock()
+    worker.on_task(dict(body), message)
+    _wait_for_messages(worker, [message])
+
+    # After the last attempt, the message is acknowledged and parked.
+    message.requeue.assert_not_called()
+    assert [event.push_id for event in settled] == [raw_push_entity["push_id"]]
+    parked = connection.SimpleQueue(parking_queue).get(timeout=1).payload
+    assert parked["message"] == body
+    assert parked["queue"] == "queue"
+    assert parked["attempts"] == 2
+    assert "RuntimeError: push failed" in parked["error"]
+
+
+def test_parks_on_consumer_connection(raw_push_entity: dict) -> None:
+    def handle(_event: Event) -> None:
+        raise RuntimeError("push failed")
+
+    queue = kombu.Queue("queue/parks", routing_key="queue/parks")
+    parking_queue = kombu.Queue("queue/parks/parked", routing_key="queue/parks/parked")
+    with kombu.Connection("memory://") as connection:
+        queue(connection).declare()
+        connection.Producer(serializer="json").publish(
+            {"payload": raw_push_entity}, exchange="", routing_key=queue.name
+        )
+
+    connection = kombu.Connection("memory://")
+    worker = PulseWorker(connection, queue, max_attempts=1, parking_queue=parking_queue)
+    worker.event_handler = handle
+    worker.event_settled = lambda _event: setattr(worker, "should_stop", True)
+    # The connection given to the worker was dropped while the consumer, on its own
+    # clone of it, was idle.
+    with mock.patch.object(
+        connection, "Producer", side_effect=ConnectionError("connection dropped")
+    ):
+        thread = threading.Thread(target=worker.run, daemon=True)
+        thread.start()
+        thread.join(timeout=5)
+    assert not thread.is_alive()
+
+    with kombu.Connection("memory://") as connection:
+        parked = connection.SimpleQueue(parking_queue).get(timeout=1).payload
+        assert parked["message"] == {"payload": raw_push_entity}
+        assert parked["queue"] == queue.name
+        assert connection.SimpleQueue(queue).qsize() == 0
+
+
+def test_deferred_message_not_parked(raw_push_entity: dict) -> None:
+    def handle(_event: Event) -> None:
+        raise MessageDeferredError
+
+    worker = PulseWorker(
+        mock.MagicMock(),
+        mock.MagicMock(),
+        retry_delay=60,
+        max_attempts=1,
+        parking_queue=mock.MagicMock(),
+    )
+    worker.event_handler = handle
+    message = mock.MagicMock()
+
+    for _ in range(2):
+        message.reset_mock()
+        worker.on_task({"payload": dict(raw_push_entity)}, message)
+        _wait_for_messages(worker, [message])
+        # Requeued straight away.
+        message.requeue.assert_called_once()
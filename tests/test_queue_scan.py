@@ -0,0 +1,144 @@
+from collections.abc import Iterator
+from typing import Any
+from unittest import mock
+
+import kombu
+import pytest
+from kombu.simple import SimpleQueue
+
+from git_hg_sync.events import Push
+from git_hg_sync.mapping import BranchMapping
+from git_hg_sync.queue_scan import PushFilter, queue_stats, scan_queue
+
+
+def push_body(push_id: int, **kwargs: Any) -> dict:
+    return {
+        "payload": {
+            "type": "push",
+            "repo_url": kwargs.get("repo_url", "repo_url"),
+            "branches": {kwargs.get("branch", "main"): "acommitsha"},
+            "time": kwargs.get("time", 0),
+            "push_id": push_id,
+            "user": kwargs.get("user", "user"),
+            "push_json_url": "push_json_url",
+        }
+    }
+
+
+@pytest.fixture
+def queue() -> Iterator[SimpleQueue]:
+    with kombu.Connection("memory://") as connection:
+        queue = connection.SimpleQueue(f"queue-{id(connection)}")
+        yield queue
+        queue.close()
+
+
+def drain(queue: SimpleQueue) -> list:
+    payloads = []
+    while True:
+        try:
+            message = queue.get(block=False)
+        except queue.Empty:
+            return payloads
+        payloads.append(message.payload)
+        message.ack()
+
+
+def test_push_filter() -> None:
+    push = Push(**push_body(5, user="alice", branch="beta")["payload"])
+
+    assert not PushFilter()
+    assert PushFilter(min_push_id=3, max_push_id=5, user="alice").matches(push)
+    assert PushFilter(repo_url="repo_url", branch="beta").matches(push)
+    assert not PushFilter(min_push_id=6).matches(push)
+    assert not PushFilter(user="bob").matches(push)
+    assert not PushFilter(branch="main").matches(push)
+    assert not PushFilter(user="alice").matches(None)
+
+
+def test_scan_queue_removes_matching_messages(queue: SimpleQueue) -> None:
+    bodies = [
+        push_body(1),
+        push_body(2, user="bob"),
+        "not json",
+        push_body(3),
+        push_body(4, user="bob"),
+        push_body(5),
+    ]
+    for body in bodies:
+        queue.put(body)
+
+    scanned = scan_queue(queue, PushFilter(user="bob", min_push_id=2).matches)
+
+    assert [message.removed for message in scanned] == [
+        False,
+        True,
+        False,
+        False,
+        True,
+        False,
+    ]
+    assert scanned[2].event is None
+    # The other messages are back in their original order.
+    assert drain(queue) == [bodies[0], bodies[2], bodies[3], bodies[5]]
+
+
+def test_scan_queue_stops_after_max_messages(queue: SimpleQueue) -> None:
+    bodies = [push_body(push_id) for push_id in range(5)]
+    for body in bodies:
+        queue.put(body)
+
+    scanned = scan_queue(queue, lambda _event: True, max_messages=2)
+
+    assert len(scanned) == 2
+    assert drain(queue) == bodies[2:]
+
+
+def test_scan_queue_requeues_all_on_error(queue: SimpleQueue) -> None:
+    bodies = [push_body(push_id) for push_id in range(3)]
+    for body in bodies:
+        queue.put(body)
+    remove = mock.Mock(side_effect=[True, False, RuntimeError("failed")])
+
+    with pytest.raises(RuntimeError):
+        scan_queue(queue, remove)
+
+    assert drain(queue) == bodies
+
+
+def test_queue_stats(queue: SimpleQueue) -> None:
+    bodies = [
+        push_body(1, time=1000),
+        push_body(2, time=1100, branch="beta"),
+        push_body(3, repo_url="other_url", time=1200),
+        "not json",
+    ]
+    for body in bodies:
+        queue.put(body)
+    mappings = [
+        BranchMapping(
+            branch_pattern="^(main|beta)$",
+            source_url="repo_url",
+            destination_url="hg/\\1",
+            destination_branch="default",
+        )
+    ]
+
+    stats = queue_stats(scan_queue(queue), mappings, throughput=0.5, now=1500)
+
+    assert stats == {
+        "depth": 4,
+        "invalid": 1,
+        "truncated": False,
+        "repositories": {
+            "repo_url": {"depth": 2, "oldest_push_time": 1000},
+            "other_url": {"depth": 1, "oldest_push_time": 1200},
+        },
+        "destinations": {"hg/main": 1, "hg/beta": 1},
+        "oldest_push_time": 1000,
+        "lag": 500,
+        "throughput": 0.5,
+        "drain_time": 8,
+    }
+    # Reading the messages leaves them in the queue.
+    assert drain(queue) == bodies
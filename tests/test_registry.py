@@ -0,0 +1,26 @@
+from pathlib import Path
+
+from git_hg_sync.registry import ProcessRegistry
+
+
+def test_process_registry(tmp_path: Path) -> None:
+    registry = ProcessRegistry(tmp_path / "registry")
+    assert registry.pids() == {}
+    assert not registry.is_ready()
+
+    registry.register("worker-firefox", pid=1234)
+    registry.register("worker-thunderbird", pid=5678)
+    assert registry.pids() == {"worker-firefox": 1234, "worker-thunderbird": 5678}
+
+    registry.mark_ready("worker-firefox")
+    assert not registry.is_ready(), "Ready while a process is still warming up"
+    registry.mark_ready("worker-thunderbird")
+    assert registry.is_ready()
+
+    # Registering again (e.g. after a restart) resets the readiness.
+    registry.register("worker-firefox", pid=4321)
+    assert not registry.is_ready()
+
+    registry.unregister("worker-firefox")
+    assert registry.pids() == {"worker-thunderbird": 5678}
+    assert registry.is_ready()
@@ -10,9 +10,10 @@ from utils import hg_cat, hg_log, hg_rev
 
 from git_hg_sync import repo_synchronizer
 from git_hg_sync.__main__ import get_connection, get_queue
-from git_hg_sync.config import PulseConfig, TrackedRepository
+from git_hg_sync.config import CloneShard, PulseConfig, TrackedRepository
 from git_hg_sync.mapping import SyncBranchOperation, SyncTagOperation
-from git_hg_sync.repo_synchronizer import RepoSynchronizer
+from git_hg_sync.repo_synchronizer import ExecutionContext, RepoSynchronizer
+from git_hg_sync.watchdog import run_git
 
 
 @pytest.fixture
@@ -314,9 +315,145 @@ def test_sync_process_multiple_destinations(
     assert tag in tag_log
 
 
+@pytest.mark.parametrize(
+    "request_user,author_name",
+    (
+        ("request_user@example.com", "request_user"),
+        ("request_user", "request_user"),
+    ),
+)
+def test_execution_context_env(request_user: str, author_name: str) -> None:
+    env = ExecutionContext(request_user).env
+
+    assert env == {
+        "AUTOLAND_REQUEST_USER": request_user,
+        "GIT_AUTHOR_EMAIL": request_user,
+        "GIT_AUTHOR_NAME": author_name,
+    }
+
+
+def test_list_remote_refs(tmp_path: Path) -> None:
+    git_remote_repo_path = tmp_path / "git-remotes" / "myrepo"
+    repo = Repo.init(git_remote_repo_path, b="main")
+    foo_path = git_remote_repo_path / "foo.txt"
+    foo_path.write_text("FOO CONTENT")
+    repo.index.add([foo_path])
+    commit = repo.index.commit("add foo.txt")
+    repo.create_head("esr128", commit)
+    repo.create_tag("FIREFOX_128_0esr_RELEASE", commit)
+    with repo.config_writer() as config:
+        config.set_value("user", "name", "Tagger")
+        config.set_value("user", "email", "tagger@example.com")
+    repo.create_tag("ANNOTATED", commit, message="annotated tag")
+
+    syncrepos = RepoSynchronizer(
+        tmp_path / "clones" / "myrepo", str(git_remote_repo_path)
+    )
+    branches, tags = syncrepos.list_remote_refs()
+
+    assert sorted(branches) == ["esr128", "main"]
+    assert sorted(tags) == ["ANNOTATED", "FIREFOX_128_0esr_RELEASE"]
+
+
+def test_clone_shards(tmp_path: Path) -> None:
+    git_remote_repo_path = tmp_path / "git-remotes" / "myrepo"
+    repo = Repo.init(git_remote_repo_path)
+    foo_path = git_remote_repo_path / "foo.txt"
+    foo_path.write_text("FOO CONTENT")
+    repo.index.add([foo_path])
+    commit = repo.index.commit("add foo.txt")
+
+    clone_directory = tmp_path / "clones" / "myrepo"
+    syncrepos = RepoSynchronizer(
+        clone_directory,
+        str(git_remote_repo_path),
+        [CloneShard(name="esr", destination_pattern=".*/mozilla-esr\\d+$")],
+    )
+
+    assert syncrepos.clone_directory_for(None) == clone_directory
+    assert syncrepos.clone_directory_for("hg-remotes/mozilla-beta") == clone_directory
+    shard_directory = syncrepos.clone_directory_for("hg-remotes/mozilla-esr128")
+    assert shard_directory == tmp_path / "clones" / "myrepo.esr"
+
+    shard_repo = syncrepos.get_clone_repo("hg-remotes/mozilla-esr128")
+
+    assert Path(shard_repo.git_dir) == shard_directory
+    assert shard_repo.bare
+    # The shard borrows its objects from the primary clone.
+    alternates = shard_directory / "objects" / "info" / "alternates"
+    assert alternates.read_text().strip() == str(clone_directory / "objects")
+    assert shard_repo.commit(commit.hexsha)
+    assert (
+        Repo(clone_directory).config_reader().get_value("gc", "pruneExpire") == "never"
+    )
+
+
 def test_get_connection_and_queue(pulse_config: PulseConfig) -> None:
     connection = get_connection(pulse_config)
     queue = get_queue(pulse_config)
     assert connection.userid == pulse_config.userid
     assert connection.host == f"{pulse_config.host}:{pulse_config.port}"
     assert queue.name == pulse_config.queue
+
+
+def test_prefetch_source_commits(tmp_path: Path) -> None:
+    git_remote_repo_path = tmp_path / "git-remotes" / "myrepo"
+    repo = Repo.init(git_remote_repo_path, b="main")
+    foo_path = git_remote_repo_path / "foo.txt"
+    foo_path.write_text("FOO CONTENT")
+    repo.index.add([foo_path])
+    first_commit = repo.index.commit("add foo.txt")
+
+    clone_directory = tmp_path / "clones" / "myrepo"
+    syncrepos = RepoSynchronizer(clone_directory, str(git_remote_repo_path))
+
+    # Without a clone yet, this is left to the sync.
+    syncrepos.prefetch_source_commits("hg-remotes/mozilla-beta", [first_commit.hexsha])
+    assert not clone_directory.exists()
+
+    clone = syncrepos.get_clone_repo()
+    foo_path.write_text("NEW FOO CONTENT")
+    repo.index.add([foo_path])
+    second_commit = repo.index.commit("update foo.txt")
+
+    syncrepos.prefetch_source_commits(
+        "hg-remotes/mozilla-beta", [first_commit.hexsha, second_commit.hexsha]
+    )
+
+    assert clone.commit(second_commit.hexsha)
+    # Only objects were fetched.
+    assert clone.commit("main") == clone.commit(first_commit.hexsha)
+    assert not (clone_directory / "FETCH_HEAD").exists()
+
+
+def test_sync_already_pushed(tmp_path: Path) -> None:
+    git_remote_repo_path = tmp_path / "git-remotes" / "myrepo"
+    repo = Repo.init(git_remote_repo_path, b="main")
+    foo_path = git_remote_repo_path / "foo.txt"
+    foo_path.write_text("FOO CONTENT")
+    repo.index.add([foo_path])
+    commit = repo.index.commit("add foo.txt")
+
+    syncrepos = RepoSynchronizer(tmp_path / "clones" / "myrepo", str(repo.working_dir))
+    operation = SyncBranchOperation(
+        source_commit=commit.hexsha, destination_branch="default"
+    )
+
+    # The destination branch already points to the commit, e.g. when the sync is
+    # retried after it completed.
+    with (
+        mock.patch.object(RepoSynchronizer, "ensure_cinnabar_metadata"),
+        mock.patch.object(
+            RepoSynchronizer,
+            "_list_destination_branches",
+            return_value={"refs/heads/branches/default/tip": commit.hexsha},
+        ),
+        mock.patch.object(RepoSynchronizer, "_git2hg", return_value="1" * 40),
+        mock.patch(
+            "git_hg_sync.repo_synchronizer.run_git", wraps=run_git
+        ) as mock_run_git,
+    ):
+        hg_shas = syncrepos.sync("hg-remotes/mozilla-beta", [operation], "user")
+
+    assert "push" not in [call.kwargs["stage"] for call in mock_run_git.call_args_list]
+    assert hg_shas == {commit.hexsha: "1" * 40}
@@ -0,0 +1,91 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from git_hg_sync.metrics import metrics
+from git_hg_sync.ssh import SshMultiplexer
+
+# Records its invocations, and emulates a master connection with a state file.
+FAKE_SSH = """
+import os, sys
+from pathlib import Path
+
+state = Path(os.environ["FAKE_SSH_DIR"])
+args = sys.argv[1:]
+if "-O" in args:
+    sys.exit(0 if (state / "master").exists() else 255)
+if "ControlMaster=yes" in args:
+    if (state / "unreachable").exists():
+        print("ssh: connect to host: Connection refused", file=sys.stderr)
+        sys.exit(255)
+    with (state / "log").open("a") as log:
+        log.write("handshake\\n")
+    (state / "master").touch()
+else:
+    with (state / "log").open("a") as log:
+        log.write(f"session {' '.join(args)}\\n")
+"""
+
+
+@pytest.fixture
+def fake_ssh(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    script = tmp_path / "ssh"
+    script.write_text(f"#!{sys.executable}\n{FAKE_SSH}")
+    script.chmod(0o755)
+    monkeypatch.setenv("FAKE_SSH_DIR", str(tmp_path))
+    metrics.reset()
+    return script
+
+
+def _log(tmp_path: Path) -> list[str]:
+    return (tmp_path / "log").read_text().splitlines()
+
+
+def test_ssh_multiplexer(tmp_path: Path, fake_ssh: Path) -> None:
+    ssh = SshMultiplexer(tmp_path / "control", ssh_command=str(fake_ssh))
+
+    assert ssh.env("https://github.com/mozilla-firefox/firefox") == {}
+    ssh.warm(
+        [
+            "ssh://hg.example/mozilla-central",
+            "ssh://hg.example/mozilla-beta",
+            "/local/repo",
+        ]
+    )
+    assert _log(tmp_path) == ["handshake"]
+
+    env = ssh.env("hg::ssh://hg.example/mozilla-central")
+    assert "ControlMaster=no" in env["GIT_SSH_COMMAND"]
+    # Git connects through the master.
+    subprocess.run(
+        ["git", "ls-remote", "ssh://hg.example/mozilla-central"],
+        env={**os.environ, **env},
+        capture_output=True,
+        check=False,
+    )
+    assert _log(tmp_path)[1].startswith(
+        f"session -o ControlMaster=no -o ControlPath={tmp_path / 'control'}/%C"
+    )
+
+    # The master died.
+    (tmp_path / "master").unlink()
+    ssh.check_all()
+    assert _log(tmp_path).count("handshake") == 2
+
+    counters = metrics.snapshot()["counters"]
+    assert counters["ssh.handshakes"] == 2
+    assert counters["ssh.multiplexed"] == 1
+    assert counters["ssh.reconnects"] == 1
+
+
+def test_ssh_multiplexer_unreachable(tmp_path: Path, fake_ssh: Path) -> None:
+    (tmp_path / "unreachable").touch()
+    ssh = SshMultiplexer(tmp_path / "control", ssh_command=str(fake_ssh))
+
+    # Commands still get to connect on their own.
+    assert "GIT_SSH_COMMAND" in ssh.env("ssh://hg.example/mozilla-central")
+    assert metrics.snapshot()["counters"]["ssh.fallbacks"] == 1
+    assert metrics.snapshot()["counters"]["ssh.failures"] == 1
@@ -0,0 +1,68 @@
+import threading
+import time
+
+import pytest
+
+from git_hg_sync.stages import StageGraph
+
+
+def test_stage_graph_runs_independent_stages_concurrently() -> None:
+    running = threading.Barrier(2, timeout=5)
+    calls = []
+
+    def independent(name: str) -> str:
+        # Both stages need to run at the same time to get past this.
+        running.wait()
+        calls.append(name)
+        return name
+
+    stages = StageGraph("test")
+    stages.add("metadata", lambda: independent("metadata"))
+    stages.add("source", lambda: independent("source"))
+    stages.add(
+        "push",
+        lambda: calls.append(f"push {stages.result('source')}"),
+        dependencies=["metadata", "source"],
+    )
+    stages.run()
+
+    assert sorted(calls[:2]) == ["metadata", "source"]
+    assert calls[2] == "push source"
+
+
+def test_stage_graph_critical_path() -> None:
+    stages = StageGraph("test")
+    stages.add("fast", lambda: None)
+    stages.add("slow", lambda: time.sleep(0.1))
+    stages.add("after_fast", lambda: None, dependencies=["fast"])
+    stages.add("last", lambda: None, dependencies=["after_fast", "slow"])
+    stages.run()
+
+    assert [stage.name for stage in stages.critical_path()] == ["slow", "last"]
+    summary = stages.summary()
+    assert "slow 0.1s" in summary
+    assert summary.endswith("critical path: slow > last")
+
+
+def test_stage_graph_failure() -> None:
+    calls = []
+
+    def fail() -> None:
+        raise RuntimeError("fetch failed")
+
+    stages = StageGraph("test")
+    stages.add("fetch", fail)
+    stages.add("independent", lambda: calls.append("independent"))
+    stages.add("push", lambda: calls.append("push"), dependencies=["fetch"])
+
+    with pytest.raises(RuntimeError, match="fetch failed"):
+        stages.run()
+
+    # Stages depending on the failed one don't run.
+    assert "push" not in calls
+
+
+def test_stage_graph_unknown_dependency() -> None:
+    stages = StageGraph("test")
+    with pytest.raises(ValueError, match="Unknown dependencies"):
+        stages.add("push", lambda: None, dependencies=["fetch"])
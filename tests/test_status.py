@@ -0,0 +1,75 @@
+import time
+from pathlib import Path
+
+from git_hg_sync.metrics import Metrics
+from git_hg_sync.registry import ProcessRegistry
+from git_hg_sync.status import HEADER, StatusPublisher, WorkerStatus, read_status
+
+
+def test_worker_status() -> None:
+    status = WorkerStatus()
+
+    status.start_message("Push 1 for repo_url")
+    status.start_stage("sync to hg/central: push")
+    status.start_stage("sync to hg/beta: cinnabar_metadata", stall_check=False)
+    snapshot = status.snapshot()
+    assert snapshot["message"] == "Push 1 for repo_url"
+    assert {
+        name: stage["stall_check"] for name, stage in snapshot["stages"].items()
+    } == {
+        "sync to hg/central: push": True,
+        "sync to hg/beta: cinnabar_metadata": False,
+    }
+    assert snapshot["throughput"] == 0
+
+    status.finish_stage("sync to hg/central: push")
+    status.finish_stage("sync to hg/beta: cinnabar_metadata")
+    status.record_success("hg/central")
+    status.finish_message(succeeded=True)
+    status.start_message("Push 2 for repo_url")
+    status.finish_message(succeeded=False)
+    snapshot = status.snapshot()
+    assert snapshot["message"] is None
+    assert snapshot["stages"] == {}
+    assert list(snapshot["last_success"]) == ["hg/central"]
+    assert snapshot["throughput"] > 0
+
+
+def test_status_publisher(tmp_path: Path) -> None:
+    registry = ProcessRegistry(tmp_path)
+    registry.register("worker")
+    status = WorkerStatus()
+    status.start_message("Push 1 for repo_url")
+    metrics = Metrics()
+    metrics.timing("clone_lock.exclusive.wait.repo", 2)
+
+    with StatusPublisher(
+        registry.status_path("worker"), status, interval=0.01, worker_metrics=metrics
+    ):
+        published = registry.statuses()["worker"]
+        assert published["message"] == "Push 1 for repo_url"
+        # The metrics of the worker are published along with its status.
+        assert published["metrics"]["timings"]["clone_lock.exclusive.wait.repo"] == {
+            "count": 1,
+            "total": 2,
+            "max": 2,
+        }
+
+        status.finish_message(succeeded=True)
+        time.sleep(0.1)
+        assert registry.statuses()["worker"]["message"] is None
+
+    # The status is removed when the worker stops.
+    assert registry.statuses() == {"worker": None}
+
+
+def test_read_status_being_written(tmp_path: Path) -> None:
+    status_path = tmp_path / "worker.status"
+    assert read_status(status_path) is None
+
+    with StatusPublisher(status_path, WorkerStatus()):
+        assert read_status(status_path)
+        # The sequence number is odd while the status is being written.
+        with status_path.open("r+b") as status_file:
+            status_file.write(HEADER.pack(3, 0))
+        assert read_status(status_path, attempts=2) is None
@@ -0,0 +1,139 @@
+import os
+from pathlib import Path
+
+import pytest
+import tomllib
+
+from git_hg_sync.config import Config
+from git_hg_sync.registry import ProcessRegistry
+from git_hg_sync.supervisor import Supervisor, shard_configs
+
+HERE = Path(__file__).parent
+
+
+def _config(**overrides: object) -> Config:
+    config = tomllib.loads((HERE / "data" / "config.toml").read_text())
+    config["tracked_repositories"].append(
+        {"name": "thunderbird", "url": "{directory}/git-remotes/thunderbird"}
+    )
+    config.update(overrides)
+    return Config(**config)
+
+
+def test_shard_configs_default() -> None:
+    configs = shard_configs(_config())
+
+    assert list(configs) == ["firefox-releases", "thunderbird"]
+
+    firefox = configs["firefox-releases"]
+    assert firefox.pulse.queue == "queue/git-hg-sync/test/firefox-releases"
+    assert firefox.pulse.routing_key == "default"
+    assert [repo.name for repo in firefox.tracked_repositories] == ["firefox-releases"]
+    assert firefox.branch_mappings
+    assert firefox.tag_mappings
+
+    thunderbird = configs["thunderbird"]
+    assert thunderbird.pulse.queue == "queue/git-hg-sync/test/thunderbird"
+    assert [repo.name for repo in thunderbird.tracked_repositories] == ["thunderbird"]
+    assert thunderbird.branch_mappings == []
+    assert thunderbird.tag_mappings == []
+
+
+def test_shard_configs_explicit() -> None:
+    config = _config(
+        supervisor={
+            "shards": [
+                {
+                    "name": "all",
+                    "tracked_repositories": ["firefox-releases", "thunderbird"],
+                    "routing_key": "all.#",
+                }
+            ]
+        }
+    )
+
+    configs = shard_configs(config)
+
+    assert list(configs) == ["all"]
+    assert configs["all"].pulse.queue == "queue/git-hg-sync/test/all"
+    assert configs["all"].pulse.routing_key == "all.#"
+    assert len(configs["all"].tracked_repositories) == 2
+
+
+@pytest.mark.parametrize(
+    "shards,error",
+    [
+        (
+            [
+                {"name": "one", "tracked_repositories": ["firefox-releases"]},
+                {"name": "one", "tracked_repositories": ["thunderbird"]},
+            ],
+            "non-unique names",
+        ),
+        (
+            [{"name": "one", "tracked_repositories": ["firefox-releases", "unknown"]}],
+            "unknown",
+        ),
+        (
+            [
+                {"name": "one", "tracked_repositories": ["firefox-releases"]},
+                {
+                    "name": "two",
+                    "tracked_repositories": ["firefox-releases", "thunderbird"],
+                },
+            ],
+            "firefox-releases",
+        ),
+        (
+            [{"name": "one", "tracked_repositories": ["firefox-releases"]}],
+            "thunderbird",
+        ),
+    ],
+)
+def test_supervisor_shards_validation(shards: list[dict], error: str) -> None:
+    with pytest.raises(ValueError, match=error):
+        _config(supervisor={"shards": shards})
+
+
+class StoppingSupervisor(Supervisor):
+    """Stop once the first worker has been started `starts` times."""
+
+    def __init__(
+        self, *args: object, started: Path, starts: int, **kwargs: object
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self._started = started
+        self._starts = starts
+
+    def _check_workers(self) -> None:
+        super()._check_workers()
+        names = [path.name.split(".")[0] for path in self._started.iterdir()]
+        if names.count("worker-firefox-releases") >= self._starts:
+            self.should_stop = True
+
+
+# Threads left over by other tests don't matter, as the workers don't use them.
+@pytest.mark.filterwarnings("ignore:This process .* is multi-threaded")
+def test_supervisor_restarts_workers(tmp_path: Path) -> None:
+    started = tmp_path / "started"
+    started.mkdir()
+
+    def target(_config: Config, name: str) -> None:
+        # Record each start, and exit immediately to simulate a crash.
+        (started / f"{name}.{os.getpid()}").touch()
+
+    registry = ProcessRegistry(tmp_path / "registry")
+    supervisor = StoppingSupervisor(
+        _config(supervisor={"restart_delay": 0}),
+        target,
+        registry=registry,
+        poll_interval=0.01,
+        started=started,
+        starts=2,
+    )
+    supervisor.run()
+
+    names = [path.name.split(".")[0] for path in started.iterdir()]
+    assert names.count("worker-firefox-releases") >= 2
+    assert "worker-thunderbird" in names
+    assert registry.pids() == {}
@@ -0,0 +1,75 @@
+from pathlib import Path
+from unittest import mock
+
+from git_hg_sync.config import TrackedRepository
+from git_hg_sync.warmup import warm_up
+
+
+def _synchronizer(destination_urls: list[str]) -> mock.MagicMock:
+    synchronizer = mock.MagicMock()
+    synchronizer.resolve_destination_urls.return_value = destination_urls
+    return synchronizer
+
+
+def test_warm_up() -> None:
+    tracked_repositories = [
+        TrackedRepository(
+            name="firefox",
+            url="firefox.git",
+            seed_remotes=["https://hg.example/mozilla-unified"],
+        ),
+        TrackedRepository(name="thunderbird", url="thunderbird.git"),
+    ]
+    firefox = _synchronizer(
+        ["ssh://hg.example/beta", "ssh://hg.example/release", "ssh://hg.example/esr"]
+    )
+    # `esr` is in its own shard, while the others use the primary clone.
+    firefox.clone_directory_for.side_effect = lambda destination: Path(
+        "clones/firefox.esr" if destination.endswith("esr") else "clones/firefox"
+    )
+    synchronizers = {
+        "firefox.git": firefox,
+        "thunderbird.git": _synchronizer(["ssh://hg.example/comm-beta"]),
+    }
+    mappings = [mock.MagicMock()]
+
+    assert warm_up(tracked_repositories, synchronizers, mappings)
+
+    called = [name for name, _args, _kwargs in firefox.method_calls]
+    # Seed remotes are fetched before ensuring the metadata of the destinations.
+    assert called.index("fetch_all_from_remote") < called.index(
+        "ensure_cinnabar_metadata"
+    )
+    firefox.fetch_all_from_remote.assert_called_once_with(
+        mock.ANY, "hg::https://hg.example/mozilla-unified", False
+    )
+    firefox.resolve_destination_urls.assert_called_once_with(mappings)
+    # The metadata is only ensured once per clone.
+    assert firefox.ensure_cinnabar_metadata.call_args_list == [
+        mock.call(mock.ANY, "hg::ssh://hg.example/beta"),
+        mock.call(mock.ANY, "hg::ssh://hg.example/esr"),
+    ]
+
+    thunderbird = synchronizers["thunderbird.git"]
+    thunderbird.fetch_all_from_remote.assert_not_called()
+    thunderbird.ensure_cinnabar_metadata.assert_called_once_with(
+        mock.ANY, "hg::ssh://hg.example/comm-beta"
+    )
+
+
+def test_warm_up_failures() -> None:
+    tracked_repositories = [
+        TrackedRepository(name="firefox", url="firefox.git"),
+        TrackedRepository(name="thunderbird", url="thunderbird.git"),
+    ]
+    failing = _synchronizer([])
+    failing.resolve_destination_urls.side_effect = RuntimeError("ls-remote failed")
+    working = _synchronizer(["ssh://hg.example/comm-beta"])
+
+    assert not warm_up(
+        tracked_repositories,
+        {"firefox.git": failing, "thunderbird.git": working},
+        [],
+    )
+
+    working.ensure_cinnabar_metadata.assert_called_once()
@@ -0,0 +1,97 @@
+import time
+from pathlib import Path
+from unittest import mock
+
+import pytest
+from git import Repo
+from git.exc import GitCommandError
+
+from git_hg_sync.metrics import metrics
+from git_hg_sync.watchdog import CommandTimeoutError, run_git
+
+
+@pytest.fixture
+def repo(tmp_path: Path) -> Repo:
+    return Repo.init(tmp_path / "repo")
+
+
+def test_run_git(repo: Repo) -> None:
+    assert run_git(
+        repo, ["config", "--get", "core.bare"], stage="test", timeout=10
+    ) == ("false")
+    with pytest.raises(GitCommandError) as exc_info:
+        run_git(repo, ["rev-parse", "--verify", "missing"], stage="test", timeout=10)
+    assert not isinstance(exc_info.value, CommandTimeoutError)
+
+
+def test_run_git_progress(repo: Repo) -> None:
+    metrics.reset()
+    script = "echo 'Receiving objects: 50% (1/2)' >&2; echo output; echo"
+
+    assert (
+        run_git(
+            repo,
+            ["-c", f"alias.progress=!{script}", "progress"],
+            stage="fetch",
+            timeout=10,
+            progress_label="clone: fetch",
+        )
+        == "output"
+    )
+    gauges = metrics.snapshot()["gauges"]
+    assert gauges["git.progress.clone_fetch.receiving_objects.done"] == 1
+
+    # The errors are still reported, without the progress updates.
+    with pytest.raises(GitCommandError) as exc_info:
+        run_git(
+            repo,
+            ["-c", f"alias.progress=!{script} 'fatal: failed' >&2; exit 1", "progress"],
+            stage="fetch",
+            timeout=10,
+            progress_label="clone: fetch",
+        )
+    assert "fatal: failed" in exc_info.value.stderr
+    assert "Receiving objects" not in exc_info.value.stderr
+
+
+@pytest.mark.parametrize("progress_label", [None, "clone: push"])
+@pytest.mark.parametrize(
+    ("script", "signal_metric"),
+    [
+        ("sleep 30", "watchdog.sigterm"),
+        # The processes of the command ignore SIGTERM.
+        ("trap '' TERM; sleep 30", "watchdog.sigkill"),
+    ],
+)
+def test_run_git_timeout(
+    repo: Repo, script: str, signal_metric: str, progress_label: str | None
+) -> None:
+    metrics.reset()
+    start = time.monotonic()
+
+    with (
+        pytest.raises(CommandTimeoutError),
+        mock.patch("git_hg_sync.watchdog.logger") as logger,
+    ):
+        run_git(
+            repo,
+            ["-c", f"alias.hang=!{script}", "hang"],
+            stage="push",
+            timeout=0.5,
+            kill_grace=0.5,
+            progress_label=progress_label,
+        )
+
+    # The shell of the alias, and the sleep it started, were both killed.
+    assert time.monotonic() - start < 10
+    counters = metrics.snapshot()["counters"]
+    assert counters["timeouts.push"] == 1
+    assert counters[signal_metric] == 1
+    assert metrics.snapshot()["timings"]["timeouts.push.duration"]["count"] == 1
+    # The timeout, any SIGKILL, and the end of the command are logged with the stage.
+    logged = [call.args[0] for call in logger.warning.call_args_list]
+    assert all(line.startswith("push: ") for line in logged)
+    if signal_metric == "watchdog.sigkill":
+        assert any("sending SIGKILL" in line for line in logged)
+    assert "timed out after 0.5s" in logged[0]
+    assert " killed after " in logged[-1]